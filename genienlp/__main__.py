@@ -34,10 +34,12 @@ from . import (
     arguments,
     cache_embeddings,
     calibrate,
+    check_quantization,
     evaluate_file,
     export,
     kfserver,
     predict,
+    replay,
     run_bootleg,
     run_dialogue_loop,
     server,
@@ -63,7 +65,17 @@ subcommands = {
         evaluate_file.parse_argv,
         evaluate_file.main,
     ),
+    'check-quantization': (
+        'Compare the metrics of a model in full and in reduced precision on a dataset',
+        check_quantization.parse_argv,
+        check_quantization.main,
+    ),
     'server': ('Export RPC interface to predict', server.parse_argv, server.main),
+    'replay': (
+        'Replay a request trace recorded by the server and report throughput and latency',
+        replay.parse_argv,
+        replay.main,
+    ),
     'cache-embeddings': ('Download and cache embeddings', cache_embeddings.parse_argv, cache_embeddings.main),
     'run-paraphrase': ('Run a paraphraser model', run_generation.parse_argv, run_generation.main),
     # calibration commands
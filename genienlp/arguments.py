@@ -40,6 +40,19 @@ from .util import have_multilingual
 
 logger = logging.getLogger(__name__)
 
+# generation arguments that hold one value per set of hyperparameters
+GENERATION_HYPERPARAMETERS = [
+    'num_outputs',
+    'temperature',
+    'top_k',
+    'top_p',
+    'repetition_penalty',
+    'num_beams',
+    'num_beam_groups',
+    'diversity_penalty',
+    'no_repeat_ngram_size',
+]
+
 
 def get_commit():
     directory = os.path.dirname(__file__)
@@ -178,6 +191,12 @@ def parse_argv(parser):
         choices=['sample', 'epoch'],
         help='`sample` will sample batches from the training set but shorter examples will have a higher probability of being selected, `epoch` will sample but ensure that each training example is seen exactly N times before any example is seen N+1 times.',
     )
+    parser.add_argument(
+        '--data_loader_workers',
+        type=int,
+        default=0,
+        help='number of worker processes that prepare batches while the model trains. 0 prepares them in the main process',
+    )
     parser.add_argument(
         '--use_encoder_loss',
         action='store_true',
@@ -393,6 +412,19 @@ def parse_argv(parser):
         default=0.0,
         help='A number in [0, 1] to be used for label smoothing. 0 disables smoothing.',
     )
+    parser.add_argument(
+        '--pack_examples',
+        action='store_true',
+        help='Concatenate several examples into each row of a training batch instead of padding each one to the longest. '
+        'Only supported for T5 and mT5 models.',
+    )
+    parser.add_argument(
+        '--pack_max_length',
+        type=int,
+        default=0,
+        help='Maximum number of input (and output) tokens in each packed row. '
+        'Rows are never shorter than the longest example of the batch, which is also the default.',
+    )
 
     parser.add_argument(
         '--load',
@@ -590,20 +622,9 @@ def check_and_update_generation_args(args):
     checks all generation commandline arguments. Since these arguments are all lists and shorthand can be used, we expand them to match the expected length
     for instance, [1.0] becomes [1.0 1.0] if all other generation arguments are of length 2
     """
-    hyperparameters = [
-        'num_outputs',
-        'temperature',
-        'top_k',
-        'top_p',
-        'repetition_penalty',
-        'num_beams',
-        'num_beam_groups',
-        'diversity_penalty',
-        'no_repeat_ngram_size',
-    ]
-    max_hyperparameter_len = max([len(getattr(args, h)) for h in hyperparameters])
+    max_hyperparameter_len = max([len(getattr(args, h)) for h in GENERATION_HYPERPARAMETERS])
     valid_len = [1, max_hyperparameter_len]
-    for h in hyperparameters:
+    for h in GENERATION_HYPERPARAMETERS:
         if len(getattr(args, h)) not in valid_len:
             logger.error('Hyperparameters should either have the same number of values as others or have exactly one value.')
         # If only one value is provided, use the same value for all samples
@@ -705,6 +726,12 @@ def post_parse_train_specific(args):
         elif args.model == 'TransformerSeq2Seq' and args.pretrained_model not in MODEL_PARALLEL_SUPPORTED_MODELS:
             raise ValueError('Only the following models have model_parallel support: ', MODEL_PARALLEL_SUPPORTED_MODELS)
 
+    if args.pack_examples:
+        if args.model != 'TransformerSeq2Seq':
+            raise ValueError('Packing examples is only supported for TransformerSeq2Seq models')
+        if args.model_parallel:
+            raise ValueError('Packing examples is not supported with model_parallel')
+
     if args.mp_device_ratio is not None:
         if len(args.mp_device_ratio) != len(args.devices):
             raise ValueError('When using model_parallel number of provided devices must match the number of mp_device_ratio')
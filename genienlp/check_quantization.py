@@ -0,0 +1,106 @@
+#
+# Copyright (c) 2022, The Board of Trustees of the Leland Stanford Junior University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import copy
+import json
+import logging
+import os
+import sys
+
+from . import predict
+from .metrics import lower_is_better_metrics
+from .util import get_devices, set_seed
+
+logger = logging.getLogger(__name__)
+
+
+def parse_argv(parser):
+    predict.parse_argv(parser)
+    parser.add_argument(
+        '--max_metric_drop',
+        type=float,
+        default=1.0,
+        help='fail if any metric of the reduced-precision model is more than this many points worse than the full-precision '
+        'model (i.e. lower, or higher for error rates like TER)',
+    )
+
+
+def is_lower_better(metric):
+    # also covers the per-subtask metrics of e2e dialogues, e.g. `RG_ter`
+    return metric in lower_is_better_metrics or metric.split('_', 1)[-1] in lower_is_better_metrics
+
+
+def main(args):
+    """
+    Predicts on the same dataset with the full-precision model and with the `--quantize` mode, and compares the metrics
+    that `predict` computes (e.g. exact match and BLEU) for each task
+    """
+    if args.quantize == 'none':
+        raise ValueError('Pass the reduced-precision mode to check with --quantize')
+    quantize = args.quantize
+
+    predict.prepare_args(args)
+    device = get_devices(args.devices)[0]
+    if quantize == 'dynamic-int8' and device.type != 'cpu':
+        # the model would silently stay in full precision, and the check would compare it to itself
+        raise ValueError('dynamic-int8 quantization is only supported on CPU, set CUDA_VISIBLE_DEVICES= to check it on CPU')
+
+    results = dict()
+    for mode in ('none', quantize):
+        logger.info(f'Predicting with --quantize {mode}')
+        mode_args = copy.copy(args)
+        mode_args.quantize = mode
+        mode_args.eval_dir = os.path.join(args.eval_dir, mode)
+        # both runs sample (and drop out, with MC dropout) the same way, so that only the precision differs
+        set_seed(args)
+        results[mode] = predict.run(mode_args, device)
+
+    comparison = dict()
+    failed = False
+    for task_name, reference_metrics in results['none'].items():
+        comparison[task_name] = dict()
+        for metric, reference in reference_metrics.items():
+            value = results[quantize][task_name][metric]
+            # how much worse the reduced-precision model is
+            drop = value - reference if is_lower_better(metric) else reference - value
+            comparison[task_name][metric] = {'none': reference, quantize: value, 'drop': drop}
+            ok = drop <= args.max_metric_drop
+            failed = failed or not ok
+            direction = 'lower is better' if is_lower_better(metric) else 'higher is better'
+            logger.info(
+                f'{task_name} {metric} ({direction}): {reference:.2f} -> {value:.2f}, drop {drop:.2f} {"" if ok else "(FAILED)"}'
+            )
+
+    with open(os.path.join(args.eval_dir, 'quantization.json'), 'w') as fout:
+        json.dump(comparison, fout, indent=2)
+
+    if failed:
+        logger.error(f'Some metrics got worse by more than {args.max_metric_drop} points with --quantize {quantize}')
+        sys.exit(1)
+    logger.info(f'All metrics are within {args.max_metric_drop} points of the full-precision model')
@@ -30,6 +30,7 @@
 import unicodedata
 from typing import Iterable, List, NamedTuple, Union
 
+import numpy as np
 import torch
 
 
@@ -37,12 +38,84 @@ def identity(x, **kw):
     return x
 
 
+def pad_to_tensor(sequences, pad_id, length=None):
+    """
+    Pads `sequences` (lists of token ids, or of per-token feature lists) into a single CPU tensor, built in one step
+    instead of creating and padding one tensor per sequence.
+    length: if given, pad to at least this length
+    """
+    arrays = [np.asarray(sequence) for sequence in sequences]
+    non_empty = [array for array in arrays if array.size > 0]
+    # same dtypes as torch.tensor() would infer: int64 for integers, and the default float type otherwise
+    if non_empty and all(np.issubdtype(array.dtype, np.integer) for array in non_empty):
+        dtype = np.int64
+    else:
+        dtype = np.float32
+    trailing_shape = non_empty[0].shape[1:] if non_empty else ()
+    max_length = max([len(array) for array in arrays] + [length or 0])
+
+    padded = np.full((len(arrays), max_length, *trailing_shape), pad_id, dtype=dtype)
+    for i, array in enumerate(arrays):
+        if array.size > 0:
+            padded[i, : len(array)] = array
+    return torch.from_numpy(padded)
+
+
+def pack_examples(context_lengths, answer_lengths, context_budget, answer_budget):
+    """
+    Groups examples into rows whose total context and answer lengths stay within the budgets. Examples are placed
+    longest context first, each in the first row that still has room for it.
+    Returns a list of rows, each a list of example indices
+    """
+    rows, row_context_lengths, row_answer_lengths = [], [], []
+    for i in sorted(range(len(context_lengths)), key=lambda i: -context_lengths[i]):
+        for r in range(len(rows)):
+            if (
+                row_context_lengths[r] + context_lengths[i] <= context_budget
+                and row_answer_lengths[r] + answer_lengths[i] <= answer_budget
+            ):
+                break
+        else:
+            r = len(rows)
+            rows.append([])
+            row_context_lengths.append(0)
+            row_answer_lengths.append(0)
+        rows[r].append(i)
+        row_context_lengths[r] += context_lengths[i]
+        row_answer_lengths[r] += answer_lengths[i]
+    return rows
+
+
+def packed_positions(rows, lengths, width):
+    """
+    Lays out the sequences of each row of `rows` (as returned by `pack_examples`) one after the other.
+    Returns two (num_rows, max_row_length) int64 tensors: the position of each token in the flattened padded
+    (num_examples, width) tensor the sequences come from, and the 1-based index of the example each token belongs to.
+    Both are 0 at padding.
+    """
+    num_columns = max(sum(lengths[i] for i in row) for row in rows)
+    positions = np.zeros((len(rows), num_columns), dtype=np.int64)
+    segments = np.zeros((len(rows), num_columns), dtype=np.int64)
+    for r, row in enumerate(rows):
+        offset = 0
+        for i in row:
+            positions[r, offset : offset + lengths[i]] = np.arange(i * width, i * width + lengths[i])
+            segments[r, offset : offset + lengths[i]] = i + 1
+            offset += lengths[i]
+    return torch.from_numpy(positions), torch.from_numpy(segments)
+
+
 class SequentialField(NamedTuple):
     value: Union[torch.tensor, List[int]]
     length: Union[torch.tensor, int]
     limited: Union[torch.tensor, List[int]]
     feature: Union[torch.tensor, List[List[int]], None]
 
+    def to(self, device, non_blocking=False):
+        return SequentialField(
+            *(field.to(device, non_blocking=non_blocking) if isinstance(field, torch.Tensor) else field for field in self)
+        )
+
 
 VALID_ENTITY_ATTRIBUTES = ('type_id', 'type_prob', 'qid')
 
@@ -211,35 +284,34 @@ class NumericalizedExamples(NamedTuple):
             )
         return numericalized_examples
 
-    @staticmethod
-    def collate_batches(batches: Iterable['NumericalizedExamples'], numericalizer, device):
-        example_id = []
-
-        context_values, context_lengths, context_limiteds, context_features = [], [], [], []
-        answer_values, answer_lengths, answer_limiteds = [], [], []
-
-        for batch in batches:
-            example_id.append(batch.example_id[0])
-            context_values.append(torch.tensor(batch.context.value, device=device))
-            context_lengths.append(torch.tensor(batch.context.length, device=device))
-            context_limiteds.append(torch.tensor(batch.context.limited, device=device))
-            if batch.context.feature:
-                context_features.append(torch.tensor(batch.context.feature, device=device))
-
-            answer_values.append(torch.tensor(batch.answer.value, device=device))
-            answer_lengths.append(torch.tensor(batch.answer.length, device=device))
-            answer_limiteds.append(torch.tensor(batch.answer.limited, device=device))
+    def to(self, device, non_blocking=False):
+        return NumericalizedExamples(
+            example_id=self.example_id,
+            context=self.context.to(device, non_blocking=non_blocking),
+            answer=self.answer.to(device, non_blocking=non_blocking),
+        )
 
-        context_values = numericalizer.pad(context_values, pad_id=numericalizer.pad_id)
-        context_limiteds = numericalizer.pad(context_limiteds, pad_id=numericalizer.decoder_pad_id)
-        context_lengths = torch.stack(context_lengths, dim=0)
+    @staticmethod
+    def collate_batches(batches: Iterable['NumericalizedExamples'], numericalizer, device, context_length=None):
+        """
+        Padded tensors are built on the CPU, then moved to `device` (if not None) with one copy per field.
+        context_length: if given, pad contexts to at least this length
+        """
+        example_id = [batch.example_id[0] for batch in batches]
+
+        context_values = pad_to_tensor([batch.context.value for batch in batches], numericalizer.pad_id, context_length)
+        context_limiteds = pad_to_tensor(
+            [batch.context.limited for batch in batches], numericalizer.decoder_pad_id, context_length
+        )
+        context_lengths = torch.tensor([batch.context.length for batch in batches])
 
+        context_features = [batch.context.feature for batch in batches if batch.context.feature]
         if context_features:
-            context_features = numericalizer.pad(context_features, pad_id=numericalizer.args.db_unk_id)
+            context_features = pad_to_tensor(context_features, numericalizer.args.db_unk_id, context_length)
 
-        answer_values = numericalizer.pad(answer_values, pad_id=numericalizer.pad_id)
-        answer_limiteds = numericalizer.pad(answer_limiteds, pad_id=numericalizer.decoder_pad_id)
-        answer_lengths = torch.stack(answer_lengths, dim=0)
+        answer_values = pad_to_tensor([batch.answer.value for batch in batches], numericalizer.pad_id)
+        answer_limiteds = pad_to_tensor([batch.answer.limited for batch in batches], numericalizer.decoder_pad_id)
+        answer_lengths = torch.tensor([batch.answer.length for batch in batches])
 
         context = SequentialField(
             value=context_values,
@@ -250,4 +322,8 @@ class NumericalizedExamples(NamedTuple):
 
         answer = SequentialField(value=answer_values, length=answer_lengths, limited=answer_limiteds, feature=None)
 
-        return NumericalizedExamples(example_id=example_id, context=context, answer=answer)
+        collated = NumericalizedExamples(example_id=example_id, context=context, answer=answer)
+        if device is not None:
+            # only asynchronous if the tensors were pinned (see util.make_data_loader)
+            collated = collated.to(device, non_blocking=True)
+        return collated
@@ -28,7 +28,9 @@
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import hashlib
 import logging
+import os
 import random
 
 import numpy as np
@@ -39,6 +41,143 @@ logger = logging.getLogger(__name__)
 _warned_for_batch_size = False
 
 
+class PaddedBatchSize(object):
+    """
+    A batch size function that counts the elements of a batch after padding: the number of examples times the sum of
+    the maximum of each of `length_fns` over the batch, or just the number of examples if there is no `length_fn`.
+
+    It can be called on a list of examples like any other batch size function, but `LengthSortedIterator` computes it
+    incrementally instead, from per-example lengths it computes once.
+    """
+
+    def __init__(self, *length_fns):
+        self.length_fns = length_fns
+
+    def __call__(self, batch):
+        if not self.length_fns:
+            return len(batch)
+        return sum(max(length_fn(ex) for ex in batch) for length_fn in self.length_fns) * len(batch)
+
+    def example_lengths(self, examples):
+        """
+        Returns an array of shape (len(examples), len(self.length_fns))
+        """
+        lengths = np.zeros((len(examples), len(self.length_fns)), dtype=np.int64)
+        for i, length_fn in enumerate(self.length_fns):
+            lengths[:, i] = np.fromiter((length_fn(ex) for ex in examples), dtype=np.int64, count=len(examples))
+        return lengths
+
+
+class _PaddedBatchSizeAccumulator(object):
+    """
+    The size of a growing batch according to a PaddedBatchSize, updated in constant time when an example is added
+    """
+
+    def __init__(self, lengths):
+        # `lengths` is a list of per-example lengths (or an empty list if the batch size is the number of examples)
+        self.lengths = lengths
+        self.maxima = [0] * len(lengths[0]) if len(lengths) > 0 else []
+        self.count = 0
+
+    def example_size(self, index):
+        # the size of a batch with only this example
+        return sum(self.lengths[index]) if self.maxima else 1
+
+    def size_with(self, index):
+        # the batch size if we added this example to the batch
+        if not self.maxima:
+            return self.count + 1
+        return sum(max(m, length) for m, length in zip(self.maxima, self.lengths[index])) * (self.count + 1)
+
+    def add(self, index):
+        if self.maxima:
+            self.maxima = [max(m, length) for m, length in zip(self.maxima, self.lengths[index])]
+        self.count += 1
+
+
+class _BatchSizeAccumulator(object):
+    """
+    The size of a growing batch according to an arbitrary batch size function, which has to be called on the whole batch
+    """
+
+    def __init__(self, data_source, batch_size_fn):
+        self.data_source = data_source
+        self.batch_size_fn = batch_size_fn
+        self.examples = []
+
+    def example_size(self, index):
+        return self.batch_size_fn([self.data_source[index]])
+
+    def size_with(self, index):
+        return self.batch_size_fn(self.examples + [self.data_source[index]])
+
+    def add(self, index):
+        self.examples.append(self.data_source[index])
+
+
+class _UnmarkedIndices(object):
+    """
+    The indices of the examples that have not been used in a batch yet in the current epoch, in a Fenwick tree over
+    their 0/1 flags. Marking an index, finding the k-th unmarked index and finding the next unmarked index after a
+    given one all take O(log N) time; the next unmarked index is found in O(1) when it directly follows the given one,
+    which is the common case.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.num_unmarked = size
+        self.marked = np.zeros(size, dtype=bool)
+        # tree[i] (1-based) is the number of unmarked indices in (i - lowbit(i), i], which is lowbit(i) when none is marked
+        positions = np.arange(1, size + 1, dtype=np.int64)
+        self.tree = [0] + (positions & -positions).tolist()
+        self._highest_bit = 1 << (size.bit_length() - 1) if size > 0 else 0
+
+    def mark(self, index):
+        if self.marked[index]:
+            return
+        self.marked[index] = True
+        self.num_unmarked -= 1
+        i = index + 1
+        while i <= self.size:
+            self.tree[i] -= 1
+            i += i & -i
+
+    def count_before(self, index):
+        """
+        Returns the number of unmarked indices in [0, index)
+        """
+        count = 0
+        while index > 0:
+            count += self.tree[index]
+            index -= index & -index
+        return count
+
+    def find(self, k):
+        """
+        Returns the k-th (0-based) unmarked index, or `size` if there are not that many
+        """
+        if k >= self.num_unmarked:
+            return self.size
+        position = 0
+        remaining = k + 1
+        step = self._highest_bit
+        while step > 0:
+            next_position = position + step
+            if next_position <= self.size and self.tree[next_position] < remaining:
+                position = next_position
+                remaining -= self.tree[next_position]
+            step >>= 1
+        return position
+
+    def next_unmarked(self, index):
+        """
+        Returns the first unmarked index after `index`, or `size` if there is none
+        """
+        if index + 1 >= self.size or not self.marked[index + 1]:
+            return index + 1
+        return self.find(self.count_before(index + 1))
+
+
 class LengthSortedIterator(torch.utils.data.Sampler):
     """ """
 
@@ -52,12 +191,15 @@ class LengthSortedIterator(torch.utils.data.Sampler):
         batch_size_fn,
         groups=1,
         batching_algorithm='sample',
+        batch_plan_dir=None,
     ):
         """
         batch_size: can be number of tokens or number of examples, the type is inferred from batch_size_fn
         sort: if False, disables sorting and uses the original order. Useful for evaluation.
         shuffle_and_repeat: if True, the order of returned examples are semi-shuffled, and there is no end to the iterator
         groups: used for sentence batching
+        batch_plan_dir: if provided and shuffle_and_repeat is False, batch plans are cached in this directory, so that
+            iterating again over the same examples with the same batch size does not need to plan the batches again
         """
         if groups is None:
             groups = 1
@@ -84,22 +226,24 @@ class LengthSortedIterator(torch.utils.data.Sampler):
             self.data_source, self.original_order = tuple(zip(*sorted_data_with_original_order))
         else:
             self.data_source, self.original_order = data_source, list(range(len(data_source)))
-        self.data_source_marked = np.zeros(shape=(len(self.data_source)))  # mark each example that has been used in a batch
+        self._example_lengths = None
+        if isinstance(self.batch_size_fn, PaddedBatchSize):
+            # kept in a NumPy array, and as Python lists for fast access to single elements while batches are built
+            self._example_lengths = self.batch_size_fn.example_lengths(self.data_source)
+            self._example_lengths_list = self._example_lengths.tolist()
+        self.unmarked = _UnmarkedIndices(len(self.data_source))  # mark each example that has been used in a batch
         self.batch_size = batch_size  # number of examples or number of tokens
         self.shuffle_and_repeat = shuffle_and_repeat
         self.last_batch_start_index = 0
         self.last_batch_start_index = self._get_next_batch_start_index()
 
+        # boundaries of the batches, i.e. batch i is [batch_plan[i], batch_plan[i + 1]), when the order is deterministic
+        self.batch_plan = None
         if not self.shuffle_and_repeat:
             # do not allow skipping examples during validation/ prediction
             self.no_skip = True
-            # quickly iterate over self to calculate length
-            self.length = 0
-            for _ in self:
-                self.length += 1
-            # reset state
-            self.last_batch_start_index = 0
-            self.last_batch_start_index = self._get_next_batch_start_index()
+            self.batch_plan = self._load_or_make_batch_plan(batch_plan_dir)
+            self.length = len(self.batch_plan) - 1
         else:
             self.no_skip = False
             self.length = len(self.data_source)
@@ -107,23 +251,70 @@ class LengthSortedIterator(torch.utils.data.Sampler):
     def __len__(self):
         return self.length
 
+    def _make_batch_plan(self):
+        # without shuffling, batches are consecutive ranges of examples, so their boundaries are enough to describe them
+        batch_plan = [0]
+        for batch_of_indices in self:
+            assert batch_of_indices[0] == batch_plan[-1]
+            batch_plan.append(batch_plan[-1] + len(batch_of_indices))
+        return np.array(batch_plan, dtype=np.int64)
+
+    def _batch_plan_path(self, batch_plan_dir):
+        # the plan only depends on the lengths of the (sorted) examples and the batch size
+        if batch_plan_dir is None or self._example_lengths is None:
+            return None
+        key = hashlib.sha256(self._example_lengths.tobytes())
+        key.update(f'{self._example_lengths.shape}-{self.batch_size}'.encode())
+        return os.path.join(batch_plan_dir, f'{key.hexdigest()}.npy')
+
+    def _load_or_make_batch_plan(self, batch_plan_dir):
+        path = self._batch_plan_path(batch_plan_dir)
+        if path is not None and os.path.exists(path):
+            logger.info(f'Loading batch plan from {path}')
+            return np.load(path)
+
+        batch_plan = self._make_batch_plan()
+        # reset state
+        self.last_batch_start_index = 0
+        self.last_batch_start_index = self._get_next_batch_start_index()
+
+        if path is not None:
+            os.makedirs(batch_plan_dir, exist_ok=True)
+            # write to a temporary file first so that concurrent runs never see a partial plan
+            tmp_path = f'{path}.{os.getpid()}.tmp.npy'
+            np.save(tmp_path, batch_plan)
+            os.replace(tmp_path, path)
+            logger.info(f'Saved batch plan to {path}')
+        return batch_plan
+
+    def _iter_batch_plan(self):
+        for start, end in zip(self.batch_plan[:-1].tolist(), self.batch_plan[1:].tolist()):
+            yield list(range(start, end))
+
     def __iter__(self):
+        if self.batch_plan is not None:
+            return self._iter_batch_plan()
         self.last_batch_start_index = 0
-        self.data_source_marked = np.zeros(shape=(len(self.data_source)))
+        self.unmarked = _UnmarkedIndices(len(self.data_source))
         self.last_batch_start_index = self._get_next_batch_start_index()
         return self
 
+    def _new_batch_size_accumulator(self):
+        if self._example_lengths is not None:
+            return _PaddedBatchSizeAccumulator(self._example_lengths_list)
+        return _BatchSizeAccumulator(self.data_source, self.batch_size_fn)
+
     def __next__(self):
         batch_of_indices = []
         current_batch_size = 0
+        accumulator = self._new_batch_size_accumulator()
         candidate_index = self._get_next_batch_start_index()
         if candidate_index >= len(self.data_source):
             # This is the end of the iterator
             assert not self.shuffle_and_repeat
             raise StopIteration
         while current_batch_size < self.batch_size:
-            candidate_example = self.data_source[candidate_index]
-            if self.batch_size_fn([candidate_example]) > self.batch_size:
+            if accumulator.example_size(candidate_index) > self.batch_size:
                 # the example is too big even on its own
                 global _warned_for_batch_size
                 if self.no_skip:
@@ -143,16 +334,15 @@ class LengthSortedIterator(torch.utils.data.Sampler):
                     raise StopIteration
                 continue
 
-            candidate_batch_size = self.batch_size_fn(
-                [self.data_source[i] for i in batch_of_indices] + [candidate_example]
-            )  # the new batch size if we added this example to the batch
+            candidate_batch_size = accumulator.size_with(candidate_index)  # the new batch size if we added this example
             if candidate_batch_size > self.batch_size:
                 # the new example would put us over the batch size limit
                 break
 
             batch_of_indices.append(candidate_index)
+            accumulator.add(candidate_index)
             if self.batching_algorithm == 'epoch':
-                self.data_source_marked[candidate_index] = 1  # mark this index until the end of this epoch
+                self.unmarked.mark(candidate_index)  # mark this index until the end of this epoch
             current_batch_size = candidate_batch_size
             candidate_index = self._next_unmarked_index(candidate_index)
 
@@ -163,23 +353,20 @@ class LengthSortedIterator(torch.utils.data.Sampler):
         return batch_of_indices
 
     def _unmarked_index_to_datasource_index(self, index: int) -> int:
-        return np.searchsorted(np.arange(0, len(self.data_source)) - np.cumsum(self.data_source_marked), index, side='left')
+        return self.unmarked.find(index)
 
     def _next_unmarked_index(self, index: int) -> int:
         """
         or stop at len(self.data_source)
         """
-        index += 1
-        while index < len(self.data_source) and self.data_source_marked[index] == 1:
-            index += 1
-        return index
+        return self.unmarked.next_unmarked(index)
 
     def _get_next_batch_start_index(self):
         if self.shuffle_and_repeat:
-            examples_left_in_epoch = len(self.data_source) - np.sum(self.data_source_marked)
+            examples_left_in_epoch = self.unmarked.num_unmarked
             if examples_left_in_epoch == 0:
                 # start a new epoch
-                self.data_source_marked = np.zeros(shape=(len(self.data_source)))
+                self.unmarked = _UnmarkedIndices(len(self.data_source))
                 examples_left_in_epoch = len(self.data_source)
             # if self.groups > 1, this ensures that the start of each batch is a multiply of self.groups, i.e. where a group starts
             start_idx = random.randrange(0, examples_left_in_epoch / self.groups) * self.groups
@@ -36,7 +36,6 @@ from collections import Counter, defaultdict
 from typing import List, Tuple
 
 from pathos import multiprocessing
-from torch.nn.utils.rnn import pad_sequence
 from transformers import (
     SPIECE_UNDERLINE,
     T5_PRETRAINED_CONFIG_ARCHIVE_MAP,
@@ -256,13 +255,6 @@ class TransformerNumericalizer(object):
         except FileNotFoundError:
             pass
 
-    def pad(self, batch, pad_id):
-        """
-        batch: a List of List of integers
-        """
-        # TODO account for left padding models
-        return pad_sequence(batch, padding_value=pad_id, batch_first=True)
-
     def save(self, save_dir):
         self._tokenizer.save_pretrained(save_dir)
         if self.max_generative_vocab is not None:
@@ -28,29 +28,60 @@
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import asyncio
 import logging
 
 import kfserving
+from tornado.web import HTTPError
 
 from .server import Server, init
+from .server_utils.batching import RequestRejected
 from .util import log_model_size
 
 logger = logging.getLogger(__name__)
 
+# HTTP status of requests that are rejected by admission control
+REJECTED_REQUEST_STATUS = {
+    'overloaded': 503,
+    'deadline_exceeded': 504,
+    'unknown_model': 404,
+    'unavailable': 503,
+    'shutting_down': 503,
+}
+
 
 class KFModelServer(kfserving.KFModel):
     def __init__(self, name, args, model, device, confidence_estimators, estimator_filenames, ned_model):
         super().__init__(name)
         self.server = Server(args, model, device, confidence_estimators, estimator_filenames, ned_model)
+        self.server.replicas.on_device_failure = self._on_device_failure
 
     def load(self):
         log_model_size(logger, self.server.model, self.server.args.model)
         self.server.model.to(self.server.device)
         self.server.model.eval()
+        # only report ready once warm, so that rolling deployments do not send traffic to cold servers
+        self.server.warmup()
+        if self.server.args.metrics_port:
+            # KFServer runs tornado on the asyncio event loop, so the endpoint starts serving with it
+            asyncio.ensure_future(
+                self.server.metrics.start_http_server(self.server.args.metrics_port, self.server.args.metrics_host)
+            )
+        # concurrent HTTP requests are batched together, like in the TCP server
+        self.server.batcher.start()
         self.ready = True
 
-    def predict(self, request):
-        results = self.server.handle_request(request)
+    def _on_device_failure(self, replica):
+        # the remaining replicas keep serving; once none is left, report not ready so that the deployment replaces us
+        if all(replica.failed for replica in self.server.replicas.replicas):
+            logger.error('All model replicas failed, reporting the model as not ready')
+            self.ready = False
+
+    async def predict(self, request):
+        try:
+            results = await self.server.handle_request_async(request)
+        except RequestRejected as e:
+            raise HTTPError(REJECTED_REQUEST_STATUS[e.code], reason=str(e))
         return {"predictions": results}
 
 
@@ -60,4 +91,6 @@ def main(args):
         args.inference_name, args, model, device, confidence_estimators, estimator_filenames, ned_model
     )
     model_server.load()
+    # a single front-end process; use --workers to serve with several model replicas behind it.
+    # tornado runs on the asyncio event loop that the batcher was started on in load()
     kfserving.KFServer(workers=1).start([model_server])
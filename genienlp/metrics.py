@@ -45,6 +45,9 @@ logger = logging.getLogger(__name__)
 # These metrics cannot be calculated on individual examples and then averaged.
 corpus_level_metrics = {'bleu', 'casedbleu', 'ter', 't5_bleu', 'nmt_bleu', 'corpus_f1', 'jga'}
 
+# error rates, for which lower values are better; higher is better for all other metrics
+lower_is_better_metrics = {'ter', 'ser'}
+
 
 def f1_score(prediction, ground_truth):
     prediction_tokens = prediction.split()
@@ -0,0 +1,137 @@
+#
+# Copyright (c) 2022, The Board of Trustees of the Leland Stanford Junior University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+# tensors start at multiples of this many bytes in the weights file
+ALIGNMENT = 64
+
+# numpy has no bfloat16, so bfloat16 tensors are stored and mapped as int16 and reinterpreted
+_NUMPY_DTYPES = {
+    torch.float64: np.float64,
+    torch.float32: np.float32,
+    torch.float16: np.float16,
+    torch.bfloat16: np.int16,
+    torch.int64: np.int64,
+    torch.int32: np.int32,
+    torch.int16: np.int16,
+    torch.int8: np.int8,
+    torch.uint8: np.uint8,
+    torch.bool: np.bool_,
+}
+_TORCH_DTYPES = {str(dtype): dtype for dtype in _NUMPY_DTYPES}
+
+
+def mapped_weights_path(directory, checkpoint_path, variant=''):
+    """
+    The path of the weights file for `checkpoint_path` in `directory`. The name changes whenever the checkpoint is
+    modified, so stale weights files are never used.
+    """
+    checkpoint_path = os.path.abspath(checkpoint_path)
+    key = f'{checkpoint_path}@{os.path.getmtime(checkpoint_path)}#{variant}'
+    name = os.path.basename(checkpoint_path).rsplit('.', 1)[0]
+    return os.path.join(directory, f'{name}-{hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]}.weights')
+
+
+def save_mapped_weights(state_dict, path, metadata=None):
+    """
+    Writes all tensors of `state_dict` to a single flat file at `path`, with an index in `path`.json.
+    Tensors that share memory (e.g. tied embeddings) are written once.
+    """
+    index = {'metadata': metadata or {}, 'tensors': {}}
+    written = dict()  # (data_ptr, dtype, shape, stride) of the tensor in `state_dict` -> offset
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as fout:
+        for name, tensor in state_dict.items():
+            # key on the tensors of `state_dict`, which stay alive while writing, rather than on the CPU copies made
+            # below, whose memory can be reused by the next copy
+            key = (tensor.data_ptr(), str(tensor.dtype), tuple(tensor.shape), tuple(tensor.stride()))
+            tensor = tensor.detach().cpu().contiguous()
+            if key not in written:
+                padding = -fout.tell() % ALIGNMENT
+                fout.write(b'\0' * padding)
+                written[key] = fout.tell()
+                data = tensor.view(torch.int16) if tensor.dtype == torch.bfloat16 else tensor
+                fout.write(data.numpy().tobytes())
+            index['tensors'][name] = {'dtype': str(tensor.dtype), 'shape': list(tensor.shape), 'offset': written[key]}
+    with open(tmp_path + '.json', 'w') as fout:
+        json.dump(index, fout)
+
+    # rename the index last, so that other processes never see an index whose weights are incomplete
+    os.replace(tmp_path, path)
+    os.replace(tmp_path + '.json', path + '.json')
+
+
+def load_mapped_weights(path):
+    """
+    Maps the weights file at `path` into memory. Returns the dictionary of tensors and the metadata saved with them.
+
+    The mapping is copy-on-write: all processes that map the same file share its pages through the page cache, and a
+    process that modifies a tensor only gets a private copy of the pages it modified.
+    """
+    with open(path + '.json') as fin:
+        index = json.load(fin)
+    mapped = np.memmap(path, dtype=np.uint8, mode='c')
+
+    state_dict = dict()
+    for name, entry in index['tensors'].items():
+        dtype = _TORCH_DTYPES[entry['dtype']]
+        numpy_dtype = np.dtype(_NUMPY_DTYPES[dtype])
+        num_elements = int(np.prod(entry['shape'], dtype=np.int64))
+        start = entry['offset']
+        array = mapped[start : start + num_elements * numpy_dtype.itemsize].view(numpy_dtype).reshape(entry['shape'])
+        tensor = torch.from_numpy(array)
+        if dtype == torch.bfloat16:
+            tensor = tensor.view(torch.bfloat16)
+        state_dict[name] = tensor
+    return state_dict, index['metadata']
+
+
+def assign_mapped_weights(model, state_dict):
+    """
+    Makes the parameters and buffers of `model` point to the tensors of `state_dict` instead of copying them, like
+    `load_state_dict(strict=True)` would
+    """
+    own_state = model.state_dict(keep_vars=True)
+    missing = set(own_state.keys()) - set(state_dict.keys())
+    unexpected = set(state_dict.keys()) - set(own_state.keys())
+    if missing or unexpected:
+        raise RuntimeError(
+            f'Mapped weights do not match the model: missing {sorted(missing)}, unexpected {sorted(unexpected)}'
+        )
+    for name, tensor in own_state.items():
+        tensor.data = state_dict[name]
@@ -31,6 +31,7 @@ import copy
 import logging
 import os
 from collections import defaultdict
+from contextlib import nullcontext
 from typing import List, Optional
 
 import dialogues
@@ -42,13 +43,20 @@ from transformers import AutoConfig, BartForConditionalGeneration, MarianTokeniz
 from ..data_utils.example import NumericalizedExamples, SequentialField
 from ..data_utils.numericalizer import TransformerNumericalizer
 from ..data_utils.progbar import progress_bar
+from ..model_utils.mapped_weights import assign_mapped_weights, load_mapped_weights, mapped_weights_path, save_mapped_weights
 from ..util import adjust_language_code, merge_translated_sentences, replace_capturing_group
+from .common import GenerationConfidence
 
 logger = logging.getLogger(__name__)
 
+QUANTIZATION_MODES = ('none', 'dynamic-int8', 'fp16', 'bf16')
+
 
 class GenieModel(PreTrainedModel):
     numericalizer: TransformerNumericalizer
+    _generation_streamer = None
+    _generation_confidence = None
+    _stage_timer = None
 
     @classmethod
     def load(cls, save_directory: str, *model_args, **kwargs):
@@ -66,6 +74,33 @@ class GenieModel(PreTrainedModel):
         full_checkpoint_path = os.path.join(save_directory, model_checkpoint_file)
         logger.info(f'Loading the model from {full_checkpoint_path}')
         model = cls(args=args, tasks=tasks, vocab_sets=vocab_sets, save_directory=save_directory, *model_args, **kwargs)
+        quantize = getattr(args, 'quantize', 'none')
+
+        mapped_weights_dir = getattr(args, 'mapped_weights_dir', None)
+        # int8 weights are repacked by quantization, and weights on GPUs are copied anyway, so neither can be mapped
+        if mapped_weights_dir and quantize != 'dynamic-int8' and (device is None or torch.device(device).type == 'cpu'):
+            path = mapped_weights_path(mapped_weights_dir, full_checkpoint_path, quantize)
+            if not os.path.exists(path + '.json'):
+                logger.info(f'Writing the weights to {path} so that they can be mapped into memory')
+                best_decascore = model._load_checkpoint(full_checkpoint_path, device)
+                model.quantize(quantize, device)
+                os.makedirs(mapped_weights_dir, exist_ok=True)
+                save_mapped_weights(model.state_dict(), path, {'best_decascore': best_decascore})
+            logger.info(f'Mapping the weights from {path}')
+            state_dict, metadata = load_mapped_weights(path)
+            assign_mapped_weights(model, state_dict)
+            return model, metadata.get('best_decascore')
+
+        best_decascore = model._load_checkpoint(full_checkpoint_path, device)
+        model.quantize(quantize, device)
+
+        return model, best_decascore
+
+    def _load_checkpoint(self, full_checkpoint_path, device):
+        """
+        Loads the weights saved in `full_checkpoint_path` into this model, and returns the best validation score
+        saved with them
+        """
         save_dict = torch.load(full_checkpoint_path, map_location=device)
 
         # HACK
@@ -77,13 +112,48 @@ class GenieModel(PreTrainedModel):
         if (
             'model.lm_head.weight' not in save_dict['model_state_dict']
             and 'model.model.shared.weight' in save_dict['model_state_dict']
-            and isinstance(model.model, BartForConditionalGeneration)
+            and isinstance(self.model, BartForConditionalGeneration)
         ):
             save_dict['model_state_dict']['model.lm_head.weight'] = save_dict['model_state_dict']['model.model.shared.weight']
 
-        model.load_state_dict(save_dict['model_state_dict'], strict=True)
+        self.load_state_dict(save_dict['model_state_dict'], strict=True)
 
-        return model, save_dict.get('best_decascore')
+        return save_dict.get('best_decascore')
+
+    def quantize(self, mode, device=None):
+        """
+        Converts the model in place for smaller and faster inference. `mode` is one of QUANTIZATION_MODES, and `device`
+        is the device the model will run on
+        """
+        if mode not in QUANTIZATION_MODES:
+            raise ValueError(f'Unknown quantization mode {mode}, expected one of {QUANTIZATION_MODES}')
+        on_cpu = device is None or torch.device(device).type == 'cpu'
+        if mode == 'dynamic-int8':
+            if not on_cpu:
+                logger.warning('dynamic-int8 quantization is only supported on CPU, the model will run in full precision')
+                return self
+            # the output projection (e.g. lm_head) is tied to the input embeddings, and must stay a Linear layer so that
+            # resize_token_embeddings() can re-tie it when the vocabulary grows
+            output_embeddings = {
+                id(module.get_output_embeddings()) for module in self.modules() if isinstance(module, PreTrainedModel)
+            }
+            # int8 weights for all other linear layers, with activations quantized on the fly
+            qconfig_spec = {
+                name: torch.quantization.default_dynamic_qconfig
+                for name, module in self.named_modules()
+                if isinstance(module, torch.nn.Linear) and id(module) not in output_embeddings
+            }
+            torch.quantization.quantize_dynamic(self, qconfig_spec, dtype=torch.qint8, inplace=True)
+            logger.info('Quantized linear layers to int8')
+        elif mode == 'fp16':
+            if on_cpu:
+                logger.warning('Many operators are slow or not implemented in fp16 on CPU, consider bf16 or dynamic-int8')
+            self.half()
+            logger.info('Converted the model to fp16')
+        elif mode == 'bf16':
+            self.to(torch.bfloat16)
+            logger.info('Converted the model to bf16')
+        return self
 
     def add_new_vocab_from_data(self, tasks, resize_decoder=False):
         old_num_tokens = self.numericalizer.num_tokens
@@ -100,6 +170,37 @@ class GenieModel(PreTrainedModel):
         self._output_scores = False
         self._output_hidden_states = False
 
+    def set_generation_streamer(self, streamer):
+        """
+        `streamer` is a GenerationStreamer that will see the partial outputs of subsequent generate() calls, or None
+        """
+        self._generation_streamer = streamer
+
+    def _can_collect_confidence_during_generation(self, task, hyperparameter_idx):
+        """
+        Whether the no-dropout confidence features can be collected during generation instead of with a teacher-forced
+        pass. This needs greedy decoding, which generates each prediction in a single sequence of steps
+        """
+        return (
+            getattr(self.args, 'confidence_from_generation', False)
+            and self.args.num_beams[hyperparameter_idx] == 1
+            and self.args.temperature[hyperparameter_idx] == 0
+            # postprocessing can change the predicted ids
+            and not getattr(task, 'need_attention_scores', False)
+        )
+
+    def set_stage_timer(self, stage_timer):
+        """
+        `stage_timer` is a function that takes the name of a stage of prediction (e.g. `generate`) and returns a
+        context manager that measures it, or None to disable timing
+        """
+        self._stage_timer = stage_timer
+
+    def _time_stage(self, stage):
+        if self._stage_timer is None:
+            return nullcontext()
+        return self._stage_timer(stage)
+
 
 class ValidationOutput(object):
     """
@@ -243,23 +344,30 @@ class GenieModelForGeneration(GenieModel):
                 total_loss += loss
 
             for hyperparameter_idx in range(len(self.args.temperature)):
-                generated = self.generate(
-                    batch,
-                    max_output_length=self.args.max_output_length,
-                    min_output_length=self.args.min_output_length,
-                    num_outputs=self.args.num_outputs[hyperparameter_idx],
-                    temperature=self.args.temperature[hyperparameter_idx]
-                    if self.args.temperature[hyperparameter_idx] > 0
-                    else 1.0,
-                    repetition_penalty=self.args.repetition_penalty[hyperparameter_idx],
-                    top_k=self.args.top_k[hyperparameter_idx],
-                    top_p=self.args.top_p[hyperparameter_idx],
-                    num_beams=self.args.num_beams[hyperparameter_idx],
-                    num_beam_groups=self.args.num_beam_groups[hyperparameter_idx],
-                    diversity_penalty=self.args.diversity_penalty[hyperparameter_idx],
-                    no_repeat_ngram_size=self.args.no_repeat_ngram_size[hyperparameter_idx],
-                    do_sample=self.args.temperature[hyperparameter_idx] != 0,  # if temperature==0, we do not sample
-                )
+                collect_confidence = (
+                    output_confidence_features or output_confidence_scores
+                ) and self._can_collect_confidence_during_generation(task, hyperparameter_idx)
+                self._generation_confidence = GenerationConfidence() if collect_confidence else None
+                with self._time_stage('generate'):
+                    generated = self.generate(
+                        batch,
+                        max_output_length=self.args.max_output_length,
+                        min_output_length=self.args.min_output_length,
+                        num_outputs=self.args.num_outputs[hyperparameter_idx],
+                        temperature=self.args.temperature[hyperparameter_idx]
+                        if self.args.temperature[hyperparameter_idx] > 0
+                        else 1.0,
+                        repetition_penalty=self.args.repetition_penalty[hyperparameter_idx],
+                        top_k=self.args.top_k[hyperparameter_idx],
+                        top_p=self.args.top_p[hyperparameter_idx],
+                        num_beams=self.args.num_beams[hyperparameter_idx],
+                        num_beam_groups=self.args.num_beam_groups[hyperparameter_idx],
+                        diversity_penalty=self.args.diversity_penalty[hyperparameter_idx],
+                        no_repeat_ngram_size=self.args.no_repeat_ngram_size[hyperparameter_idx],
+                        do_sample=self.args.temperature[hyperparameter_idx] != 0,  # if temperature==0, we do not sample
+                    )
+                step_features = self._generation_confidence.features() if collect_confidence else None
+                self._generation_confidence = None
                 partial_batch_prediction_ids = generated.sequences
                 partial_batch_words = None
 
@@ -301,9 +409,14 @@ class GenieModelForGeneration(GenieModel):
                     partial_batch_prediction = partial_batch_words
                 else:
                     if output_confidence_features or output_confidence_scores:
-                        partial_batch_confidence_features = self.confidence_features(
-                            batch=batch, predictions=partial_batch_prediction_ids, mc_dropout_num=self.args.mc_dropout_num
-                        )
+                        with self._time_stage('confidence_features'):
+                            partial_batch_confidence_features = self.confidence_features(
+                                batch=batch,
+                                predictions=partial_batch_prediction_ids,
+                                mc_dropout_num=self.args.mc_dropout_num,
+                                step_features=step_features,
+                                batch_mc_dropout=getattr(self.args, 'confidence_from_generation', False),
+                            )
                     partial_batch_prediction = self.numericalizer.reverse(partial_batch_prediction_ids, 'answer')
 
                 def get_example_index(i):
@@ -407,7 +520,8 @@ class GenieModelForGeneration(GenieModel):
         if output_confidence_scores:
             output.confidence_scores = []
             for estimator in confidence_estimators:
-                confidence_scores = estimator.estimate(confidence_features)
+                with self._time_stage('calibrator'):
+                    confidence_scores = estimator.estimate(confidence_features)
                 output.confidence_scores.append(confidence_scores)
         if translate_return_raw_outputs:
             output.raw_predictions = raw_predictions
@@ -34,6 +34,7 @@ import torch
 import torch.nn as nn
 from torch.jit import Final
 from torch.nn import functional as F
+from transformers import LogitsProcessor
 
 INF = 1e10
 EPSILON = 1e-10
@@ -252,3 +253,68 @@ class LabelSmoothingCrossEntropy(torch.nn.Module):
         loss = (1.0 - self.smoothing) * nll_loss + self.smoothing * smooth_loss
         loss.masked_fill_((target == ignore_index), 0)
         return loss
+
+
+class GenerationStreamer(LogitsProcessor):
+    """
+    Hooks into `generate()` as a logits processor that leaves the scores untouched, and passes the tokens decoded
+    so far to `callback` every `interval` decoding steps.
+    `reset()` must be called before each call to `generate()`; it also calls `on_reset`, if given, so that the caller
+    can forget the partial outputs of the previous call.
+    """
+
+    def __init__(self, callback, interval=1, on_reset=None):
+        self.callback = callback
+        self.interval = interval
+        self.on_reset = on_reset
+        self.step = 0
+
+    def reset(self):
+        self.step = 0
+        if self.on_reset is not None:
+            self.on_reset()
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        self.step += 1
+        if self.step % self.interval == 0:
+            self.callback(input_ids)
+        return scores
+
+
+class GenerationConfidence(LogitsProcessor):
+    """
+    Hooks into greedy `generate()` to record at each step the raw logit of the token that is chosen, its probability and
+    the entropy of the distribution. These are the no-dropout confidence features of the predictions, so they do not
+    need another forward pass.
+
+    The token is the highest-scoring one after the built-in logits processors (e.g. `min_length` or
+    `forced_bos_token_id`) have run, since custom logits processors run after them. The features are computed from the
+    logits of the model before any processor masks them, which `record_logits()` receives as a forward hook of the
+    model, so that they match those of a teacher-forced pass.
+    """
+
+    def __init__(self):
+        self.logits = []
+        self.probs = []
+        self.entropies = []
+        self._raw_logits = None
+
+    def record_logits(self, module, inputs, outputs):
+        # logits processors modify the scores in place, and the scores are a view of these logits
+        self._raw_logits = outputs.logits[:, -1, :].float().clone()
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        tokens = scores.argmax(dim=-1, keepdim=True)
+        log_probs = torch.log_softmax(self._raw_logits, dim=-1)
+        self.logits.append(self._raw_logits.gather(1, tokens).squeeze(1))
+        self.probs.append(log_probs.gather(1, tokens).squeeze(1).exp())
+        self.entropies.append(torch.special.entr(log_probs.exp()).sum(dim=-1))
+        return scores
+
+    def features(self):
+        """
+        Returns logits, probabilities and entropies, each of shape (batch_size, num_steps), or None if nothing was generated
+        """
+        if not self.logits:
+            return None
+        return torch.stack(self.logits, dim=1), torch.stack(self.probs, dim=1), torch.stack(self.entropies, dim=1)
@@ -30,9 +30,11 @@ import logging
 from typing import List
 
 import torch
-from transformers import AutoConfig, AutoModelForSeq2SeqLM, MBartTokenizer, MBartTokenizerFast
+from transformers import AutoConfig, AutoModelForSeq2SeqLM, LogitsProcessorList, MBartTokenizer, MBartTokenizerFast
+from transformers.modeling_outputs import Seq2SeqLMOutput
 
 from ..calibrate import ConfidenceFeatures
+from ..data_utils.example import pack_examples, packed_positions
 from ..data_utils.numericalizer import TransformerNumericalizer
 from ..model_utils.transformers_utils import MULTILINGUAL_TOKENIZERS
 from ..util import adjust_language_code
@@ -94,6 +96,11 @@ class TransformerSeq2Seq(GenieModelForGeneration):
 
         self.criterion = LabelSmoothingCrossEntropy(args.label_smoothing)
 
+        # only the training arguments have packing options
+        if getattr(args, 'pack_examples', False) and self.config.model_type not in ('t5', 'mt5'):
+            # other models add absolute position embeddings, and only accept one padding mask per row
+            raise ValueError('Packing examples is only supported for T5 and mT5 models')
+
     def add_new_vocab_from_data(self, tasks, resize_decoder=False):
         super().add_new_vocab_from_data(tasks, resize_decoder)
         self.model.resize_token_embeddings(self.numericalizer.num_tokens)
@@ -146,20 +153,23 @@ class TransformerSeq2Seq(GenieModelForGeneration):
             # longer sequences in the batch do not drown shorter sequences.
             # (3) if `args.dropper_ratio > 0.0`, will perform Loss Truncation
             # (4) if `args.label_smoothing > 0.0`, will add label smoothing term to loss
-            outputs = self.model(
-                batch.context.value,
-                labels=answer,
-                attention_mask=(batch.context.value != self.numericalizer.pad_id),
-                output_attentions=False,
-                output_hidden_states=False,
-                return_dict=True,
-            )
-            batch_size, vocab_size = outputs.logits.shape[0], outputs.logits.shape[2]
-            loss = self.criterion(
-                outputs.logits.view(-1, vocab_size), target=answer.view(-1), ignore_index=self.numericalizer.pad_id
-            )
-            loss = loss.view(batch_size, -1)  # (batch_size, sequence_length)
-            loss = loss.sum(dim=1) / answer_length  # accounts for the case where BOS is removed
+            if getattr(self.args, 'pack_examples', False):
+                outputs, loss = self._packed_forward(batch.context, answer, answer_length)
+            else:
+                outputs = self.model(
+                    batch.context.value,
+                    labels=answer,
+                    attention_mask=(batch.context.value != self.numericalizer.pad_id),
+                    output_attentions=False,
+                    output_hidden_states=False,
+                    return_dict=True,
+                )
+                batch_size, vocab_size = outputs.logits.shape[0], outputs.logits.shape[2]
+                loss = self.criterion(
+                    outputs.logits.view(-1, vocab_size), target=answer.view(-1), ignore_index=self.numericalizer.pad_id
+                )
+                loss = loss.view(batch_size, -1).sum(dim=1)  # (batch_size, )
+            loss = loss / answer_length  # accounts for the case where BOS is removed
             if self.dropper is not None:
                 dropper_mask = self.dropper(loss)
                 loss = loss * dropper_mask
@@ -169,6 +179,66 @@ class TransformerSeq2Seq(GenieModelForGeneration):
         else:
             return self.model(**kwargs)
 
+    def _packed_forward(self, context, answer, answer_length):
+        """
+        Runs the model on rows that each hold several examples back to back, instead of one padded example per row.
+        Attention masks keep the examples of a row from attending to each other, and since T5 only uses relative
+        positions, each example sees the same positions as it would on its own row.
+        Returns the model outputs for the packed rows, and the summed token loss of each example
+        """
+        pad_id = self.numericalizer.pad_id
+        device = context.value.device
+        context_lengths, answer_lengths = context.length.tolist(), answer_length.tolist()
+        rows = pack_examples(
+            context_lengths,
+            answer_lengths,
+            max([self.args.pack_max_length] + context_lengths),
+            max([self.args.pack_max_length] + answer_lengths),
+        )
+        context_positions, context_segments = packed_positions(rows, context_lengths, context.value.shape[1])
+        answer_positions, answer_segments = packed_positions(rows, answer_lengths, answer.shape[1])
+        context_positions, context_segments = context_positions.to(device), context_segments.to(device)
+        answer_positions, answer_segments = answer_positions.to(device), answer_segments.to(device)
+
+        input_ids = context.value.view(-1)[context_positions].masked_fill(context_segments == 0, pad_id)
+        labels = answer.view(-1)[answer_positions].masked_fill(answer_segments == 0, pad_id)
+        # shift each answer right by one token, and start it with the decoder start token
+        previous_segments = torch.cat([torch.zeros_like(answer_segments[:, :1]), answer_segments[:, :-1]], dim=1)
+        decoder_input_ids = (
+            answer.view(-1)[(answer_positions - 1).clamp(min=0)]
+            .masked_fill(answer_segments != previous_segments, self.model.config.decoder_start_token_id)
+            .masked_fill(answer_segments == 0, pad_id)
+        )
+
+        # (rows, query_length, key_length) masks that only let tokens attend to tokens of the same example
+        context_mask = (context_segments[:, :, None] == context_segments[:, None, :]) & (context_segments != 0)[:, None, :]
+        decoder_mask = (answer_segments[:, :, None] == answer_segments[:, None, :]) & (answer_segments != 0)[:, None, :]
+        decoder_mask &= torch.ones(decoder_mask.shape[1:], dtype=torch.bool, device=device).tril()
+        cross_mask = (answer_segments[:, :, None] == context_segments[:, None, :]) & (context_segments != 0)[:, None, :]
+
+        encoder_outputs = self.model.encoder(input_ids=input_ids, attention_mask=context_mask, return_dict=True)
+        decoder_outputs = self.model.decoder(
+            input_ids=decoder_input_ids,
+            attention_mask=decoder_mask,
+            encoder_hidden_states=encoder_outputs.last_hidden_state,
+            encoder_attention_mask=cross_mask,
+            use_cache=False,
+            return_dict=True,
+        )
+        sequence_output = decoder_outputs.last_hidden_state
+        if self.model.config.tie_word_embeddings:
+            # T5 rescales the decoder output before projecting it with the tied embeddings
+            sequence_output = sequence_output * (self.model.model_dim**-0.5)
+        logits = self.model.lm_head(sequence_output)
+
+        loss = self.criterion(logits.view(-1, logits.shape[2]), target=labels.view(-1), ignore_index=pad_id)
+        # pad tokens have zero loss and segment 0, which is dropped
+        loss = torch.zeros(len(context_lengths) + 1, dtype=loss.dtype, device=device).index_add(
+            0, answer_segments.view(-1), loss
+        )[1:]
+        outputs = Seq2SeqLMOutput(logits=logits, encoder_last_hidden_state=encoder_outputs.last_hidden_state)
+        return outputs, loss
+
     def generate(
         self,
         batch,
@@ -188,37 +258,58 @@ class TransformerSeq2Seq(GenieModelForGeneration):
 
         input_ids = batch.context.value
 
-        # when attention_mask is not provided to generate(), it will default to masking pad tokens, which is the correct thing
-        generated = self.model.generate(
-            input_ids=input_ids,
-            max_length=max_output_length,
-            min_length=min_output_length,
-            bos_token_id=self.numericalizer.init_id,
-            pad_token_id=self.numericalizer.pad_id,
-            early_stopping=False,
-            num_return_sequences=num_outputs,
-            repetition_penalty=repetition_penalty,
-            temperature=temperature,
-            eos_token_id=self.numericalizer.eos_id,
-            top_k=top_k,
-            top_p=top_p,
-            num_beams=num_beams,
-            num_beam_groups=num_beam_groups,
-            diversity_penalty=diversity_penalty,
-            no_repeat_ngram_size=no_repeat_ngram_size,
-            do_sample=do_sample,
-            output_scores=self._output_scores,
-            output_attentions=self._output_attentions,
-            output_hidden_states=self._output_hidden_states,
-            return_dict_in_generate=True,
-        )
+        logits_processor = LogitsProcessorList()
+        if self._generation_streamer is not None:
+            # with several sets of hyperparameters, generate() is called once per set, and each one streams from scratch
+            self._generation_streamer.reset()
+            logits_processor.append(self._generation_streamer)
+        confidence_hook = None
+        if self._generation_confidence is not None:
+            logits_processor.append(self._generation_confidence)
+            confidence_hook = self.model.register_forward_hook(self._generation_confidence.record_logits)
+
+        try:
+            # when attention_mask is not provided to generate(), it will default to masking pad tokens, which is the correct thing
+            generated = self.model.generate(
+                input_ids=input_ids,
+                max_length=max_output_length,
+                min_length=min_output_length,
+                bos_token_id=self.numericalizer.init_id,
+                pad_token_id=self.numericalizer.pad_id,
+                early_stopping=False,
+                num_return_sequences=num_outputs,
+                repetition_penalty=repetition_penalty,
+                temperature=temperature,
+                eos_token_id=self.numericalizer.eos_id,
+                top_k=top_k,
+                top_p=top_p,
+                num_beams=num_beams,
+                num_beam_groups=num_beam_groups,
+                diversity_penalty=diversity_penalty,
+                no_repeat_ngram_size=no_repeat_ngram_size,
+                do_sample=do_sample,
+                logits_processor=logits_processor,
+                output_scores=self._output_scores,
+                output_attentions=self._output_attentions,
+                output_hidden_states=self._output_hidden_states,
+                return_dict_in_generate=True,
+            )
+        finally:
+            if confidence_hook is not None:
+                confidence_hook.remove()
 
         return generated
 
-    def confidence_features(self, batch, predictions, mc_dropout_num=0) -> List[ConfidenceFeatures]:
+    def confidence_features(
+        self, batch, predictions, mc_dropout_num=0, step_features=None, batch_mc_dropout=False
+    ) -> List[ConfidenceFeatures]:
         """
         predictions: Tensor of shape (batch_size, output_length)
         mc_droput_num: number of Monte Carlo samples used for the MC Dropout method. 0 disables MC dropout.
+        step_features: (logits, probs, entropies) of the predicted tokens, collected by GenerationConfidence during greedy
+            generation. If provided, the no-dropout features are taken from them instead of a teacher-forced forward pass.
+        batch_mc_dropout: run all MC dropout samples as a single forward pass over copies of the batch, instead of one
+            pass per sample. Faster, but uses `mc_dropout_num` times more memory.
         """
         batch_size = predictions.shape[0]
         repetition_factor = batch_size // batch.context.value.shape[0]
@@ -243,47 +334,72 @@ class TransformerSeq2Seq(GenieModelForGeneration):
         # batch_nodrop_top1_idx = []
         # batch_nodrop_top2_probs = []
         # batch_nodrop_top2_idx = []
-        outputs = self.model(
-            input_ids=input_ids,
-            decoder_input_ids=predictions,
-            attention_mask=attention_mask,
-            return_dict=True,
-            use_cache=False,
-        )
-        nodrop_logits = outputs.logits[:, :-1, :]  # remove the last probability distribution which is for the token after EOS
-        for i in range(batch_size):
-            batch_nodrop_logits.append(
-                nodrop_logits[i].gather(dim=1, index=truncated_predictions[i].view(-1, 1)).view(-1)[: prediction_lengths[i]]
-            )
-            probs = torch.softmax(nodrop_logits[i], dim=1)
-            batch_nodrop_probs.append(
-                probs.gather(dim=1, index=truncated_predictions[i].view(-1, 1)).view(-1)[: prediction_lengths[i]]
+        if step_features is not None:
+            step_logits, step_probs, step_entropies = step_features
+            for i in range(batch_size):
+                batch_nodrop_logits.append(step_logits[i][: prediction_lengths[i]])
+                batch_nodrop_probs.append(step_probs[i][: prediction_lengths[i]])
+                batch_nodrop_entropies.append(step_entropies[i][: prediction_lengths[i]])
+        else:
+            outputs = self.model(
+                input_ids=input_ids,
+                decoder_input_ids=predictions,
+                attention_mask=attention_mask,
+                return_dict=True,
+                use_cache=False,
             )
-            batch_nodrop_entropies.append(-torch.sum(torch.log(probs) * probs, dim=1)[: prediction_lengths[i]])
-            # sorted_probs = probs.sort(dim=1)
-            # batch_nodrop_top1_probs.append(sorted_probs.values[:, -1][:prediction_lengths[i]])
-            # batch_nodrop_top2_probs.append(sorted_probs.values[:, -2][:prediction_lengths[i]])
-            # batch_nodrop_top1_idx.append(sorted_probs.indices[:, -1][:prediction_lengths[i]])
-            # batch_nodrop_top2_idx.append(sorted_probs.indices[:, -2][:prediction_lengths[i]])
+            # remove the last probability distribution which is for the token after EOS
+            nodrop_logits = outputs.logits[:, :-1, :]
+            for i in range(batch_size):
+                batch_nodrop_logits.append(
+                    nodrop_logits[i]
+                    .gather(dim=1, index=truncated_predictions[i].view(-1, 1))
+                    .view(-1)[: prediction_lengths[i]]
+                )
+                probs = torch.softmax(nodrop_logits[i], dim=1)
+                batch_nodrop_probs.append(
+                    probs.gather(dim=1, index=truncated_predictions[i].view(-1, 1)).view(-1)[: prediction_lengths[i]]
+                )
+                batch_nodrop_entropies.append(-torch.sum(torch.log(probs) * probs, dim=1)[: prediction_lengths[i]])
+                # sorted_probs = probs.sort(dim=1)
+                # batch_nodrop_top1_probs.append(sorted_probs.values[:, -1][:prediction_lengths[i]])
+                # batch_nodrop_top2_probs.append(sorted_probs.values[:, -2][:prediction_lengths[i]])
+                # batch_nodrop_top1_idx.append(sorted_probs.indices[:, -1][:prediction_lengths[i]])
+                # batch_nodrop_top2_idx.append(sorted_probs.indices[:, -2][:prediction_lengths[i]])
 
         # activate dropout layers
         self.train()
 
+        def mc_dropout_logits():
+            """
+            Yields the logits of each MC dropout sample, without the last distribution which is for the token after EOS
+            """
+            if batch_mc_dropout and mc_dropout_num > 1:
+                # dropout masks are drawn independently for each row, so each copy of the batch is an independent sample
+                outputs = self.model(
+                    input_ids=input_ids.repeat(mc_dropout_num, 1),
+                    decoder_input_ids=predictions.repeat(mc_dropout_num, 1),
+                    attention_mask=attention_mask.repeat(mc_dropout_num, 1),
+                    return_dict=True,
+                    use_cache=False,
+                )
+                yield from outputs.logits[:, :-1, :].split(batch_size, dim=0)
+                return
+            for _ in range(mc_dropout_num):
+                outputs = self.model(
+                    input_ids=input_ids,
+                    decoder_input_ids=predictions,
+                    attention_mask=attention_mask,
+                    return_dict=True,
+                    use_cache=False,
+                )
+                yield outputs.logits[:, :-1, :]
+
         batch_drop_logits = [[] for _ in range(batch_size)]
         batch_drop_probs = [[] for _ in range(batch_size)]
         # batch_drop_top1_probs = [[] for _ in range(batch_size)]
         # batch_drop_top2_probs = [[] for _ in range(batch_size)]
-        for _ in range(mc_dropout_num):
-            outputs = self.model(
-                input_ids=input_ids,
-                decoder_input_ids=predictions,
-                attention_mask=attention_mask,
-                return_dict=True,
-                use_cache=False,
-            )
-            drop_logits = outputs.logits[
-                :, :-1, :
-            ]  # remove the last probability distribution which is for the token after EOS
+        for drop_logits in mc_dropout_logits():
             for i in range(batch_size):
                 batch_drop_logits[i].append(
                     (drop_logits[i].gather(dim=1, index=truncated_predictions[i].view(-1, 1)).view(-1))[
@@ -28,6 +28,7 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 import logging
 import os
+from collections import OrderedDict
 
 import torch
 import ujson
@@ -295,19 +296,60 @@ class ServingBootlegEntityDisambiguator(BatchBootlegEntityDisambiguator):
         # collect all outputs now; we will filter later
         self.annotator.set_threshold(0.0)
 
-    def process_examples(self, examples, split_path, utterance_field):
-        with torch.no_grad():
-            bootleg_inputs = []
-            for ex in examples:
-                bootleg_inputs.append(getattr(ex, utterance_field))
+        # bootleg's output for recently seen sentences, and the features of recently seen (alias, candidates) pairs
+        self.cache_size = getattr(args, 'ned_cache_size', 10000)
+        self._label_cache = OrderedDict()
+        self._alias_cache = OrderedDict()
+
+    def _cache_get(self, cache, key):
+        value = cache.get(key)
+        if value is not None:
+            cache.move_to_end(key)
+        return value
 
-            bootleg_labels = self.annotator.label_mentions(bootleg_inputs)
+    def _cache_put(self, cache, key, value):
+        if self.cache_size <= 0:
+            return
+        cache[key] = value
+        if len(cache) > self.cache_size:
+            cache.popitem(last=False)
+
+    def collect_features_per_alias(self, alias, all_probs, all_qids):
+        key = (alias, tuple(all_probs), tuple(all_qids))
+        features = self._cache_get(self._alias_cache, key)
+        if features is None:
+            features = tuple(tuple(f) for f in super().collect_features_per_alias(alias, all_probs, all_qids))
+            self._cache_put(self._alias_cache, key, features)
+        # callers pad the returned lists in place
+        return tuple(list(f) for f in features)
+
+    def label_mentions(self, sentences):
+        """
+        Returns bootleg's labels for each sentence, only running the annotator on the sentences that are not cached.
+        Bootleg disambiguates mentions using the whole sentence, so results are cached per sentence.
+        """
+        labels = [self._cache_get(self._label_cache, sentence) for sentence in sentences]
+        missing = list(OrderedDict.fromkeys(sentence for sentence, label in zip(sentences, labels) if label is None))
+        if missing:
+            bootleg_labels = self.annotator.label_mentions(missing)
 
             keys = tuple(bootleg_labels.keys())
             values = list(bootleg_labels.values())
             values_unpacked = list(zip(*values))
 
-            bootleg_labels_unpacked = [dict(zip(keys, values)) for values in values_unpacked]
+            new_labels = dict(zip(missing, [dict(zip(keys, values)) for values in values_unpacked]))
+            for sentence, label in new_labels.items():
+                self._cache_put(self._label_cache, sentence, label)
+            labels = [label if label is not None else new_labels[sentence] for sentence, label in zip(sentences, labels)]
+        return labels
+
+    def process_examples(self, examples, split_path, utterance_field):
+        with torch.no_grad():
+            bootleg_inputs = []
+            for ex in examples:
+                bootleg_inputs.append(getattr(ex, utterance_field))
+
+            bootleg_labels_unpacked = self.label_mentions(bootleg_inputs)
 
             all_token_type_ids, all_token_type_probs, all_token_qids = [], [], []
             for ex, label in zip(examples, bootleg_labels_unpacked):
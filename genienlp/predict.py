@@ -43,6 +43,7 @@ from . import models
 from .arguments import check_and_update_generation_args
 from .calibrate import ConfidenceEstimator
 from .metrics import calculate_and_reduce_metrics
+from .models.base import QUANTIZATION_MODES
 from .ned.ned_utils import init_ned_model
 from .tasks.registry import get_tasks
 from .util import (
@@ -102,6 +103,11 @@ def parse_argv(parser):
     )
     parser.add_argument('--seed', default=123, type=int, help='Random seed.')
     parser.add_argument('--data', default='.data/', type=str, help='where to load data from.')
+    parser.add_argument(
+        '--cache_batch_plans',
+        action='store_true',
+        help='save how examples are split into batches in --data/batch_plans, and reuse it in later runs on the same data',
+    )
     parser.add_argument('--embeddings', default='.embeddings/', type=str, help='where to save embeddings.')
     parser.add_argument(
         '--checkpoint_name', default='best.pth', help='Checkpoint file to use (relative to --path, defaults to best.pth)'
@@ -141,6 +147,12 @@ def parse_argv(parser):
         type=int,
         help='Batch size for validation corresponding to tasks in val tasks',
     )
+    parser.add_argument(
+        '--data_loader_workers',
+        type=int,
+        default=0,
+        help='number of worker processes that prepare batches during prediction. 0 prepares them in the main process',
+    )
     parser.add_argument(
         "--reduce_metrics",
         type=str,
@@ -203,6 +215,12 @@ def parse_argv(parser):
         default=0,
         help='Number of samples to use for Monte Carlo (MC) dropout. 0 disables MC dropout.',
     )
+    parser.add_argument(
+        '--confidence_from_generation',
+        action='store_true',
+        help='With greedy decoding, collect confidence features while generating instead of with another forward pass, '
+        'and run MC dropout samples as one batch. Calibrators should be trained on features computed the same way.',
+    )
     parser.add_argument(
         "--override_confidence_labels",
         type=str,
@@ -220,6 +238,13 @@ def parse_argv(parser):
         help='If True, will use mixed precision for prediction.'
         'This reduces memory consumption and is especially faster on GPUs like NVIDIA V100 and T4. May slightly change the generated output.',
     )
+    parser.add_argument(
+        '--quantize',
+        default='none',
+        choices=QUANTIZATION_MODES,
+        help='run the model in reduced precision: dynamic-int8 quantizes the weights of linear layers to int8 (CPU only), '
+        'fp16 and bf16 convert all weights. Use `genienlp check-quantization` to measure the effect on accuracy',
+    )
     parser.add_argument(
         '--one_output_per_line',
         action='store_true',
@@ -423,9 +448,19 @@ def prepare_data_iterators(args, val_sets, numericalizer, device):
     if len(args.val_batch_size) == 1 and len(val_sets) > 1:
         args.val_batch_size *= len(val_sets)
     iters = []
+    batch_plan_dir = os.path.join(args.data, 'batch_plans') if args.cache_batch_plans else None
     for task, bs, val_set in zip(args.tasks, args.val_batch_size, val_sets):
         task_iter = []
-        loader, original_order = make_data_loader(val_set, numericalizer, bs, device, train=False, return_original_order=True)
+        loader, original_order = make_data_loader(
+            val_set,
+            numericalizer,
+            bs,
+            device,
+            train=False,
+            return_original_order=True,
+            batch_plan_dir=batch_plan_dir,
+            num_workers=args.data_loader_workers,
+        )
         task_iter.append((task, loader, original_order))
 
         iters.extend(task_iter)
@@ -489,6 +524,7 @@ def run(args, device):
             src_lang=args.pred_src_languages[0],
             tgt_lang=args.pred_tgt_languages[0],
         )
+        model.quantize(args.quantize, device)
     else:
         # TODO handle multiple languages
         model, _ = model_class.load(
@@ -511,6 +547,7 @@ def run(args, device):
 
     model.eval()
     task_scores = defaultdict(list)
+    all_metrics = dict()
 
     eval_dir = os.path.join(args.eval_dir, args.evaluate)
     os.makedirs(eval_dir, exist_ok=True)
@@ -589,6 +626,7 @@ def run(args, device):
             logger.info(metrics)
 
             task_scores[task].append((len(validation_output.answers), metrics[task.metrics[0]]))
+            all_metrics[task.name] = metrics
 
     decaScore = []
     for task in task_scores.keys():
@@ -603,6 +641,8 @@ def run(args, device):
     logger.info(f'DecaScore:  {sum(decaScore)}\n')
     logger.info(f'\nSummary: | {sum(decaScore)} | {" | ".join([str(x) for x in decaScore])} |\n')
 
+    return all_metrics
+
 
 def update_metrics(args):
     assert len(args.override_valid_metrics) == len(args.tasks)
@@ -620,12 +660,7 @@ def update_metrics(args):
         task.metrics = new_metrics
 
 
-def main(args):
-    try:
-        set_start_method('spawn')
-    except RuntimeError:
-        pass
-
+def prepare_args(args):
     load_config_file_to_args(args)
     check_and_update_generation_args(args)
     check_args(args)
@@ -636,6 +671,15 @@ def main(args):
     if args.override_valid_metrics:
         update_metrics(args)
 
+
+def main(args):
+    try:
+        set_start_method('spawn')
+    except RuntimeError:
+        pass
+
+    prepare_args(args)
+
     logger.info(f'Arguments:\n{pformat(vars(args))}')
     logger.info(f'Loading from {args.best_checkpoint}')
     devices = get_devices(args.devices)
@@ -0,0 +1,254 @@
+#
+# Copyright (c) 2022, The Board of Trustees of the Leland Stanford Junior University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import asyncio
+import json
+import logging
+import math
+import time
+
+from .server_utils.protocol import JsonLinesFraming
+from .server_utils.tracing import read_trace
+
+logger = logging.getLogger(__name__)
+
+
+def parse_argv(parser):
+    parser.add_argument('--trace_file', type=str, required=True, help='trace written by `genienlp server --trace_file`')
+    parser.add_argument('--host', default='localhost', type=str, help='host of the server to replay the trace against')
+    parser.add_argument('--port', default=8401, type=int, help='TCP port of the server')
+    parser.add_argument(
+        '--speed',
+        default=1.0,
+        type=float,
+        help='send requests this many times faster than they were recorded. 0 sends all of them as fast as possible',
+    )
+    parser.add_argument('--connections', default=4, type=int, help='number of pipelined connections to spread requests over')
+    parser.add_argument(
+        '--max_requests', default=0, type=int, help='only replay this many requests from the start of the trace. 0 replays all'
+    )
+    parser.add_argument('--output', default=None, type=str, help='also write the report to this JSON file')
+
+
+def make_request(record, index):
+    """
+    The request of a trace record, with a fresh id. Records without a payload get synthetic instances of the recorded
+    lengths, which exercise the server the same way up to tokenization.
+    """
+    if 'request' in record:
+        request = dict(record['request'])
+    else:
+        request = {
+            'task': record['task'],
+            'options': record['options'],
+            'instances': [
+                {
+                    'example_id': str(i),
+                    'context': ' '.join(['replay'] * context_length),
+                    'question': ' '.join(['replay'] * question_length),
+                }
+                for i, (context_length, question_length) in enumerate(record['instance_lengths'])
+            ],
+        }
+        for key in ('model', 'stream', 'timeout_ms'):
+            if record.get(key) is not None:
+                request[key] = record[key]
+    # a cached answer would not say anything about the server's speed
+    request['cache'] = False
+    request['id'] = f'replay-{index}'
+    return request
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    return sorted_values[max(math.ceil(p / 100 * len(sorted_values)) - 1, 0)]
+
+
+class ReplayConnection(object):
+    """
+    A pipelined connection to the server. Responses can arrive out of order, and are matched to requests by id.
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.framing = JsonLinesFraming()
+        self._waiting = dict()
+        self._first_partial = dict()
+        self._task = None
+        # set when responses cannot be read anymore
+        self._error = None
+
+    @classmethod
+    async def open(cls, host, port):
+        reader, writer = await asyncio.open_connection(host, port)
+        writer.write(JsonLinesFraming().encode({'protocol': 'json', 'pipeline': True}))
+        acknowledgement = json.loads(await reader.readline())
+        if 'error' in acknowledgement:
+            raise ValueError(f'The server does not support pipelining: {acknowledgement["error"]}')
+        connection = cls(reader, writer)
+        connection._task = asyncio.ensure_future(connection._read_responses())
+        return connection
+
+    async def _read_responses(self):
+        loop = asyncio.get_event_loop()
+        error = ConnectionError('The server closed the connection')
+        try:
+            while True:
+                data = await self.framing.read(self.reader)
+                if data is None:
+                    break
+                response = self.framing.decode(data)
+                if response.get('id') is None:
+                    # an error that is not about a specific request, e.g. a protocol error, after which the server closes
+                    # the connection
+                    error = ConnectionError(f'The server failed the connection: {response.get("error")}')
+                    break
+                if response.get('partial', False):
+                    self._first_partial.setdefault(response['id'], loop.time())
+                    continue
+                future = self._waiting.pop(response['id'], None)
+                if future is not None:
+                    future.set_result((response, loop.time(), self._first_partial.pop(response['id'], None)))
+        except Exception as e:
+            error = ConnectionError(f'Could not read the responses of the server: {e}')
+        finally:
+            # no more responses will be read, so nothing that is waiting for one may wait forever
+            self._error = error
+            for future in self._waiting.values():
+                if not future.done():
+                    future.set_exception(error)
+            self._waiting.clear()
+
+    async def send(self, request):
+        """
+        Returns the response, the time it arrived and the time the first partial response arrived (or None)
+        """
+        if self._error is not None:
+            raise self._error
+        future = asyncio.get_event_loop().create_future()
+        self._waiting[request['id']] = future
+        self.writer.write(self.framing.encode(request))
+        return await future
+
+    async def close(self):
+        self.writer.close()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+
+async def replay(records, args):
+    loop = asyncio.get_event_loop()
+    connections = [await ReplayConnection.open(args.host, args.port) for _ in range(args.connections)]
+    results = []
+
+    async def send(index, request, connection):
+        sent = loop.time()
+        try:
+            response, received, first_partial = await connection.send(request)
+        except ConnectionError as e:
+            results.append({'status': 'connection_error', 'error': str(e)})
+            return
+        results.append(
+            {
+                'status': response.get('code', 'ok'),
+                'latency': received - sent,
+                'first_partial_latency': first_partial - sent if first_partial is not None else None,
+                'instances': len(request['instances']) if 'instances' in request else 1,
+                'recorded_latency': records[index]['latency'],
+            }
+        )
+
+    first_time = records[0]['time']
+    start = loop.time()
+    tasks = []
+    for index, record in enumerate(records):
+        if args.speed > 0:
+            delay = start + (record['time'] - first_time) / args.speed - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        request = make_request(record, index)
+        tasks.append(asyncio.ensure_future(send(index, request, connections[index % len(connections)])))
+    await asyncio.gather(*tasks)
+    elapsed = loop.time() - start
+
+    for connection in connections:
+        await connection.close()
+    return results, elapsed
+
+
+def make_report(results, elapsed):
+    statuses = dict()
+    for result in results:
+        statuses[result['status']] = statuses.get(result['status'], 0) + 1
+    answered = [result for result in results if result['status'] == 'ok']
+
+    report = {
+        'requests': len(results),
+        'statuses': statuses,
+        'seconds': elapsed,
+        'requests_per_second': len(answered) / elapsed if elapsed > 0 else None,
+        'instances_per_second': sum(result['instances'] for result in answered) / elapsed if elapsed > 0 else None,
+    }
+    for name in ('latency', 'first_partial_latency', 'recorded_latency'):
+        values = sorted(result[name] for result in answered if result[name] is not None)
+        if values:
+            report[name] = {f'p{p}': percentile(values, p) for p in (50, 90, 99)}
+            report[name]['max'] = values[-1]
+    return report
+
+
+def main(args):
+    records = sorted(read_trace(args.trace_file), key=lambda record: record['time'])
+    if args.max_requests > 0:
+        records = records[: args.max_requests]
+    if not records:
+        raise ValueError(f'{args.trace_file} does not contain any request')
+    logger.info(f'Replaying {len(records)} requests at {"maximum" if args.speed <= 0 else f"{args.speed}x"} speed')
+
+    start = time.time()
+    results, elapsed = asyncio.get_event_loop().run_until_complete(replay(records, args))
+    report = make_report(results, elapsed)
+    report['started'] = start
+
+    logger.info(f'Answered {report["statuses"].get("ok", 0)} of {len(results)} requests in {elapsed:.1f} seconds')
+    if report['requests_per_second'] is not None:
+        logger.info(
+            f'Throughput: {report["requests_per_second"]:.2f} requests/s, {report["instances_per_second"]:.2f} instances/s'
+        )
+    for name in ('latency', 'first_partial_latency', 'recorded_latency'):
+        if name in report:
+            logger.info(f'{name}: ' + ', '.join(f'{key} {value * 1000:.1f} ms' for key, value in report[name].items()))
+    if args.output is not None:
+        with open(args.output, 'w') as fout:
+            json.dump(report, fout, indent=2)
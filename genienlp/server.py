@@ -29,21 +29,39 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 
+import argparse
 import asyncio
 import copy
+import ipaddress
 import json
 import logging
 import os
+import signal
 import sys
+import time
+import unicodedata
+from collections import OrderedDict
+from functools import partial
 from pprint import pformat
+from typing import NamedTuple, Optional, Tuple
 
 import torch
 
 from . import models
-from .arguments import check_and_update_generation_args
+from .arguments import GENERATION_HYPERPARAMETERS, check_and_update_generation_args
 from .calibrate import ConfidenceEstimator
 from .data_utils.example import Example, NumericalizedExamples
+from .models.base import QUANTIZATION_MODES
+from .models.common import GenerationStreamer
 from .ned.ned_utils import init_ned_model
+from .server_utils.batching import RequestBatcher, RequestRejected, batch_key, round_up_to_bucket
+from .server_utils.cache import ResponseCache
+from .server_utils.metrics import ServerMetrics
+from .server_utils.ned_batching import NEDBatcher
+from .server_utils.protocol import JsonLinesFraming, negotiate
+from .server_utils.registry import ModelRegistry
+from .server_utils.replicas import DeviceFailure, ModelReplica, ReplicaPool, partition_cpu_cores
+from .server_utils.tracing import RequestTrace, RequestTracer
 from .tasks.registry import get_tasks
 from .util import adjust_language_code, get_devices, load_config_file_to_args, log_model_size, set_seed
 
@@ -70,12 +88,75 @@ GENERATION_ARGUMENTS = {
     'translate_only_entities',
 }
 
+# number of distinct (task, generation options) combinations whose request contexts are kept, least recently used first
+MAX_REQUEST_CONTEXTS = 256
+
+
+def is_local_peer(peername) -> bool:
+    """
+    Whether `peername`, the address of the other end of a TCP connection, is on this host
+    """
+    if not peername:
+        return False
+    address = ipaddress.ip_address(peername[0])
+    # IPv4 clients of a dual-stack socket have addresses like ::ffff:127.0.0.1
+    if getattr(address, 'ipv4_mapped', None) is not None:
+        address = address.ipv4_mapped
+    return address.is_loopback
+
 
 def parse_argv(parser):
     parser.add_argument('--path', type=str, required=True)
     parser.add_argument(
         '--devices', default=[0], nargs='+', type=int, help='a list of devices that can be used (multi-gpu currently WIP)'
     )
+    parser.add_argument(
+        '--workers',
+        default=1,
+        type=int,
+        help='number of model replicas to serve requests with. Replicas are spread over all visible GPUs, or over '
+        'disjoint groups of CPU cores on CPU-only hosts',
+    )
+    parser.add_argument(
+        '--cpu_profile',
+        action='store_true',
+        help='tune for CPU-only hosts: pin each replica to its own cores (even with a single worker), with one intra-op '
+        'thread per core and a single inter-op thread',
+    )
+    parser.add_argument(
+        '--intra_op_threads',
+        default=0,
+        type=int,
+        help='number of threads each replica uses inside an operator. 0 means one per core of the replica when replicas '
+        'are pinned, and the PyTorch default otherwise',
+    )
+    parser.add_argument(
+        '--inter_op_threads',
+        default=0,
+        type=int,
+        help='number of threads used to run independent operators in parallel. 0 means 1 with --cpu_profile, and the '
+        'PyTorch default otherwise',
+    )
+    parser.add_argument(
+        '--quantize',
+        default='none',
+        choices=QUANTIZATION_MODES,
+        help='run the model in reduced precision: dynamic-int8 quantizes the weights of linear layers to int8 (CPU only), '
+        'fp16 and bf16 convert all weights. Use `genienlp check-quantization` to measure the effect on accuracy',
+    )
+    parser.add_argument(
+        '--mapped_weights_dir',
+        default=None,
+        type=str,
+        help='on CPU, keep the model weights in a flat file in this directory and map it into memory, so that all server '
+        'processes on the host share one copy of the weights. The file is written by the first process that needs it',
+    )
+    parser.add_argument(
+        '--ned_cache_size',
+        default=10000,
+        type=int,
+        help='number of sentences (and of entity aliases) whose NED results are cached. 0 disables the caches',
+    )
     parser.add_argument('--seed', default=123, type=int, help='Random seed.')
     parser.add_argument('--embeddings', default='.embeddings', type=str, help='where to save embeddings.')
     parser.add_argument(
@@ -83,10 +164,143 @@ def parse_argv(parser):
     )
     parser.add_argument('--port', default=8401, type=int, help='TCP port to listen on')
     parser.add_argument('--stdin', action='store_true', help='Interact on stdin/stdout instead of TCP')
+    parser.add_argument(
+        '--drain_timeout',
+        default=30,
+        type=float,
+        help='on SIGTERM or SIGINT, seconds to wait for requests in flight to be answered before shutting down. Also how '
+        'long a replaced or unloaded model gets to answer its requests before it is released',
+    )
     parser.add_argument('--database_dir', type=str, help='Database folder containing all relevant files')
     parser.add_argument('--src_locale', help='locale tag of the input language to parse')
     parser.add_argument('--tgt_locale', help='locale tag of the target language to generate')
     parser.add_argument('--inference_name', default='nlp', help='name used by kfserving inference service, alphanumeric only')
+    parser.add_argument(
+        '--models',
+        default=[],
+        nargs='*',
+        type=str,
+        help='additional models to host, as NAME=PATH. Requests choose a model with their `model` field; '
+        'the model in --path is named after --inference_name and is used by default',
+    )
+    parser.add_argument(
+        '--model_memory_budget',
+        default=0,
+        type=float,
+        help='in GB. When the parameters of hosted models take more than this, the least recently used additional models '
+        'are unloaded. 0 means no limit',
+    )
+    parser.add_argument(
+        '--allow_control_requests',
+        action='store_true',
+        help='accept control requests, which load models from any path on this host and unload hosted models, from '
+        'clients on localhost. They are rejected otherwise',
+    )
+
+    # batching of concurrent requests
+    parser.add_argument(
+        '--batch_wait_ms',
+        default=5,
+        type=float,
+        help='how long (in milliseconds) to wait for more requests to arrive before running a batch in TCP mode',
+    )
+    parser.add_argument(
+        '--batch_max_tokens',
+        default=4000,
+        type=int,
+        help='run a batch as soon as it contains this many input tokens (approximated by counting words). '
+        'Larger requests are split into several batches',
+    )
+    parser.add_argument(
+        '--max_pending_tokens',
+        default=0,
+        type=int,
+        help='reject new requests when this many input tokens are already queued or running. 0 means no limit',
+    )
+
+    parser.add_argument(
+        '--length_buckets',
+        default=[],
+        type=int,
+        nargs='*',
+        help='pad model inputs to the smallest of these lengths (in tokens) that fits, and batch together requests that '
+        'fall in the same bucket, so that the model sees few distinct input shapes. Requests are grouped before they are '
+        'tokenized, by their number of words, which underestimates the number of subword tokens; a batch is still padded '
+        'to the bucket of its longest tokenized input. Disabled by default',
+    )
+
+    # response cache
+    parser.add_argument(
+        '--cache_size',
+        default=0,
+        type=int,
+        help='number of instances whose responses are cached, keyed on task, example id, input and generation options. '
+        '0 disables caching',
+    )
+    parser.add_argument(
+        '--cache_max_bytes', default=64 * 1024 * 1024, type=int, help='maximum total size of cached responses in bytes'
+    )
+    parser.add_argument(
+        '--cache_ttl', default=0, type=float, help='seconds after which a cached response expires. 0 means never'
+    )
+
+    parser.add_argument(
+        '--stream_interval',
+        default=1,
+        type=int,
+        help='for requests with "stream": true, send a partial response every this many decoding steps',
+    )
+
+    # warm-up
+    parser.add_argument(
+        '--warmup_lengths',
+        default=[],
+        type=int,
+        nargs='*',
+        help='before serving, run synthetic requests whose input has each of these numbers of words, so that the first real '
+        'requests do not pay for cold caches and kernels. No warm-up by default',
+    )
+    parser.add_argument(
+        '--warmup_batch_sizes', default=[1], type=int, nargs='+', help='number of instances in each warm-up request'
+    )
+    parser.add_argument(
+        '--warmup_options',
+        default=[{}],
+        type=json.loads,
+        nargs='+',
+        help='generation options of warm-up requests, as JSON objects (e.g. \'{"num_beams": 4}\'). Each one is warmed up',
+    )
+    parser.add_argument('--warmup_task', default='generic', type=str, help='task of warm-up requests')
+
+    parser.add_argument(
+        '--metrics_port',
+        default=0,
+        type=int,
+        help='serve Prometheus metrics on http://localhost:<metrics_port>/metrics. 0 disables the metrics endpoint',
+    )
+    parser.add_argument(
+        '--metrics_host',
+        default='localhost',
+        type=str,
+        help='interface the metrics endpoint listens on. Use 0.0.0.0 to let a Prometheus server on another host scrape it',
+    )
+
+    parser.add_argument(
+        '--trace_file',
+        default=None,
+        type=str,
+        help='write a sample of the requests, with their lengths and per-stage timings, to this file for `genienlp replay`',
+    )
+    parser.add_argument('--trace_sample_rate', default=0.01, type=float, help='fraction of the requests that are traced')
+    parser.add_argument(
+        '--trace_max_bytes', default=100 * 1024 * 1024, type=int, help='size at which the trace file is rotated'
+    )
+    parser.add_argument('--trace_backups', default=5, type=int, help='number of rotated trace files to keep')
+    parser.add_argument(
+        '--trace_payloads',
+        action='store_true',
+        help='also write the content of traced requests. Otherwise, replay sends synthetic inputs of the same lengths',
+    )
 
     # These are generation hyperparameters. Each one can be a list of values in which case, we generate `num_outputs` outputs for each set of hyperparameters.
     parser.add_argument("--num_outputs", type=int, nargs='+', default=[1], help='number of sequences to output per input')
@@ -127,10 +341,29 @@ def parse_argv(parser):
         default=None,
         help='If provided, will be used to output confidence scores for each prediction. Defaults to `--path`/calibrator.pkl',
     )
+    parser.add_argument(
+        '--confidence_from_generation',
+        action='store_true',
+        help='With greedy decoding, collect confidence features while generating instead of with another forward pass, '
+        'and run MC dropout samples as one batch. Calibrators should be trained on features computed the same way.',
+    )
+
+
+class RequestContext(NamedTuple):
+    """
+    Everything that a request needs and that only depends on its task and generation options.
+    Built once per (task, options) and reused by later requests with the same task and options, as long as it is one of
+    the MAX_REQUEST_CONTEXTS most recently used.
+    """
+
+    task: object
+    args: argparse.Namespace
+    # (src_locale, tgt_locale) adjusted to what the model expects, or None if the arguments do not specify them
+    locales: Optional[Tuple[str, str]]
 
 
 class Server(object):
-    def __init__(self, args, model, device, confidence_estimators, estimator_filenames, ned_model):
+    def __init__(self, args, model, device, confidence_estimators, estimator_filenames, ned_model, metrics=None, tracer=None):
         self.args = args
         self.device = device
         self.numericalizer = model.numericalizer
@@ -139,42 +372,271 @@ class Server(object):
         self.estimator_filenames = estimator_filenames
         self.ned_model = ned_model
 
+        self._reset_replica_state()
+
+        self.cache = None
+        if self.args.cache_size > 0:
+            self.cache = ResponseCache(self.args.cache_size, self.args.cache_max_bytes, self.args.cache_ttl)
+        checkpoint_path = os.path.join(self.args.path, self.args.checkpoint_name)
+        checkpoint_mtime = os.path.getmtime(checkpoint_path) if os.path.exists(checkpoint_path) else 0
+        self.checkpoint_id = f'{checkpoint_path}@{checkpoint_mtime}'
+
+        # id(request) -> function that sends partial answers of a streaming request to its client
+        self._stream_callbacks = dict()
+
+        # shared by all replicas, and by all models hosted in the same process
+        owns_metrics = metrics is None
+        self.metrics = ServerMetrics() if owns_metrics else metrics
+
+        self.tracer = tracer
+        if self.tracer is None and self.args.trace_file:
+            self.tracer = RequestTracer(
+                self.args.trace_file,
+                self.args.trace_sample_rate,
+                self.args.trace_max_bytes,
+                self.args.trace_backups,
+                self.args.trace_payloads,
+            )
+
+        # NED models are not thread-safe; replicas share one, and their concurrent batches go through it together
+        self.ned_batcher = None
+        if self.ned_model:
+            self.ned_batcher = NEDBatcher(self.ned_model, on_batch=self.metrics.ned_batch_size.observe)
+
+        # set by enable_model_registry() on the server that listens for requests
+        self.registry = None
+
+        # shutdown state of the server that listens for requests
+        self._stop_event = None
+        self._draining = False
+        self._active_requests = 0
+        self._client_writers = set()
+        # exit status of the process once the server stops, if not 0
+        self._exit_code = None
+        # whether batches were still running on replica threads when the server stopped
+        self._abandoned_batches = False
+
+        # in TCP mode, each model replica runs on its own thread so that the event loop is never blocked by generation
+        self.replicas = ReplicaPool(self._make_replicas(self.args.workers), on_device_failure=self._on_device_failure)
+        self.batcher = RequestBatcher(
+            self.replicas.submit,
+            max_wait_ms=self.args.batch_wait_ms,
+            max_tokens=self.args.batch_max_tokens,
+            max_concurrency=len(self.replicas),
+            max_pending_tokens=self.args.max_pending_tokens,
+            length_buckets=self.args.length_buckets,
+            merges_instances=self._merges_instances,
+        )
+        if owns_metrics:
+            self.metrics.queue_depth.fn = lambda: sum(server.batcher._queue.qsize() for server in self._hosted_servers())
+            self.metrics.pending_tokens.fn = lambda: sum(server.batcher.pending_tokens for server in self._hosted_servers())
+        # set after the replicas are created, since models are deep-copied
+        for replica in self.replicas.replicas:
+            replica.server.model.set_stage_timer(self.metrics.time_stage)
+
+    def _make_replicas(self, num_workers):
+        pin_cpu_cores = self.args.cpu_profile and self.device.type == 'cpu'
+        if num_workers <= 1 and not pin_cpu_cores:
+            return [ModelReplica(0, self, self.device, num_threads=self.args.intra_op_threads)]
+
+        if self.device.type == 'cpu':
+            devices = [self.device] * num_workers
+            all_cpu_cores = partition_cpu_cores(num_workers)
+        else:
+            gpus = get_devices()
+            devices = [gpus[i % len(gpus)] for i in range(num_workers)]
+            all_cpu_cores = [None] * num_workers
+
+        replicas = []
+        for i, (device, cpu_cores) in enumerate(zip(devices, all_cpu_cores)):
+            if i == 0:
+                server = self
+            else:
+                server = copy.copy(self)
+                memo = dict()
+                if device == self.device:
+                    # inference never modifies the weights, so replicas on the same device can share them
+                    memo = {id(tensor): tensor for tensor in self.model.state_dict(keep_vars=True).values()}
+                server.model = copy.deepcopy(self.model, memo).to(device)
+                server.model.eval()
+                server.numericalizer = server.model.numericalizer
+                server.device = device
+                server._reset_replica_state()
+            replica = ModelReplica(i, server, device, cpu_cores, num_threads=self.args.intra_op_threads)
+            logger.info(f'Created {replica}')
+            replicas.append(replica)
+        return replicas
+
+    def _on_device_failure(self, replica):
+        # exit with status 100, which tells the supervisor to restart the server, after a graceful shutdown
+        logger.error(f'{replica} cannot be used anymore, shutting down the server so that it is restarted')
+        self._exit_code = 100
+        if self._stop_event is not None:
+            self._stop_event.set()
+
+    def _hosted_servers(self):
+        return self.registry.servers() if self.registry is not None else [self]
+
+    def model_memory_bytes(self):
+        num_bytes = sum(p.numel() * p.element_size() for p in self.model.parameters())
+        # replicas on other devices hold their own copy of the parameters
+        return num_bytes * len({replica.device for replica in self.replicas.replicas})
+
+    def shutdown(self, wait=True):
+        """
+        wait: whether to wait for the batches that are running on the replicas to finish
+        """
+        self.replicas.shutdown(wait)
+        if self.device.type == 'cuda':
+            torch.cuda.empty_cache()
+
+    def enable_model_registry(self, cli_args):
+        """
+        Lets this server host several models, routed by the `model` field of requests.
+        `cli_args` are the command-line arguments before `init()` updated them from the configuration of --path;
+        other models are loaded with the same arguments and their own path.
+        """
+        memory_budget = int(self.args.model_memory_budget * 1024**3)
+        self.registry = ModelRegistry(
+            partial(self._load_model, cli_args), self.args.inference_name, memory_budget, self.args.drain_timeout
+        )
+        self.registry.add(self.args.inference_name, self)
+        for spec in self.args.models:
+            name, path = spec.split('=', 1)
+            self.registry.add(name, self._load_model(cli_args, name, path))
+
+    def _load_model(self, cli_args, name, path, checkpoint_name=None):
+        args = copy.deepcopy(cli_args)
+        args.path = path
+        if checkpoint_name:
+            args.checkpoint_name = checkpoint_name
+        model, device, confidence_estimators, estimator_filenames, ned_model = init(args, seed=False)
+        server = Server(
+            args,
+            model,
+            device,
+            confidence_estimators,
+            estimator_filenames,
+            ned_model,
+            metrics=self.metrics,
+            tracer=self.tracer,
+        )
+        server.replicas.on_device_failure = self._on_device_failure
+        server.warmup()
+        return server
+
+    def _route(self, request):
+        if self.registry is None:
+            return self
+        return self.registry.get(request.get('model'))
+
+    async def handle_control_request(self, request):
+        """
+        Control requests manage the hosted models:
+        `{"control": "load", "model": NAME, "path": PATH, "checkpoint_name": FILE}` loads (or reloads) a model,
+        `{"control": "unload", "model": NAME}` unloads one and `{"control": "models"}` lists them
+        """
+        if self.registry is None:
+            raise ValueError('This server does not host multiple models')
+        command = request['control']
+        if command == 'load':
+            await self.registry.load(request['model'], request['path'], request.get('checkpoint_name'))
+        elif command == 'unload':
+            await self.registry.unload(request['model'])
+        elif command != 'models':
+            raise ValueError(f'Unknown control request {command}')
+        return {'id': request.get('id'), 'models': self.registry.describe()}
+
+    def _check_control_request_allowed(self, client_writer):
+        # loading a model unpickles a file chosen by the client, so only trusted clients may send control requests
+        if not self.args.allow_control_requests:
+            raise RequestRejected('forbidden', 'Control requests are disabled, start the server with --allow_control_requests')
+        if not is_local_peer(client_writer.get_extra_info('peername')):
+            raise RequestRejected('forbidden', 'Control requests are only accepted from localhost')
+
+    def _reset_replica_state(self):
+        # state that belongs to a specific copy of the model and numericalizer
         self._cached_task_names = dict()
+        self._request_contexts = OrderedDict()
+        self._current_locales = None
+        self._tasks_with_vocab = set()
+        self._output_options_task = None
 
     def numericalize_examples(self, ex):
-
-        all_features = NumericalizedExamples.from_examples(ex, self.numericalizer)
+        with self.metrics.time_stage('numericalize'):
+            all_features = NumericalizedExamples.from_examples(ex, self.numericalizer)
+        context_length = None
+        if self.args.length_buckets:
+            context_length = round_up_to_bucket(
+                max(features.context.length for features in all_features), sorted(self.args.length_buckets)
+            )
         # make a single batch with all examples
-        return NumericalizedExamples.collate_batches(all_features, self.numericalizer, device=self.device)
+        with self.metrics.time_stage('collate'):
+            return NumericalizedExamples.collate_batches(
+                all_features, self.numericalizer, device=self.device, context_length=context_length
+            )
 
-    def _init_request(self, request):
-        args = copy.deepcopy(self.args)
-        generation_options = request.get('options', {})
+    def _make_request_context(self, task_name, generation_options):
+        # a shallow copy is enough because overridden options are replaced, never modified in place
+        args = copy.copy(self.args)
         for k, v in generation_options.items():
             if k not in GENERATION_ARGUMENTS:
                 logger.warning(f'{k} is not a generation option and cannot be overridden')
                 continue
             setattr(args, k, v)
+        # generation hyperparameters are lists (one value per set of hyperparameters); allow scalars in requests too
+        for k in GENERATION_HYPERPARAMETERS:
+            if k in generation_options and not isinstance(generation_options[k], list):
+                setattr(args, k, [generation_options[k]])
+        if any(k in generation_options for k in GENERATION_HYPERPARAMETERS):
+            check_and_update_generation_args(args)
 
+        locales = None
         # TODO handle this better by decoupling numericalizer and model
         if hasattr(args, 'src_locale') and hasattr(args, 'tgt_locale'):
-            src_locale, tgt_locale = adjust_language_code(
-                self.model.config, self.args.pretrained_model, args.src_locale, args.tgt_locale
-            )
-            self.numericalizer.update_language_dependent_properties(src_locale, tgt_locale)
-            self.model.update_language_dependent_configs(tgt_locale)
+            locales = adjust_language_code(self.model.config, self.args.pretrained_model, args.src_locale, args.tgt_locale)
 
-        task_name = request['task'] if 'task' in request else 'generic'
         task = list(get_tasks([task_name], args, self._cached_task_names).values())[0]
         if task_name not in self._cached_task_names:
             self._cached_task_names[task_name] = task
 
-        return task, args
+        return RequestContext(task=task, args=args, locales=locales)
+
+    def _get_request_context(self, request):
+        task_name = request['task'] if 'task' in request else 'generic'
+        generation_options = request.get('options', {})
+        key = (task_name, json.dumps(generation_options, sort_keys=True))
+        context = self._request_contexts.get(key)
+        if context is None:
+            context = self._make_request_context(task_name, generation_options)
+            self._request_contexts[key] = context
+            # clients choose the options, so only the most recently used combinations are kept
+            if len(self._request_contexts) > MAX_REQUEST_CONTEXTS:
+                self._request_contexts.popitem(last=False)
+        else:
+            self._request_contexts.move_to_end(key)
+        return context
 
-    def _numericalize_request(self, request, task, args):
+    def _init_request(self, request):
+        context = self._get_request_context(request)
+
+        # only touch the numericalizer and model if something actually changed since the previous request
+        if context.locales is not None and self._current_locales != context.locales:
+            src_locale, tgt_locale = context.locales
+            self.numericalizer.update_language_dependent_properties(src_locale, tgt_locale)
+            self.model.update_language_dependent_configs(tgt_locale)
+            self._current_locales = context.locales
+
+        # validate() reads generation options from the model's args
+        self.model.args = context.args
+
+        return context.task, context.args
+
+    @staticmethod
+    def _get_instances(request):
         # if single example wrap it as a list
         if 'instances' not in request:
-            request['instances'] = [
+            return [
                 {
                     'example_id': request.get('example_id', ''),
                     'context': request['context'],
@@ -182,10 +644,12 @@ class Server(object):
                     'answer': request.get('answer', ''),
                 }
             ]
+        return request['instances']
 
+    def _make_examples(self, request, task, args):
         examples = []
-        # request['instances'] is an array of {context, question, answer, example_id}
-        for instance in request['instances']:
+        # instances is an array of {context, question, answer, example_id}
+        for instance in self._get_instances(request):
             example_id, context, question, answer = (
                 instance.get('example_id', ''),
                 instance['context'],
@@ -202,14 +666,42 @@ class Server(object):
             )
             examples.append(ex)
 
-        # process features for examples
-        if self.ned_model:
-            self.ned_model.process_examples(examples, None, task.utterance_field)
+        return examples
+
+    def _process_ned(self, examples_and_tasks):
+        """
+        Adds NED features to the examples of all groups of a batch with as few NED calls as possible
+        """
+        examples_per_field = dict()
+        for examples, task in examples_and_tasks:
+            examples_per_field.setdefault(task.utterance_field, []).extend(examples)
+        with self.metrics.time_stage('ned'):
+            for utterance_field, examples in examples_per_field.items():
+                self.ned_batcher.process_examples(examples, utterance_field)
+
+    def _numericalize_examples(self, examples, task):
+        """
+        Makes a single batch out of `examples`, which should all be for `task`
+        """
+        if task.name not in self._tasks_with_vocab:
+            self.model.add_new_vocab_from_data([task])
+            self._tasks_with_vocab.add(task.name)
+        if self._output_options_task != task.name:
+            self.model.set_generation_output_options([task])
+            self._output_options_task = task.name
 
-        self.model.add_new_vocab_from_data([task])
-        self.model.set_generation_output_options([task])
+        batch = self.numericalize_examples(examples)
+        self._observe_batch(batch)
+        return batch
 
-        return self.numericalize_examples(examples)
+    def _observe_batch(self, batch):
+        batch_size, padded_length = batch.context.value.shape
+        num_tokens = batch.context.length.sum().item()
+        self.metrics.batch_size.observe(batch_size)
+        self.metrics.input_tokens.inc(num_tokens)
+        self.metrics.padding_tokens.inc(batch_size * padded_length - num_tokens)
+        if padded_length > 0:
+            self.metrics.padding_ratio.observe(1 - num_tokens / (batch_size * padded_length))
 
     def _predict_batch(self, batch, task, args):
         if args.calibrator_paths is not None:
@@ -253,91 +745,541 @@ class Server(object):
 
         return response
 
-    def handle_request(self, request):
+    def handle_requests(self, requests):
+        """
+        Answers a list of requests, returning one response per request.
+        Requests that share a task and generation options are predicted together as a single batch.
+        """
+        groups = dict()
+        for i, request in enumerate(requests):
+            key = batch_key(request)
+            if self._merges_instances(request):
+                # the predictions of split instances are merged back together, so they cannot be matched to their
+                # requests by counting them; predict each such request on its own
+                key += (i,)
+            groups.setdefault(key, []).append(i)
+
+        responses = [None] * len(requests)
+        traces = [request['_trace'] for request in requests if '_trace' in request]
         try:
-            with torch.no_grad():
-                task, args = self._init_request(request)
-                batch = self._numericalize_request(request, task, args)
-                response = self._predict_batch(batch, task, args)
+            # cheaper than no_grad(), since tensors created here never need version counters or autograd metadata
+            with torch.inference_mode(), self.metrics.record_stages() as stages:
+                examples_and_tasks = []
+                with self.metrics.time_stage('preprocess'):
+                    for indices in groups.values():
+                        context = self._get_request_context(requests[indices[0]])
+                        examples = []
+                        for i in indices:
+                            examples += self._make_examples(requests[i], context.task, context.args)
+                        examples_and_tasks.append((examples, context.task))
+
+                if self.ned_batcher is not None:
+                    self._process_ned(examples_and_tasks)
+
+                for indices, (examples, _) in zip(groups.values(), examples_and_tasks):
+                    group = [requests[i] for i in indices]
+                    task, args = self._init_request(group[0])
+                    batch = self._numericalize_examples(examples, task)
+                    self.model.set_generation_streamer(self._make_streamer(group))
+                    try:
+                        predictions = self._predict_batch(batch, task, args)
+                    finally:
+                        self.model.set_generation_streamer(None)
+
+                    if len(group) == 1:
+                        responses[indices[0]] = predictions
+                        continue
+                    # split the batch predictions back into one response per request
+                    start = 0
+                    for i, request in zip(indices, group):
+                        end = start + len(self._get_instances(request))
+                        responses[i] = predictions[start:end]
+                        start = end
+            for trace in traces:
+                trace.add_stages(stages)
         except RuntimeError as e:
-            # catch all cuda errors and exit
+            # after a CUDA error, the device cannot be used anymore; only this batch fails, and the process is restarted
+            # once the other requests in flight are answered
             if 'CUDA error' in str(e):
-                exit(100)
+                raise DeviceFailure(str(e)) from e
             else:
                 raise e
 
+        return responses
+
+    def _merges_instances(self, request):
+        """
+        Whether the predictions of consecutive instances of `request` that are parts of the same sentence (or entities
+        of the same sentence) are merged, so that the request gets fewer answers than it has instances
+        """
+        # read from the request rather than from its context, since this is also called from the event loop while
+        # the contexts are used by the inference thread
+        options = request.get('options', {})
+        return any(
+            options.get(k, getattr(self.args, k, False)) for k in ('translate_example_split', 'translate_only_entities')
+        )
+
+    def _make_streamer(self, requests):
+        """
+        Returns a GenerationStreamer that sends the partial answers of the streaming requests among `requests`
+        to their clients, or None if none of them is streaming
+        """
+        callbacks = [self._stream_callbacks.get(id(request)) for request in requests]
+        if not any(callbacks):
+            return None
+        sizes = [len(self._get_instances(request)) for request in requests]
+        previous = dict()
+
+        def on_step(input_ids):
+            # there are several rows (beams or samples) per instance; with beam search, the first one is the best so far
+            rows_per_instance = input_ids.shape[0] // sum(sizes)
+            start = 0
+            for i, (callback, size) in enumerate(zip(callbacks, sizes)):
+                if callback is not None:
+                    rows = input_ids[start * rows_per_instance : (start + size) * rows_per_instance : rows_per_instance]
+                    answers = self.numericalizer.reverse(rows, 'answer')
+                    if answers != previous.get(i):
+                        callback(answers)
+                        previous[i] = answers
+                start += size
+
+        return GenerationStreamer(on_step, interval=self.args.stream_interval, on_reset=previous.clear)
+
+    def _cache_keys(self, request):
+        """
+        Returns one cache key per instance of `request`, or None if the request should not be cached
+        """
+        if self.cache is None or not request.get('cache', True):
+            return None
+        # answers of split instances are merged, so they do not correspond to single instances
+        if self._merges_instances(request):
+            return None
+
+        options = {k: v for k, v in request.get('options', {}).items() if k in GENERATION_ARGUMENTS}
+        # sampling is not deterministic, so caching would change the output distribution
+        temperature = options.get('temperature', self.args.temperature)
+        if any(t > 0 for t in (temperature if isinstance(temperature, list) else [temperature])):
+            return None
+        options = json.dumps(options, sort_keys=True)
+        task_name = request.get('task', 'generic')
+
+        keys = []
+        for instance in self._get_instances(request):
+            normalized = []
+            # same normalization as Example.from_raw applies before task-specific preprocessing, which also gets
+            # the example id and the answer
+            for field in (instance['context'], instance['question'], instance.get('answer', '')):
+                field = unicodedata.normalize('NFD', field).rstrip('\n')
+                if self.args.lower:
+                    field = field.lower()
+                normalized.append(field)
+            keys.append((self.checkpoint_id, task_name, options, str(instance.get('example_id', '')), *normalized))
+        return keys
+
+    def _get_cached_response(self, request):
+        keys = self._cache_keys(request)
+        if keys is None:
+            return None
+        response = []
+        for key in keys:
+            value = self.cache.get(key)
+            if value is None:
+                self.metrics.cache_lookups.inc(result='miss')
+                return None
+            self.metrics.cache_lookups.inc(result='hit')
+            response.append(value)
         return response
 
-    def handle_json_request(self, line: str) -> str:
-        request = json.loads(line)
+    def _cache_response(self, request, response):
+        keys = self._cache_keys(request)
+        if keys is None or len(keys) != len(response):
+            return
+        for key, value in zip(keys, response):
+            self.cache.put(key, value)
+
+    def handle_request(self, request, stream_callback=None):
+        """
+        If the request asks for streaming, `stream_callback` is called with the list of partial answers
+        (one per instance) as they are decoded
+        """
+        start = time.perf_counter()
+        request = self._start_trace(request)
+        response = self._get_cached_response(request)
+        if response is None:
+            if request.get('stream', False) and stream_callback is not None:
+                self._stream_callbacks[id(request)] = stream_callback
+            try:
+                response = self.handle_requests([request])[0]
+            except Exception:
+                self._observe_failure(request, 'error', start)
+                raise
+            finally:
+                self._stream_callbacks.pop(id(request), None)
+            self._cache_response(request, response)
+            self._observe_request(request, 'ok', start)
+        else:
+            self._observe_request(request, 'cached', start)
+        return response
+
+    async def handle_request_async(self, request, stream_callback=None):
+        """
+        Like `handle_request`, but the request is batched with other concurrent requests and predicted off the event loop.
+        `stream_callback` is called from the inference thread.
+        """
+        start = time.perf_counter()
+        request = self._start_trace(request)
+        response = self._get_cached_response(request)
+        if response is None:
+            if request.get('stream', False) and stream_callback is not None:
+                self._stream_callbacks[id(request)] = stream_callback
+            try:
+                response = await self.batcher.submit(request)
+            except RequestRejected as e:
+                self._observe_failure(request, e.code, start)
+                raise
+            except Exception:
+                self._observe_failure(request, 'error', start)
+                raise
+            finally:
+                self._stream_callbacks.pop(id(request), None)
+            self._cache_response(request, response)
+            self._observe_request(request, 'ok', start)
+        else:
+            self._observe_request(request, 'cached', start)
+        return response
+
+    def _start_trace(self, request):
+        """
+        If `request` is sampled for tracing, returns a copy of it that collects the time spent in each stage of answering it.
+        The copy is passed along to the batcher and the replicas in place of the original request.
+        """
+        if self.tracer is None or not self.tracer.should_trace():
+            return request
+        return dict(request, _trace=RequestTrace(request, time.time()))
+
+    def _record_trace(self, request, status, start):
+        if '_trace' in request:
+            self.tracer.record(request['_trace'], status, time.perf_counter() - start)
+
+    def _observe_request(self, request, status, start):
+        self.metrics.requests.inc(status=status)
+        self.metrics.instances.inc(len(self._get_instances(request)))
+        self.metrics.request_seconds.observe(time.perf_counter() - start)
+        self._record_trace(request, status, start)
+
+    def _observe_failure(self, request, status, start):
+        self.metrics.requests.inc(status=status)
+        self._record_trace(request, status, start)
+
+    def make_response(self, request, response) -> dict:
         if 'instances' in request:
-            return json.dumps({'id': request['id'], 'instances': self.handle_request(request)}) + '\n'
+            return {'id': request['id'], 'instances': response}
         else:
-            response = self.handle_request(request)
             assert len(response) == 1
             response = response[0]
             response['id'] = request['id']
-            return json.dumps(response, ensure_ascii=False) + '\n'
+            return response
+
+    def make_error_response(self, request, error: Exception, code: str) -> dict:
+        return {'id': request.get('id'), 'error': str(error), 'code': code}
+
+    def make_partial_response(self, request, answers) -> dict:
+        if 'instances' in request:
+            return {'id': request['id'], 'partial': True, 'instances': [{'answer': answer} for answer in answers]}
+        else:
+            return {'id': request['id'], 'partial': True, 'answer': answers[0]}
+
+    def format_response(self, request, response) -> str:
+        with self.metrics.time_stage('serialize'):
+            return json.dumps(self.make_response(request, response), ensure_ascii=False) + '\n'
+
+    def format_error_response(self, request, error: RequestRejected) -> str:
+        return json.dumps(self.make_error_response(request, error, error.code)) + '\n'
+
+    def format_partial_response(self, request, answers) -> str:
+        return json.dumps(self.make_partial_response(request, answers), ensure_ascii=False) + '\n'
+
+    def handle_json_request(self, line: str, stream_callback=None) -> str:
+        with self.metrics.time_stage('parse'):
+            request = json.loads(line)
+
+        def send_partial_response(answers):
+            stream_callback(self.format_partial_response(request, answers))
+
+        if 'control' in request:
+            error = ValueError('Control requests are only supported in TCP mode')
+            return json.dumps(self.make_error_response(request, error, 'unsupported')) + '\n'
+        try:
+            server = self._route(request)
+            response = server.handle_request(request, send_partial_response if stream_callback is not None else None)
+        except RequestRejected as e:
+            return self.format_error_response(request, e)
+        except DeviceFailure:
+            self._on_device_failure(server.replicas.replicas[0])
+            error = RequestRejected('unavailable', 'The model failed to answer this request')
+            return self.format_error_response(request, error)
+        return self.format_response(request, response)
 
     async def handle_client(self, client_reader, client_writer):
+        """
+        By default, a client sends one JSON request per line and gets the responses in the same order.
+        A client can instead start the connection with `{"protocol": "json" | "msgpack", "pipeline": true}`: the server
+        acknowledges with the same JSON line and then switches to the requested framing. With `"pipeline": true`
+        (the default once negotiated), the client can send requests without waiting for the previous responses, and
+        responses are sent as soon as they are ready, so possibly out of order; clients match them by `id`.
+        """
+        framing = JsonLinesFraming()
+        pipeline = False
+        pending = set()
+        self._client_writers.add(client_writer)
         try:
-            line = await client_reader.readline()
-            while line:
-                client_writer.write(self.handle_json_request(line).encode('utf-8'))
-                line = await client_reader.readline()
+            request = await self._read_request(framing, client_reader)
+            if request is not None and 'protocol' in request:
+                try:
+                    framing, pipeline = negotiate(request)
+                except (ValueError, ImportError) as e:
+                    client_writer.write(framing.encode({'error': str(e), 'code': 'unsupported_protocol'}))
+                    client_writer.close()
+                    return
+                client_writer.write(JsonLinesFraming().encode({'protocol': framing.name, 'pipeline': pipeline}))
+                request = await self._read_request(framing, client_reader)
+
+            while request is not None:
+                if pipeline:
+                    task = asyncio.ensure_future(self._answer_request(request, framing, client_writer))
+                    pending.add(task)
+                    task.add_done_callback(pending.discard)
+                else:
+                    await self._answer_request(request, framing, client_writer)
+                request = await self._read_request(framing, client_reader)
 
-        except IOError:
+            if pending:
+                await asyncio.gather(*pending)
+
+        except ValueError as e:
+            # the rest of the stream cannot be trusted after a malformed message, so stop reading it; the requests
+            # already received are still answered
+            logger.warning(f'Closing the connection to a client that sent a malformed message: {e}')
+            client_writer.write(framing.encode({'error': str(e), 'code': 'protocol_error'}))
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+            client_writer.close()
+        except (IOError, asyncio.IncompleteReadError):
             logger.info('Connection to client_reader closed')
+            for task in pending:
+                task.cancel()
             try:
                 client_writer.close()
             except IOError:
                 pass
+        finally:
+            self._client_writers.discard(client_writer)
+
+    async def _read_request(self, framing, client_reader):
+        data = await framing.read(client_reader)
+        if data is None:
+            return None
+        with self.metrics.time_stage('parse'):
+            request = framing.decode(data)
+        if not isinstance(request, dict):
+            raise ValueError(f'Expected a request object, got {type(request).__name__}')
+        return request
+
+    async def _answer_request(self, request, framing, client_writer):
+        loop = asyncio.get_event_loop()
+
+        def send_partial_response(answers):
+            # called from the inference thread
+            message = framing.encode(self.make_partial_response(request, answers))
+            loop.call_soon_threadsafe(client_writer.write, message)
+
+        self._active_requests += 1
+        try:
+            try:
+                if self._draining:
+                    raise RequestRejected('shutting_down', 'The server is shutting down')
+                if 'control' in request:
+                    self._check_control_request_allowed(client_writer)
+                    message = framing.encode(await self.handle_control_request(request))
+                else:
+                    response = await self._route(request).handle_request_async(request, send_partial_response)
+                    with self.metrics.time_stage('serialize'):
+                        message = framing.encode(self.make_response(request, response))
+            except RequestRejected as e:
+                message = framing.encode(self.make_error_response(request, e, e.code))
+            except Exception as e:
+                # answer with an error rather than dropping the connection, since other requests may be in flight on it
+                logger.exception(f'Failed to answer request {request.get("id")}')
+                message = framing.encode(self.make_error_response(request, e, 'internal_error'))
+            client_writer.write(message)
+        finally:
+            self._active_requests -= 1
 
     def _run_tcp(self):
+        """
+        Serves until SIGTERM or SIGINT, or until a replica fails for good, then shuts down gracefully: the server stops
+        accepting connections, rejects new requests on open connections as `shutting_down`, and waits up to
+        --drain_timeout seconds for the requests in flight to be answered. Requests that are still queued after that
+        are rejected, and responses are flushed before the connections are closed.
+        """
         loop = asyncio.get_event_loop()
+        self._stop_event = asyncio.Event()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, self._stop_event.set)
+        for server in self._hosted_servers():
+            server.batcher.start()
         server = loop.run_until_complete(asyncio.start_server(self.handle_client, port=self.args.port))
-        try:
-            loop.run_forever()
-        except KeyboardInterrupt:
-            pass
+        metrics_server = None
+        if self.args.metrics_port:
+            metrics_server = loop.run_until_complete(
+                self.metrics.start_http_server(self.args.metrics_port, self.args.metrics_host)
+            )
+
+        loop.run_until_complete(self._stop_event.wait())
+        logger.info(f'Shutting down, waiting up to {self.args.drain_timeout} seconds for requests in flight')
+        deadline = loop.time() + self.args.drain_timeout
         server.close()
+        self._draining = True
+        loop.run_until_complete(self._drain(self.args.drain_timeout))
+
+        # a batch that is stuck on a replica must not keep the process from exiting once the drain window is over
+        remaining = max(deadline - loop.time(), 0)
+        if self.registry is not None:
+            drained = loop.run_until_complete(self.registry.stop(timeout=remaining))
+        else:
+            loop.run_until_complete(self.batcher.stop(timeout=remaining))
+            drained = self.batcher.pending_tokens <= 0
+            if not drained:
+                logger.warning('Some batches are still running, not waiting for them')
+            self.shutdown(wait=drained)
+        self._abandoned_batches = not drained
+        # answer the requests that the batchers rejected, then close the connections
+        loop.run_until_complete(self._close_connections())
         loop.run_until_complete(server.wait_closed())
+        if metrics_server is not None:
+            metrics_server.close()
+            loop.run_until_complete(metrics_server.wait_closed())
+        if self.cache is not None:
+            logger.info(f'Response cache statistics: {self.cache.stats()}')
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.remove_signal_handler(signum)
         loop.close()
 
+    async def _drain(self, timeout):
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout
+        while self._active_requests > 0 and loop.time() < deadline:
+            await asyncio.sleep(0.05)
+        if self._active_requests > 0:
+            logger.warning(f'{self._active_requests} requests were not answered within {timeout} seconds')
+
+    async def _close_connections(self):
+        await self._drain(timeout=1)
+        for client_writer in list(self._client_writers):
+            # buffered responses are still sent before the connection is closed
+            client_writer.close()
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        if tasks:
+            await asyncio.wait(tasks, timeout=1)
+
+    @staticmethod
+    def _write_stdout(message):
+        sys.stdout.write(message)
+        sys.stdout.flush()
+
     def _run_stdin(self):
         try:
             while True:
                 line = sys.stdin.readline()
                 if not line:
                     break
-                sys.stdout.write(self.handle_json_request(line))
+                sys.stdout.write(self.handle_json_request(line, stream_callback=self._write_stdout))
                 sys.stdout.flush()
+                if self._exit_code is not None:
+                    break
         except KeyboardInterrupt:
             pass
 
+    def _make_warmup_requests(self):
+        requests = []
+        for options in self.args.warmup_options:
+            for length in self.args.warmup_lengths:
+                for batch_size in self.args.warmup_batch_sizes:
+                    instances = [
+                        {'example_id': f'warmup-{i}', 'context': ' '.join(['warmup'] * length), 'question': ''}
+                        for i in range(batch_size)
+                    ]
+                    requests.append(
+                        {
+                            'id': f'warmup-{length}-{batch_size}',
+                            'task': self.args.warmup_task,
+                            'options': options,
+                            'instances': instances,
+                        }
+                    )
+        return requests
+
+    def warmup(self):
+        """
+        Runs the synthetic requests of --warmup_* on every replica, in the replica's own thread.
+        Each request is run on its own, so that every combination of length, batch size and options is exercised
+        """
+        requests = self._make_warmup_requests()
+        if not requests:
+            return
+        start = time.perf_counter()
+        futures = [replica.executor.submit(replica.server._warmup_replica, requests) for replica in self.replicas.replicas]
+        for future in futures:
+            future.result()
+        elapsed = time.perf_counter() - start
+        logger.info(f'Warmed up {len(self.replicas)} replica(s) with {len(requests)} requests in {elapsed:.1f} seconds')
+
+    def _warmup_replica(self, requests):
+        # synthetic requests would skew the batch size, padding and latency metrics of real ones
+        with self.metrics.muted():
+            for request in requests:
+                self.handle_requests([request])
+
     def run(self):
         log_model_size(logger, self.model, self.args.model)
         self.model.to(self.device)
 
         self.model.eval()
+        self.warmup()
         if self.args.stdin:
             self._run_stdin()
         else:
             self._run_tcp()
+        if self.tracer is not None:
+            self.tracer.close()
+        if self._abandoned_batches:
+            # the interpreter would otherwise join the replica threads on exit, and wait for the stuck batches
+            logging.shutdown()
+            os._exit(self._exit_code or 0)
+        if self._exit_code is not None:
+            sys.exit(self._exit_code)
 
 
-def init(args):
+def init(args, seed=True):
     load_config_file_to_args(args)
     check_and_update_generation_args(args)
     if not args.src_locale:
         args.src_locale = args.eval_src_languages
     if not args.tgt_locale:
         args.tgt_locale = args.eval_tgt_languages
-    set_seed(args)
+    # models hosted after the first one are loaded while other models generate, and reseeding the global RNGs then
+    # would change their sampled outputs
+    if seed:
+        set_seed(args)
 
     devices = get_devices()
     device = devices[0]  # server only runs on a single device
 
+    inter_op_threads = args.inter_op_threads or (1 if args.cpu_profile else 0)
+    # can only be set once per process, before any parallel work; init() runs again when hosting more models
+    if inter_op_threads and torch.get_num_interop_threads() != inter_op_threads:
+        torch.set_num_interop_threads(inter_op_threads)
+
     if args.ned_retrieve_method == 'bootleg':
         ned_model = init_ned_model(args, 'bootleg-annotator')
     else:
@@ -384,6 +1326,8 @@ def init(args):
 
 
 def main(args):
+    cli_args = copy.deepcopy(args)
     model, device, confidence_estimators, estimator_filenames, ned_model = init(args)
     server = Server(args, model, device, confidence_estimators, estimator_filenames, ned_model)
+    server.enable_model_registry(cli_args)
     server.run()
@@ -0,0 +1,361 @@
+#
+# Copyright (c) 2022, The Board of Trustees of the Leland Stanford Junior University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import asyncio
+import json
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def _estimate_instance_tokens(instance):
+    return len(instance.get('context', '').split()) + len(instance.get('question', '').split()) + 1
+
+
+def estimate_num_tokens(request):
+    """
+    A cheap, tokenizer-free estimate of the number of input tokens in a request, used to bound the size of batches
+    before the request is numericalized
+    """
+    if 'instances' in request:
+        instances = request['instances']
+    else:
+        instances = [request]
+    return sum(_estimate_instance_tokens(instance) for instance in instances)
+
+
+def round_up_to_bucket(length, buckets):
+    """
+    Returns the smallest of the (sorted) `buckets` that is at least `length`, or `length` itself if it is larger than
+    all of them
+    """
+    for bucket in buckets:
+        if bucket >= length:
+            return bucket
+    return length
+
+
+def length_bucket(request, buckets):
+    """
+    The bucket of the longest instance of `request`, according to the same estimate as `estimate_num_tokens`.
+    This counts words, not subword tokens, so the input can still be padded to a larger bucket once it is tokenized
+    """
+    instances = request['instances'] if 'instances' in request else [request]
+    return round_up_to_bucket(max(_estimate_instance_tokens(instance) for instance in instances), buckets)
+
+
+def batch_key(request):
+    """
+    Requests can only share a batch if they are for the same task and override the same generation options
+    """
+    return request.get('task', 'generic'), json.dumps(request.get('options', {}), sort_keys=True)
+
+
+class RequestRejected(Exception):
+    """
+    Raised when a request is not answered because of admission control, because it asks for a model that is not
+    hosted, or because the server cannot answer it anymore. `code` is one of `overloaded`, `deadline_exceeded`,
+    `unknown_model`, `unavailable` (the model replica failed), `shutting_down` or `forbidden` (a control request that
+    is not allowed).
+    """
+
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+
+class PendingRequest(object):
+    def __init__(self, request, future, deadline=None, length_buckets=(), alone=False):
+        self.request = request
+        self.future = future
+        self.deadline = deadline
+        self.key = batch_key(request)
+        if length_buckets:
+            self.key += (length_bucket(request, length_buckets),)
+        if alone:
+            # a key of its own keeps the request out of everyone else's group
+            self.key += (id(self),)
+        self.num_tokens = estimate_num_tokens(request)
+
+
+class RequestBatcher(object):
+    """
+    Collects in-flight requests from all connected clients and runs them through `process_fn` in batches.
+
+    A batch is closed when `max_wait_ms` milliseconds have passed since its first request arrived, or when the
+    estimated number of input tokens reaches `max_tokens`. Requests in a batch are then grouped by task and generation
+    options, and each group is passed to `process_fn` as a list. `process_fn` is a coroutine function that must return
+    one response per request.
+
+    At most `max_concurrency` groups are processed at the same time (usually one per model replica). While all of them
+    are busy, new requests keep accumulating in the queue and make up the next batch.
+
+    If `length_buckets` are given, requests are also grouped by the bucket of their longest instance, so that each
+    group is padded to one of a few lengths.
+
+    `merges_instances(request)`, if given, tells whether the answers of some instances of `request` are merged together
+    (e.g. the sentences of a split paragraph), so that the request has fewer answers than instances. Such requests
+    are never split, and are processed in a group of their own.
+
+    Admission control: requests whose `instances` do not fit in `max_tokens` are split into several batches. If
+    `max_pending_tokens` is set, requests that would bring the number of queued and running tokens above it are rejected.
+    Requests can set a deadline with `timeout_ms`; they are rejected as soon as it is clear they cannot meet it, either
+    on arrival (based on the measured processing speed and the work ahead of them) or when their batch is formed.
+    """
+
+    def __init__(
+        self,
+        process_fn,
+        max_wait_ms=5,
+        max_tokens=4000,
+        max_concurrency=1,
+        max_pending_tokens=0,
+        length_buckets=(),
+        merges_instances=None,
+    ):
+        self.process_fn = process_fn
+        self.max_wait = max_wait_ms / 1000
+        self.max_tokens = max_tokens
+        self.max_concurrency = max_concurrency
+        self.max_pending_tokens = max_pending_tokens
+        self.length_buckets = sorted(length_buckets)
+        self.merges_instances = merges_instances
+
+        self.pending_tokens = 0
+        # exponential moving average of the processing time per token, used to predict queueing delays
+        self.seconds_per_token = None
+
+        self._queue = None
+        self._carry_over = None
+        self._slots = None
+        self._task = None
+        self._running = set()
+        # requests that were submitted and are not answered yet
+        self._unanswered = set()
+
+    def start(self):
+        self._queue = asyncio.Queue()
+        self._slots = asyncio.Semaphore(self.max_concurrency)
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self, timeout=None):
+        """
+        Stops batching, waits up to `timeout` seconds (or indefinitely if None) for the groups that are being processed,
+        and rejects the requests that are still not answered
+        """
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        if self._running:
+            await asyncio.wait(self._running, timeout=timeout)
+        # requests that were still queued will never be batched
+        for pending in list(self._unanswered):
+            if not pending.future.done():
+                pending.future.set_exception(RequestRejected('shutting_down', 'The server is shutting down'))
+
+    def _split(self, request):
+        """
+        Splits a request whose instances do not fit in a single batch into several requests
+        """
+        instances = request.get('instances')
+        # partial answers of streaming requests are sent for all instances at once, so they cannot be split
+        if not instances or request.get('stream', False) or estimate_num_tokens(request) <= self.max_tokens:
+            return [request]
+        # instances whose answers are merged must stay together, and the answers cannot be split back by counting
+        if self._merges_instances(request):
+            return [request]
+
+        chunks = []
+        chunk = []
+        num_tokens = 0
+        for instance in instances:
+            instance_tokens = _estimate_instance_tokens(instance)
+            if chunk and num_tokens + instance_tokens > self.max_tokens:
+                chunks.append(chunk)
+                chunk = []
+                num_tokens = 0
+            chunk.append(instance)
+            num_tokens += instance_tokens
+        chunks.append(chunk)
+
+        return [dict(request, instances=chunk) for chunk in chunks]
+
+    def _merges_instances(self, request):
+        return self.merges_instances is not None and self.merges_instances(request)
+
+    def _admit(self, num_tokens, deadline):
+        # a request is always admitted when nothing else is pending, however large it is
+        if (
+            self.max_pending_tokens > 0
+            and 0 < self.pending_tokens
+            and (self.pending_tokens + num_tokens > self.max_pending_tokens)
+        ):
+            raise RequestRejected('overloaded', 'The server has too many pending requests, try again later')
+
+        if deadline is not None and self.seconds_per_token is not None:
+            expected_tokens = self.pending_tokens / self.max_concurrency + num_tokens
+            if asyncio.get_event_loop().time() + expected_tokens * self.seconds_per_token > deadline:
+                raise RequestRejected('deadline_exceeded', 'The request cannot be answered before its deadline')
+
+    def _release(self, pending):
+        self.pending_tokens -= pending.num_tokens
+        self._unanswered.discard(pending)
+        # nobody might be waiting for the future anymore if the request timed out
+        if not pending.future.cancelled():
+            pending.future.exception()
+
+    async def submit(self, request):
+        if self._task is None:
+            raise RequestRejected('shutting_down', 'The server is shutting down')
+        loop = asyncio.get_event_loop()
+        deadline = None
+        if request.get('timeout_ms') is not None:
+            deadline = loop.time() + request['timeout_ms'] / 1000
+        self._admit(estimate_num_tokens(request), deadline)
+
+        chunks = self._split(request)
+        if len(chunks) == 1:
+            return await self._submit_one(request, deadline)
+
+        logger.debug('splitting a request with %d instances into %d batches', len(request['instances']), len(chunks))
+        responses = await asyncio.gather(*[self._submit_one(chunk, deadline) for chunk in chunks])
+        return [instance_response for response in responses for instance_response in response]
+
+    async def _submit_one(self, request, deadline):
+        loop = asyncio.get_event_loop()
+        pending = PendingRequest(
+            request, loop.create_future(), deadline, self.length_buckets, alone=self._merges_instances(request)
+        )
+        self.pending_tokens += pending.num_tokens
+        self._unanswered.add(pending)
+        pending.future.add_done_callback(lambda _: self._release(pending))
+        self._queue.put_nowait(pending)
+
+        if deadline is None:
+            return await pending.future
+        try:
+            # the request keeps its place in the batch if the client gives up on it
+            return await asyncio.wait_for(asyncio.shield(pending.future), max(deadline - loop.time(), 0))
+        except asyncio.TimeoutError:
+            raise RequestRejected('deadline_exceeded', 'The request was not answered before its deadline')
+
+    async def _next_batch(self):
+        loop = asyncio.get_event_loop()
+        if self._carry_over is not None:
+            first, self._carry_over = self._carry_over, None
+        else:
+            first = await self._queue.get()
+        batch = [first]
+        num_tokens = first.num_tokens
+        deadline = loop.time() + self.max_wait
+
+        while num_tokens < self.max_tokens:
+            if self._queue.empty():
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    pending = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            else:
+                pending = self._queue.get_nowait()
+            if num_tokens + pending.num_tokens > self.max_tokens:
+                # keep it for the next batch
+                self._carry_over = pending
+                break
+            batch.append(pending)
+            num_tokens += pending.num_tokens
+
+        return batch
+
+    async def _run(self):
+        while True:
+            # do not start the waiting window until someone can actually run the batch
+            await self._slots.acquire()
+            self._slots.release()
+
+            batch = await self._next_batch()
+
+            groups = OrderedDict()
+            now = asyncio.get_event_loop().time()
+            for pending in batch:
+                if pending.deadline is not None and pending.deadline < now:
+                    pending.future.set_exception(
+                        RequestRejected('deadline_exceeded', 'The request was not answered before its deadline')
+                    )
+                    continue
+                groups.setdefault(pending.key, []).append(pending)
+
+            logger.debug('running a batch of %d requests in %d groups', len(batch), len(groups))
+            for group in groups.values():
+                await self._slots.acquire()
+                task = asyncio.ensure_future(self._run_group(group))
+                self._running.add(task)
+                task.add_done_callback(self._running.discard)
+
+    async def _run_group(self, group):
+        try:
+            await self._process_group(group)
+        finally:
+            self._slots.release()
+
+    async def _process_group(self, group):
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        try:
+            responses = await self.process_fn([pending.request for pending in group])
+        except Exception as e:
+            # rejections are about the whole group (e.g. its replica failed), so there is no point in retrying
+            if len(group) == 1 or isinstance(e, RequestRejected):
+                for pending in group:
+                    if not pending.future.done():
+                        pending.future.set_exception(e)
+                return
+            # one bad request should not fail everyone else in its group, so retry them one by one
+            logger.warning('batch of %d requests failed (%s), retrying them individually', len(group), e)
+            for pending in group:
+                await self._process_group([pending])
+            return
+
+        seconds_per_token = (loop.time() - start) / sum(pending.num_tokens for pending in group)
+        if self.seconds_per_token is None:
+            self.seconds_per_token = seconds_per_token
+        else:
+            self.seconds_per_token = 0.9 * self.seconds_per_token + 0.1 * seconds_per_token
+
+        for pending, response in zip(group, responses):
+            if not pending.future.done():
+                pending.future.set_result(response)
@@ -0,0 +1,271 @@
+#
+# Copyright (c) 2022, The Board of Trustees of the Leland Stanford Junior University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import asyncio
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+RATIO_BUCKETS = (0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0)
+
+
+# whether the current thread is in a `ServerMetrics.muted()` block
+_muted = threading.local()
+
+
+def _is_muted():
+    return getattr(_muted, 'value', False)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+
+class Metric(object):
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = dict()  # tuple of label values -> value
+
+    def _key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labelnames)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines += self._render_value(list(zip(self.labelnames, key)), value)
+        return lines
+
+    def _render_value(self, labels, value):
+        return [f'{self.name}{_format_labels(labels)} {value}']
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        super().__init__(name, help, labelnames)
+        if not self.labelnames:
+            self._values[()] = 0
+
+    def inc(self, amount=1, **labels):
+        if _is_muted():
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Metric):
+    """
+    A gauge whose value is either set explicitly or read from `fn` when the metrics are collected
+    """
+
+    type = 'gauge'
+
+    def __init__(self, name, help, labelnames=(), fn=None):
+        super().__init__(name, help, labelnames)
+        self.fn = fn
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def render(self):
+        if self.fn is not None:
+            self.set(self.fn())
+        return super().render()
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        if _is_muted():
+            return
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _render_value(self, labels, value):
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{_format_labels(labels + [("le", bound)])} {cumulative}')
+        lines.append(f'{self.name}_sum{_format_labels(labels)} {total}')
+        lines.append(f'{self.name}_count{_format_labels(labels)} {cumulative}')
+        return lines
+
+
+class ServerMetrics(object):
+    """
+    Counters and histograms describing where time goes when serving requests, in Prometheus text format
+    """
+
+    def __init__(self):
+        self.requests = Counter('genienlp_requests_total', 'Requests received', ('status',))
+        self.instances = Counter('genienlp_instances_total', 'Instances received')
+        self.cache_lookups = Counter('genienlp_cache_lookups_total', 'Instances looked up in the response cache', ('result',))
+        self.stage_seconds = Histogram(
+            'genienlp_stage_seconds', 'Time spent in each stage of answering a request', ('stage',), LATENCY_BUCKETS
+        )
+        self.request_seconds = Histogram('genienlp_request_seconds', 'End-to-end latency of requests')
+        self.batch_size = Histogram('genienlp_batch_size', 'Number of instances in each model batch', buckets=SIZE_BUCKETS)
+        self.padding_ratio = Histogram(
+            'genienlp_padding_ratio', 'Fraction of pad tokens in the input of each model batch', buckets=RATIO_BUCKETS
+        )
+        self.input_tokens = Counter('genienlp_input_tokens_total', 'Input tokens in model batches, excluding padding')
+        self.padding_tokens = Counter('genienlp_padding_tokens_total', 'Pad tokens added to the input of model batches')
+        self.ned_batch_size = Histogram(
+            'genienlp_ned_batch_size', 'Number of examples in each call to the NED model', buckets=SIZE_BUCKETS
+        )
+        self.queue_depth = Gauge('genienlp_queue_depth', 'Requests waiting to be batched')
+        self.pending_tokens = Gauge('genienlp_pending_tokens', 'Input tokens of requests that are queued or running')
+
+        self._metrics = [
+            self.requests,
+            self.instances,
+            self.cache_lookups,
+            self.stage_seconds,
+            self.request_seconds,
+            self.batch_size,
+            self.padding_ratio,
+            self.ned_batch_size,
+            self.input_tokens,
+            self.padding_tokens,
+            self.queue_depth,
+            self.pending_tokens,
+        ]
+
+        # stage timings of the batch that is running on each thread, when they are being recorded
+        self._local = threading.local()
+
+    def add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    @contextmanager
+    def time_stage(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.stage_seconds.observe(seconds, stage=stage)
+            stages = getattr(self._local, 'stages', None)
+            if stages is not None:
+                stages[stage] = stages.get(stage, 0) + seconds
+
+    @contextmanager
+    def muted(self):
+        """
+        Counters and histograms are not updated from the current thread until the block exits, e.g. during warm-up
+        """
+        _muted.value = True
+        try:
+            yield
+        finally:
+            _muted.value = False
+
+    @contextmanager
+    def record_stages(self):
+        """
+        Also collects the time spent in each stage on the current thread into the yielded dict, until the block exits
+        """
+        self._local.stages = stages = dict()
+        try:
+            yield stages
+        finally:
+            self._local.stages = None
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines += metric.render()
+        return '\n'.join(lines) + '\n'
+
+    async def _handle_http(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            # skip the headers
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request_line.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+                status, body = '200 OK', self.render().encode('utf-8')
+            else:
+                status, body = '404 Not Found', b'not found\n'
+            writer.write(
+                f'HTTP/1.0 {status}\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: {len(body)}\r\n\r\n'.encode(
+                    'latin-1'
+                )
+                + body
+            )
+            await writer.drain()
+        except IOError:
+            pass
+        finally:
+            writer.close()
+
+    async def start_http_server(self, port, host='localhost'):
+        server = await asyncio.start_server(self._handle_http, host=host, port=port)
+        logger.info(f'Serving metrics on http://{host}:{port}/metrics')
+        return server
@@ -0,0 +1,95 @@
+#
+# Copyright (c) 2022, The Board of Trustees of the Leland Stanford Junior University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import threading
+from collections import defaultdict
+
+
+class _NEDJob(object):
+    def __init__(self, examples, utterance_field):
+        self.examples = examples
+        self.utterance_field = utterance_field
+        self.done = False
+        self.error = None
+
+
+class NEDBatcher(object):
+    """
+    Shares one NED model between the inference threads of all model replicas, and runs their examples through it together.
+
+    The NED model only runs on one thread at a time. While it is busy, the examples of other threads accumulate, and the
+    next thread to run it takes all of them at once, so concurrent batches share a single NED call.
+    """
+
+    def __init__(self, ned_model, on_batch=None):
+        self.ned_model = ned_model
+        # called with the number of examples of each NED call
+        self.on_batch = on_batch
+
+        self._condition = threading.Condition()
+        self._pending = []
+        self._busy = False
+
+    def process_examples(self, examples, utterance_field):
+        job = _NEDJob(examples, utterance_field)
+        with self._condition:
+            self._pending.append(job)
+            while self._busy and not job.done:
+                self._condition.wait()
+            if not job.done:
+                # nobody else is running the NED model, so run it for everything that is pending, including this job
+                self._busy = True
+                jobs, self._pending = self._pending, []
+        if not job.done:
+            try:
+                self._run(jobs)
+            finally:
+                with self._condition:
+                    self._busy = False
+                    self._condition.notify_all()
+        if job.error is not None:
+            raise job.error
+
+    def _run(self, jobs):
+        jobs_per_field = defaultdict(list)
+        for job in jobs:
+            jobs_per_field[job.utterance_field].append(job)
+
+        for utterance_field, field_jobs in jobs_per_field.items():
+            examples = [ex for job in field_jobs for ex in job.examples]
+            try:
+                # features are written into the examples in place
+                self.ned_model.process_examples(examples, None, utterance_field)
+                if self.on_batch is not None:
+                    self.on_batch(len(examples))
+            except Exception as e:
+                for job in field_jobs:
+                    job.error = e
+            for job in field_jobs:
+                job.done = True
@@ -0,0 +1,110 @@
+#
+# Copyright (c) 2022, The Board of Trustees of the Leland Stanford Junior University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import asyncio
+import json
+import struct
+
+# upper bound on the size of a single msgpack frame, to protect the server from malformed length prefixes
+MAX_FRAME_BYTES = 256 * 1024 * 1024
+
+_frame_header = struct.Struct('>I')
+
+
+class JsonLinesFraming(object):
+    """
+    The default wire format: one JSON object per line
+    """
+
+    name = 'json'
+
+    async def read(self, reader):
+        """
+        Returns the next raw message, or None at the end of the stream
+        """
+        line = await reader.readline()
+        return line or None
+
+    def decode(self, data):
+        return json.loads(data)
+
+    def encode(self, message):
+        return (json.dumps(message, ensure_ascii=False) + '\n').encode('utf-8')
+
+
+class MsgpackFraming(object):
+    """
+    Each message is a msgpack object, prefixed by its length in bytes as a 4-byte big-endian unsigned integer
+    """
+
+    name = 'msgpack'
+
+    def __init__(self):
+        try:
+            import msgpack
+        except ImportError:
+            raise ImportError('Please install msgpack (pip install msgpack) to use the msgpack protocol')
+        self.msgpack = msgpack
+
+    async def read(self, reader):
+        try:
+            header = await reader.readexactly(_frame_header.size)
+        except asyncio.IncompleteReadError as e:
+            if not e.partial:
+                return None
+            raise
+        (length,) = _frame_header.unpack(header)
+        if length > MAX_FRAME_BYTES:
+            raise ValueError(f'Message of {length} bytes is larger than the maximum of {MAX_FRAME_BYTES} bytes')
+        return await reader.readexactly(length)
+
+    def decode(self, data):
+        try:
+            return self.msgpack.unpackb(data, raw=False)
+        except self.msgpack.exceptions.UnpackException as e:
+            # most unpacking errors are already ValueErrors, but not all of them
+            raise ValueError(f'Malformed msgpack message: {e!r}') from e
+
+    def encode(self, message):
+        payload = self.msgpack.packb(message, use_bin_type=True)
+        return _frame_header.pack(len(payload)) + payload
+
+
+FRAMINGS = {'json': JsonLinesFraming, 'msgpack': MsgpackFraming}
+
+
+def negotiate(message):
+    """
+    Handles the optional first message of a connection, of the form `{"protocol": "json" | "msgpack", "pipeline": bool}`.
+    Returns the framing to use for the rest of the connection and whether requests are pipelined.
+    """
+    protocol = message['protocol']
+    if protocol not in FRAMINGS:
+        raise ValueError(f'Unknown protocol {protocol}, expected one of {list(FRAMINGS.keys())}')
+    return FRAMINGS[protocol](), message.get('pipeline', True)
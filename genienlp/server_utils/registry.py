@@ -0,0 +1,165 @@
+#
+# Copyright (c) 2022, The Board of Trustees of the Leland Stanford Junior University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import asyncio
+import logging
+from collections import OrderedDict
+
+from .batching import RequestRejected
+
+logger = logging.getLogger(__name__)
+
+
+class ModelRegistry(object):
+    """
+    The models hosted by one server process, by name.
+
+    `load_fn(name, path, checkpoint_name)` builds a ready-to-serve (i.e. loaded and warmed up) model server; it runs on a
+    background thread so that other models keep serving while a new one loads. Loading a name that is already hosted
+    swaps the new version in atomically: new requests go to the new version while the old one finishes the requests it
+    already accepted, and is then released.
+
+    When the models take more than `memory_budget` bytes, the least recently used ones are unloaded, except for the
+    default model and the model that was just loaded.
+
+    A model that is replaced or unloaded gets `drain_timeout` seconds to answer its requests in flight. After that, the
+    requests that are still not answered are rejected, and the model is released without waiting for its replicas.
+    """
+
+    def __init__(self, load_fn, default_name, memory_budget=0, drain_timeout=30):
+        self.load_fn = load_fn
+        self.default_name = default_name
+        self.memory_budget = memory_budget
+        self.drain_timeout = drain_timeout
+
+        self._servers = OrderedDict()  # name -> server, from least to most recently used
+        self._load_lock = None
+
+    def __len__(self):
+        return len(self._servers)
+
+    def add(self, name, server):
+        self._servers[name] = server
+
+    def servers(self):
+        return list(self._servers.values())
+
+    def get(self, name=None):
+        if name is None:
+            name = self.default_name
+        server = self._servers.get(name)
+        if server is None:
+            raise RequestRejected('unknown_model', f'Model {name} is not loaded')
+        self._servers.move_to_end(name)
+        return server
+
+    def describe(self):
+        return [
+            {'model': name, 'checkpoint': server.checkpoint_id, 'memory_bytes': server.model_memory_bytes()}
+            for name, server in self._servers.items()
+        ]
+
+    async def load(self, name, path, checkpoint_name=None):
+        if self._load_lock is None:
+            self._load_lock = asyncio.Lock()
+        # one load at a time, so that memory usage never includes more than one model that is not yet accounted for
+        async with self._load_lock:
+            logger.info(f'Loading model {name} from {path}')
+            server = await asyncio.get_event_loop().run_in_executor(None, self.load_fn, name, path, checkpoint_name)
+            server.batcher.start()
+
+            old = self._servers.get(name)
+            self._servers[name] = server
+            self._servers.move_to_end(name)
+            logger.info(f'Now serving model {name} from {server.checkpoint_id}')
+
+            if old is not None:
+                await self._release(name, old)
+            await self._evict(keep=name)
+
+    async def unload(self, name):
+        if name == self.default_name:
+            raise ValueError('Cannot unload the default model')
+        server = self._servers.pop(name, None)
+        if server is None:
+            raise RequestRejected('unknown_model', f'Model {name} is not loaded')
+        await self._release(name, server)
+
+    async def _release(self, name, server):
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + self.drain_timeout
+        # let the requests that were already routed to this server finish
+        while server.batcher.pending_tokens > 0 and loop.time() < deadline:
+            await asyncio.sleep(0.05)
+        await server.batcher.stop(timeout=max(deadline - loop.time(), 0))
+        drained = server.batcher.pending_tokens <= 0
+        if not drained:
+            # a stuck batch must not keep the reload waiting forever; its replica thread is abandoned
+            logger.warning(
+                f'Model {name} from {server.checkpoint_id} did not answer its requests within {self.drain_timeout} seconds, '
+                'releasing it anyway'
+            )
+        server.shutdown(wait=drained)
+        logger.info(f'Released model {name} from {server.checkpoint_id}')
+
+    def memory_bytes(self):
+        return sum(server.model_memory_bytes() for server in self._servers.values())
+
+    async def _evict(self, keep):
+        if self.memory_budget <= 0:
+            return
+        while self.memory_bytes() > self.memory_budget:
+            candidates = [name for name in self._servers if name not in (keep, self.default_name)]
+            if not candidates:
+                logger.warning(
+                    f'Hosted models take {self.memory_bytes()} bytes, more than the budget of {self.memory_budget} bytes, '
+                    'but no model can be evicted'
+                )
+                return
+            name = candidates[0]
+            logger.info(f'Evicting model {name} to stay within the memory budget')
+            await self._release(name, self._servers.pop(name))
+
+    async def stop(self, timeout=None):
+        """
+        Stops all models, waiting up to `timeout` seconds in total (or indefinitely if None) for their running batches.
+        Models whose batches are still running after that are shut down without waiting for their replicas.
+        Returns whether all batches finished.
+        """
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout if timeout is not None else None
+        all_drained = True
+        for name, server in list(self._servers.items()):
+            await server.batcher.stop(timeout=max(deadline - loop.time(), 0) if deadline is not None else None)
+            drained = server.batcher.pending_tokens <= 0
+            if not drained:
+                logger.warning(f'Model {name} from {server.checkpoint_id} still has batches running, not waiting for them')
+            server.shutdown(wait=drained)
+            all_drained = all_drained and drained
+        return all_drained
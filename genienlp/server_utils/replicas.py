@@ -0,0 +1,175 @@
+#
+# Copyright (c) 2022, The Board of Trustees of the Leland Stanford Junior University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import asyncio
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+from .batching import RequestRejected, estimate_num_tokens
+
+logger = logging.getLogger(__name__)
+
+
+class DeviceFailure(RuntimeError):
+    """
+    Raised by a replica whose device cannot be used anymore, e.g. after a CUDA error. Only restarting the process helps.
+    """
+
+
+def partition_cpu_cores(num_groups):
+    """
+    Splits the cores this process is allowed to run on into `num_groups` contiguous, disjoint groups
+    """
+    cores = sorted(os.sched_getaffinity(0))
+    if num_groups > len(cores):
+        logger.warning(f'Cannot give each of {num_groups} workers its own core, only {len(cores)} cores are available')
+        return [[core] for core in (cores * num_groups)[:num_groups]]
+    group_size, remainder = divmod(len(cores), num_groups)
+    groups = []
+    start = 0
+    for i in range(num_groups):
+        end = start + group_size + (1 if i < remainder else 0)
+        groups.append(cores[start:end])
+        start = end
+    return groups
+
+
+class ModelReplica(object):
+    """
+    A copy of the model on one device (or one group of CPU cores), together with the single thread that runs it
+    """
+
+    def __init__(self, index, server, device, cpu_cores=None, num_threads=0):
+        self.index = index
+        self.server = server
+        self.device = device
+        self.cpu_cores = cpu_cores
+        # number of intra-op threads; by default, one per core of the replica
+        self.num_threads = num_threads
+
+        self.executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix=f'genienlp-replica-{index}', initializer=self._init_thread
+        )
+
+        # load and health tracking
+        self.in_flight_tokens = 0
+        self.num_batches = 0
+        self.consecutive_failures = 0
+        self.healthy = True
+        self.unhealthy_since = None
+        # set after a DeviceFailure; such a replica never comes back
+        self.failed = False
+
+    def _init_thread(self):
+        if self.cpu_cores:
+            # on Linux, this only pins the calling (inference) thread and the intra-op threads it spawns
+            os.sched_setaffinity(0, self.cpu_cores)
+        if self.num_threads:
+            torch.set_num_threads(self.num_threads)
+        elif self.cpu_cores:
+            torch.set_num_threads(len(self.cpu_cores))
+
+    def __repr__(self):
+        cores = f', cores={self.cpu_cores[0]}-{self.cpu_cores[-1]}' if self.cpu_cores else ''
+        return f'ModelReplica({self.index}, device={self.device}{cores})'
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+
+class ReplicaPool(object):
+    """
+    Dispatches batches to the least loaded healthy replica.
+
+    A replica that fails `max_failures` batches in a row with a RuntimeError (the type PyTorch uses for device errors)
+    is taken out of rotation for `retry_after` seconds, after which it gets another chance. A replica that raises
+    DeviceFailure is taken out of rotation for good, its batch is rejected as `unavailable`, and `on_device_failure`
+    is called with it.
+    """
+
+    def __init__(self, replicas, max_failures=3, retry_after=30, on_device_failure=None):
+        self.replicas = replicas
+        self.max_failures = max_failures
+        self.retry_after = retry_after
+        self.on_device_failure = on_device_failure
+
+    def __len__(self):
+        return len(self.replicas)
+
+    def _update_health(self):
+        now = time.monotonic()
+        for replica in self.replicas:
+            if not replica.healthy and not replica.failed and now - replica.unhealthy_since >= self.retry_after:
+                logger.info(f'Putting {replica} back in rotation')
+                replica.healthy = True
+                replica.consecutive_failures = 0
+
+    def pick(self):
+        self._update_health()
+        candidates = [replica for replica in self.replicas if replica.healthy]
+        if not candidates:
+            raise RequestRejected('unavailable', 'No healthy model replica is available')
+        return min(candidates, key=lambda replica: replica.in_flight_tokens)
+
+    async def submit(self, requests):
+        replica = self.pick()
+        num_tokens = sum(estimate_num_tokens(request) for request in requests)
+        replica.in_flight_tokens += num_tokens
+        try:
+            responses = await asyncio.get_event_loop().run_in_executor(
+                replica.executor, replica.server.handle_requests, requests
+            )
+        except DeviceFailure as e:
+            logger.error(f'{replica} failed with a device error, taking it out of rotation for good: {e}')
+            replica.healthy = False
+            replica.failed = True
+            if self.on_device_failure is not None:
+                self.on_device_failure(replica)
+            raise RequestRejected('unavailable', 'The model replica answering this request failed') from e
+        except RuntimeError:
+            replica.consecutive_failures += 1
+            if replica.consecutive_failures >= self.max_failures and replica.healthy:
+                logger.error(f'{replica} failed {replica.consecutive_failures} batches in a row, taking it out of rotation')
+                replica.healthy = False
+                replica.unhealthy_since = time.monotonic()
+            raise
+        finally:
+            replica.in_flight_tokens -= num_tokens
+
+        replica.consecutive_failures = 0
+        replica.num_batches += 1
+        return responses
+
+    def shutdown(self, wait=True):
+        for replica in self.replicas:
+            replica.shutdown(wait)
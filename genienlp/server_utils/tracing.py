@@ -0,0 +1,190 @@
+#
+# Copyright (c) 2022, The Board of Trustees of the Leland Stanford Junior University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import json
+import logging
+import os
+import queue
+import random
+import struct
+import threading
+
+logger = logging.getLogger(__name__)
+
+_record_header = struct.Struct('>I')
+
+
+class RequestTrace(object):
+    """
+    A request that was sampled for tracing, and the time spent in each stage by the batches that answered it
+    """
+
+    def __init__(self, request, arrival_time):
+        self.request = request
+        self.arrival_time = arrival_time
+        self.stages = dict()
+        # requests that are split into several batches can be answered by several replicas at once
+        self._lock = threading.Lock()
+
+    def add_stages(self, stages):
+        with self._lock:
+            for stage, seconds in stages.items():
+                self.stages[stage] = self.stages.get(stage, 0) + seconds
+
+
+class RequestTracer(object):
+    """
+    Writes a sample of the requests a server answers to a binary log, for offline analysis and replay with `genienlp replay`.
+
+    Each record is a JSON object, prefixed by its length in bytes as a 4-byte big-endian unsigned integer. When the log
+    reaches `max_bytes`, it is rotated to `path`.1 (and `path`.1 to `path`.2, and so on, keeping `backups` old files).
+
+    `record()` is called from the event loop, so records are serialized and written by a background thread. If more
+    than `max_queued` records are waiting to be written, new ones are dropped rather than slowing down the server.
+    """
+
+    def __init__(self, path, sample_rate, max_bytes=100 * 1024 * 1024, backups=5, payloads=False, max_queued=10000):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.payloads = payloads
+        self.num_dropped = 0
+
+        self._file = open(path, 'ab')
+        self._queue = queue.Queue(max_queued)
+        self._writer = threading.Thread(target=self._write_records, name='request-tracer', daemon=True)
+        self._writer.start()
+
+    def should_trace(self):
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def record(self, trace, status, latency):
+        request = trace.request
+        instances = request['instances'] if 'instances' in request else [request]
+        record = {
+            'time': trace.arrival_time,
+            'id': request.get('id'),
+            'model': request.get('model'),
+            'task': request.get('task', 'generic'),
+            'options': request.get('options', {}),
+            'stream': request.get('stream', False),
+            'timeout_ms': request.get('timeout_ms'),
+            # number of words in the context and question of each instance
+            'instance_lengths': [
+                [len(instance.get('context', '').split()), len(instance.get('question', '').split())] for instance in instances
+            ],
+            'status': status,
+            'latency': latency,
+            # a copy, since batches of a request that was already answered (e.g. after its deadline) can still add to it
+            'stages': dict(trace.stages),
+        }
+        if self.payloads:
+            record['request'] = request
+        if self._writer is None:
+            return
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            if self.num_dropped == 0:
+                logger.warning(f'Writing to {self.path} cannot keep up, dropping trace records')
+            self.num_dropped += 1
+
+    def _write_records(self):
+        while True:
+            record = self._queue.get()
+            if record is None:
+                break
+            try:
+                data = json.dumps(record, ensure_ascii=False).encode('utf-8')
+                if 0 < self.max_bytes < self._file.tell() + len(data):
+                    self._rotate()
+                self._file.write(_record_header.pack(len(data)) + data)
+                # flush once the backlog is written, so that the file is usable while the server runs
+                if self._queue.empty():
+                    self._file.flush()
+            except (TypeError, ValueError, OSError):
+                # one bad record or a full disk should not stop tracing for the rest of the server's life
+                logger.exception(f'Failed to write a trace record to {self.path}')
+        self._file.close()
+
+    def _rotate(self):
+        self._file.close()
+        try:
+            for i in range(self.backups - 1, 0, -1):
+                if os.path.exists(f'{self.path}.{i}'):
+                    os.replace(f'{self.path}.{i}', f'{self.path}.{i + 1}')
+            if self.backups > 0:
+                os.replace(self.path, f'{self.path}.1')
+            else:
+                os.remove(self.path)
+        finally:
+            # keep writing, to the old file if it could not be rotated
+            self._file = open(self.path, 'ab')
+
+    def close(self, timeout=10):
+        """
+        Writes the records that are still queued, then closes the log. Gives up after `timeout` seconds.
+        """
+        if self._writer is None:
+            return
+        writer, self._writer = self._writer, None
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            logger.warning(f'Timed out writing the remaining trace records to {self.path}')
+            return
+        writer.join(timeout)
+        if writer.is_alive():
+            logger.warning(f'Timed out writing the remaining trace records to {self.path}')
+
+
+def read_trace(path):
+    """
+    Yields the records of the log at `path`, including its rotated files, from oldest to newest
+    """
+    paths = []
+    i = 1
+    while os.path.exists(f'{path}.{i}'):
+        paths.append(f'{path}.{i}')
+        i += 1
+    paths = paths[::-1] + [path]
+
+    for file_path in paths:
+        with open(file_path, 'rb') as fin:
+            while True:
+                header = fin.read(_record_header.size)
+                if len(header) < _record_header.size:
+                    break
+                (length,) = _record_header.unpack(header)
+                data = fin.read(length)
+                if len(data) < length:
+                    logger.warning(f'{file_path} ends with a truncated record')
+                    break
+                yield json.loads(data)
@@ -31,11 +31,11 @@
 import json
 import logging
 import os
-from typing import Iterable
 
 from datasets import load_dataset
 
 from ..data_utils.example import Example, NumericalizedExamples
+from ..data_utils.iterator import PaddedBatchSize
 from .base_dataset import Dataset, Split, interleave_keys
 
 logger = logging.getLogger(__name__)
@@ -72,16 +72,9 @@ def id_value(ex):
 
 
 # batch_size functions; batch size is calculated after pad tokens are added
-def input_tokens_fn(batch: Iterable[NumericalizedExamples]):
-    return max([context_question_len(e) for e in batch]) * len(batch)
-
-
-def all_tokens_fn(batch: Iterable[NumericalizedExamples]):
-    return (max([context_question_len(e) for e in batch]) + max([answer_len(e) for e in batch])) * len(batch)
-
-
-def default_batch_fn(batch: Iterable[NumericalizedExamples]):
-    return len(batch)
+input_tokens_fn = PaddedBatchSize(context_question_len)
+all_tokens_fn = PaddedBatchSize(context_question_len, answer_len)
+default_batch_fn = PaddedBatchSize()
 
 
 class CQA(Dataset):
@@ -446,7 +446,13 @@ def train(
         (
             task,
             make_data_loader(
-                dataset, numericalizer, tok, main_device, train=True, batching_algorithm=args.train_batching_algorithm
+                dataset,
+                numericalizer,
+                tok,
+                main_device,
+                train=True,
+                batching_algorithm=args.train_batching_algorithm,
+                num_workers=args.data_loader_workers,
             ),
         )
         for task, dataset, tok in zip(args.train_tasks, train_sets, args.train_batch_tokens)
@@ -461,7 +467,7 @@ def train(
     val_iters = [
         (
             task,
-            make_data_loader(dataset, numericalizer, bs, main_device, train=False),
+            make_data_loader(dataset, numericalizer, bs, main_device, train=False, num_workers=args.data_loader_workers),
         )  # no need to specify batching_algorithm for validation sets
         for task, dataset, bs in zip(args.val_tasks, val_sets, args.val_batch_size)
     ]
@@ -474,7 +480,13 @@ def train(
             (
                 name,
                 make_data_loader(
-                    dataset, numericalizer, tok, main_device, train=True, batching_algorithm=args.train_batching_algorithm
+                    dataset,
+                    numericalizer,
+                    tok,
+                    main_device,
+                    train=True,
+                    batching_algorithm=args.train_batching_algorithm,
+                    num_workers=args.data_loader_workers,
                 ),
             )
             for name, dataset, tok in zip(args.train_tasks, aux_sets, args.train_batch_tokens)
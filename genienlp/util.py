@@ -36,6 +36,7 @@ import re
 import shutil
 import sys
 import time
+from functools import partial
 from json.decoder import JSONDecodeError
 
 import numpy as np
@@ -311,9 +312,39 @@ def elapsed_time(log):
     return f'{day:02}:{hour:02}:{minutes:02}:{seconds:02}'
 
 
+class DeviceDataLoader(object):
+    """
+    Wraps a DataLoader that collates batches on the CPU, and moves each batch to `device` as it is consumed.
+    The copies are asynchronous when the DataLoader pins memory, so they overlap with the computation on the device.
+    """
+
+    def __init__(self, data_loader, device):
+        self.data_loader = data_loader
+        self.device = device
+
+    def __len__(self):
+        return len(self.data_loader)
+
+    def __iter__(self):
+        for batch in self.data_loader:
+            yield batch.to(self.device, non_blocking=True)
+
+
 def make_data_loader(
-    dataset, numericalizer, batch_size, device=None, train=False, return_original_order=False, batching_algorithm='sample'
+    dataset,
+    numericalizer,
+    batch_size,
+    device=None,
+    train=False,
+    return_original_order=False,
+    batching_algorithm='sample',
+    batch_plan_dir=None,
+    num_workers=0,
 ):
+    """
+    num_workers: number of processes that collate batches, so that data preparation overlaps with the model's computation.
+    0 collates in the main process.
+    """
     args = numericalizer.args
     all_features = NumericalizedExamples.from_examples(dataset, numericalizer)
 
@@ -397,15 +428,20 @@ def make_data_loader(
         batch_size_fn=batch_size_fn,
         groups=dataset.groups,
         batching_algorithm=batching_algorithm,
+        batch_plan_dir=batch_plan_dir,
     )
     # get the sorted data_source
     all_f = sampler.data_source
+    # batches are collated on the CPU, possibly in worker processes, and pinned so that they can be copied asynchronously
     data_loader = torch.utils.data.DataLoader(
         all_f,
         batch_sampler=sampler,
-        collate_fn=lambda batches: NumericalizedExamples.collate_batches(batches, numericalizer, device),
-        num_workers=0,
+        collate_fn=partial(NumericalizedExamples.collate_batches, numericalizer=numericalizer, device=None),
+        num_workers=num_workers,
+        pin_memory=device is not None and device.type == 'cuda',
     )
+    if device is not None:
+        data_loader = DeviceDataLoader(data_loader, device)
 
     if return_original_order:
         return data_loader, sampler.original_order
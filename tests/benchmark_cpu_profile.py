@@ -0,0 +1,135 @@
+#
+# Copyright (c) 2022, The Board of Trustees of the Leland Stanford Junior University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Measures the throughput and latency of `genienlp server` on CPU with the default settings, with `--cpu_profile` and
+with `--quantize dynamic-int8`:
+
+    python3 tests/benchmark_cpu_profile.py --path MODEL_DIR [--num_requests N] [--trace_file TRACE] [--server_args ARGS]
+
+Each configuration runs in a new server process, which gets the same stream of requests through `genienlp replay`
+(all requests at once, over pipelined connections): the requests of TRACE if given, or synthetic requests otherwise.
+A few requests are sent first and left out of the report, so that the first batches do not count.
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import shlex
+import socket
+import subprocess
+import sys
+import time
+
+from genienlp import replay
+from genienlp.server_utils.tracing import read_trace
+
+CONFIGURATIONS = [
+    ('defaults', []),
+    ('--cpu_profile', ['--cpu_profile']),
+    ('--quantize dynamic-int8', ['--quantize', 'dynamic-int8']),
+]
+
+
+def make_records(num_requests, seed):
+    # trace records without payloads; the replay gives each instance a context of the recorded number of words
+    rng = random.Random(seed)
+    return [
+        {
+            'time': 0.0,
+            'task': 'generic',
+            'options': {},
+            'instance_lengths': [(rng.randint(5, 30), 1) for _ in range(rng.randint(1, 4))],
+            'latency': None,
+        }
+        for _ in range(num_requests)
+    ]
+
+
+def start_server(args, configuration_args):
+    command = [sys.executable, '-m', 'genienlp', 'server', '--path', args.path, '--port', str(args.port)]
+    command += shlex.split(args.server_args) + configuration_args
+    # as in the tests, so that the server runs on CPU even on hosts with GPUs
+    process = subprocess.Popen(command, env=dict(os.environ, CUDA_VISIBLE_DEVICES=''))
+    for _ in range(300):
+        if process.poll() is not None:
+            raise RuntimeError(f'The server exited with status {process.returncode}')
+        try:
+            socket.create_connection(('localhost', args.port)).close()
+            return process
+        except OSError:
+            time.sleep(1)
+    process.terminate()
+    raise RuntimeError('The server did not start')
+
+
+def run_configuration(args, records, configuration_args):
+    process = start_server(args, configuration_args)
+    try:
+        loop = asyncio.get_event_loop()
+        replay_args = argparse.Namespace(host='localhost', port=args.port, speed=0, connections=args.connections)
+        loop.run_until_complete(replay.replay(records[: args.warmup_requests], replay_args))
+        results, elapsed = loop.run_until_complete(replay.replay(records, replay_args))
+    finally:
+        # SIGTERM drains the server gracefully
+        process.terminate()
+        process.wait()
+    return replay.make_report(results, elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--path', type=str, required=True)
+    parser.add_argument('--port', default=8411, type=int)
+    parser.add_argument('--trace_file', type=str, default=None, help='replay the requests of this trace')
+    parser.add_argument('--num_requests', default=200, type=int, help='number of synthetic requests, without --trace_file')
+    parser.add_argument('--warmup_requests', default=8, type=int)
+    parser.add_argument('--connections', default=4, type=int)
+    parser.add_argument('--server_args', default='', type=str, help='arguments passed to every server, e.g. "--workers 2"')
+    parser.add_argument('--seed', default=123, type=int)
+    args = parser.parse_args()
+
+    if args.trace_file is not None:
+        records = sorted(read_trace(args.trace_file), key=lambda record: record['time'])
+    else:
+        records = make_records(args.num_requests, args.seed)
+
+    for name, configuration_args in CONFIGURATIONS:
+        report = run_configuration(args, records, configuration_args)
+        if report['statuses'].get('ok', 0) != len(records):
+            raise RuntimeError(f'Not all requests were answered with {name}: {report["statuses"]}')
+        print(
+            f'{name}: {report["requests_per_second"]:.2f} requests/s, '
+            f'p50 {report["latency"]["p50"] * 1000:.1f} ms, p99 {report["latency"]["p99"] * 1000:.1f} ms'
+        )
+
+
+if __name__ == '__main__':
+    main()
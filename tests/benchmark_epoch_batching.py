@@ -0,0 +1,123 @@
+#
+# Copyright (c) 2022, The Board of Trustees of the Leland Stanford Junior University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Measures how long the `epoch` batching algorithm of `LengthSortedIterator` takes to build training batches over a large
+synthetic dataset:
+
+    python3 tests/benchmark_epoch_batching.py [--num_examples N] [--num_batches N]
+
+The examples that are already in a batch of the current epoch are tracked once with `_UnmarkedIndices`, and once with
+`ArrayUnmarkedIndices` below, which keeps them in a flat array and rescans it as the iterator did before. With the same
+seed, both must give the same batches.
+"""
+
+import argparse
+import random
+import time
+
+import numpy as np
+
+from genienlp.data_utils import iterator
+from genienlp.data_utils.iterator import LengthSortedIterator, PaddedBatchSize
+
+
+class ArrayUnmarkedIndices(object):
+    """
+    The previous bookkeeping: a cumulative sum over the whole dataset to find the k-th unmarked index, and a Python loop
+    over the marks to find the next unmarked one
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.marked = np.zeros(shape=(size,))
+
+    @property
+    def num_unmarked(self):
+        return self.size - int(np.sum(self.marked))
+
+    def mark(self, index):
+        self.marked[index] = 1
+
+    def find(self, k):
+        return np.searchsorted(np.arange(0, self.size) - np.cumsum(self.marked), k, side='left')
+
+    def next_unmarked(self, index):
+        index += 1
+        while index < self.size and self.marked[index] == 1:
+            index += 1
+        return index
+
+
+def make_examples(num_examples, seed):
+    rng = random.Random(seed)
+    return sorted((rng.randint(5, 60) for _ in range(num_examples)), reverse=True)
+
+
+def build_batches(examples, args, unmarked_indices_class):
+    iterator._UnmarkedIndices = unmarked_indices_class
+    random.seed(args.seed)
+    batches = LengthSortedIterator(
+        examples,
+        batch_size=args.batch_size,
+        sort=False,
+        shuffle_and_repeat=True,
+        sort_key_fn=None,
+        batch_size_fn=PaddedBatchSize(lambda length: length),
+        batching_algorithm='epoch',
+    )
+    start = time.perf_counter()
+    batches = [next(batches) for _ in range(args.num_batches)]
+    return batches, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--num_examples', default=2000000, type=int)
+    parser.add_argument('--num_batches', default=200, type=int)
+    parser.add_argument('--batch_size', default=4000, type=int, help='in tokens')
+    parser.add_argument('--seed', default=123, type=int)
+    args = parser.parse_args()
+
+    examples = make_examples(args.num_examples, args.seed)
+    fenwick_tree_class = iterator._UnmarkedIndices
+    try:
+        fenwick_batches, fenwick_seconds = build_batches(examples, args, fenwick_tree_class)
+        array_batches, array_seconds = build_batches(examples, args, ArrayUnmarkedIndices)
+    finally:
+        iterator._UnmarkedIndices = fenwick_tree_class
+    assert fenwick_batches == array_batches, 'The two ways of tracking unmarked examples disagree'
+    print(
+        f'{args.num_examples} examples, {args.num_batches} batches of up to {args.batch_size} tokens: '
+        f'{fenwick_seconds:.2f} s with a Fenwick tree, {array_seconds:.2f} s with an array'
+    )
+
+
+if __name__ == '__main__':
+    main()
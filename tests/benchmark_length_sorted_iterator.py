@@ -0,0 +1,110 @@
+#
+# Copyright (c) 2022, The Board of Trustees of the Leland Stanford Junior University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Measures how long `LengthSortedIterator` takes to plan the batches of one pass over a synthetic dataset, i.e. without
+shuffling:
+
+    python3 tests/benchmark_length_sorted_iterator.py [--num_examples N] [--batch_sizes TOKENS ...]
+
+Batches are planned once with the built-in `PaddedBatchSize`, whose size is updated incrementally as examples are added,
+and once with the same function wrapped in a plain function, which the iterator has to call on the whole growing batch
+for each candidate example, as it did for all batch size functions before. Both must give the same batches.
+"""
+
+import argparse
+import random
+import time
+from typing import NamedTuple
+
+import numpy as np
+
+from genienlp.data_utils.iterator import LengthSortedIterator, PaddedBatchSize
+
+
+class SyntheticExample(NamedTuple):
+    context_length: int
+    answer_length: int
+
+
+def context_length(ex):
+    return ex.context_length
+
+
+def answer_length(ex):
+    return ex.answer_length
+
+
+def make_examples(num_examples, seed):
+    rng = random.Random(seed)
+    examples = [SyntheticExample(rng.randint(5, 60), rng.randint(3, 40)) for _ in range(num_examples)]
+    # already sorted from long to short, as the training and evaluation iterators sort them
+    examples.sort(key=lambda ex: (ex.context_length, ex.answer_length), reverse=True)
+    return examples
+
+
+def plan_batches(examples, batch_size, batch_size_fn):
+    start = time.perf_counter()
+    iterator = LengthSortedIterator(
+        examples,
+        batch_size=batch_size,
+        sort=False,
+        shuffle_and_repeat=False,
+        sort_key_fn=None,
+        batch_size_fn=batch_size_fn,
+    )
+    return iterator.batch_plan, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--num_examples', default=1000000, type=int)
+    parser.add_argument('--batch_sizes', default=[4000, 16000], nargs='+', type=int, help='batch sizes, in tokens')
+    parser.add_argument('--seed', default=123, type=int)
+    args = parser.parse_args()
+
+    examples = make_examples(args.num_examples, args.seed)
+    incremental_fn = PaddedBatchSize(context_length, answer_length)
+
+    def whole_batch_fn(batch):
+        return incremental_fn(batch)
+
+    for batch_size in args.batch_sizes:
+        incremental_plan, incremental_seconds = plan_batches(examples, batch_size, incremental_fn)
+        whole_batch_plan, whole_batch_seconds = plan_batches(examples, batch_size, whole_batch_fn)
+        assert np.array_equal(incremental_plan, whole_batch_plan), 'The two ways of computing batch sizes disagree'
+        print(
+            f'{args.num_examples} examples, {len(incremental_plan) - 1} batches of up to {batch_size} tokens: '
+            f'{incremental_seconds:.1f} s incrementally, {whole_batch_seconds:.1f} s calling the batch size function '
+            f'on whole batches'
+        )
+
+
+if __name__ == '__main__':
+    main()
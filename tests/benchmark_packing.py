@@ -0,0 +1,123 @@
+#
+# Copyright (c) 2022, The Board of Trustees of the Leland Stanford Junior University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Measures the training throughput of a T5 model with and without `--pack_examples`:
+
+    python3 tests/benchmark_packing.py --path MODEL_DIR --data_file TSV_FILE [--batch_size N] [--num_steps N] [--repeats N]
+
+Training batches are drawn at random from the examples of TSV_FILE (id, context and answer on each line, as in the almond
+datasets), so that they mix short and long examples as in training. Each mode runs the same batches through forward,
+backward and an optimizer step, and reports the number of examples and of answer tokens (without padding) per second.
+Every run starts from a fresh copy of the loaded model with a new optimizer, and the two modes alternate, so that neither
+benefits from the training or the warm caches of the other. The median of `--repeats` runs of each mode is reported.
+"""
+
+import argparse
+import copy
+import random
+import statistics
+import time
+
+import torch
+
+from genienlp import server
+from genienlp.data_utils.example import Example, NumericalizedExamples
+
+
+def read_examples(path):
+    examples = []
+    with open(path) as fp:
+        for line in fp:
+            example_id, context, answer = line.rstrip('\n').split('\t')[:3]
+            examples.append(Example.from_raw(example_id, context, 'translate', answer))
+    return examples
+
+
+def train_step(model, optimizer, batch):
+    loss = model(batch, train=True).loss
+    loss.backward()
+    optimizer.step()
+    optimizer.zero_grad()
+
+
+def time_training(initial_model, batches, pack_examples):
+    # the numericalizer is never modified by training, so the copies can share it
+    model = copy.deepcopy(initial_model, {id(initial_model.numericalizer): initial_model.numericalizer})
+    model.args.pack_examples = pack_examples
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-5)
+    # the first step allocates the optimizer state
+    train_step(model, optimizer, batches[0])
+    start = time.perf_counter()
+    for batch in batches:
+        train_step(model, optimizer, batch)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    server.parse_argv(parser)
+    parser.add_argument('--data_file', required=True, type=str)
+    parser.add_argument('--batch_size', default=32, type=int, help='number of examples in each batch')
+    parser.add_argument('--num_steps', default=20, type=int, help='number of training steps to time in each mode')
+    parser.add_argument('--pack_max_length', default=0, type=int, help='as in `genienlp train`')
+    parser.add_argument('--repeats', default=3, type=int, help='number of timed runs of each mode')
+    args = parser.parse_args()
+
+    model, device = server.init(args)[:2]
+    model.train()
+    model.args.pack_max_length = args.pack_max_length
+
+    features = NumericalizedExamples.from_examples(read_examples(args.data_file), model.numericalizer)
+    rng = random.Random(args.seed)
+    batches = [
+        NumericalizedExamples.collate_batches(
+            [rng.choice(features) for _ in range(args.batch_size)], model.numericalizer, device
+        )
+        for _ in range(args.num_steps)
+    ]
+    num_examples = args.batch_size * args.num_steps
+    num_tokens = sum(batch.answer.length.sum().item() for batch in batches)
+
+    seconds = {False: [], True: []}
+    for _ in range(args.repeats):
+        for pack_examples in (False, True):
+            seconds[pack_examples].append(time_training(model, batches, pack_examples))
+    for pack_examples in (False, True):
+        median_seconds = statistics.median(seconds[pack_examples])
+        print(
+            f'{"packed" if pack_examples else "padded"} batches: {num_examples / median_seconds:.1f} examples/s, '
+            f'{num_tokens / median_seconds:.0f} answer tokens/s (median of {args.repeats} runs)'
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+#
+# Copyright (c) 2022, The Board of Trustees of the Leland Stanford Junior University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Measures the fixed CPU cost of `Server.handle_request`, that is everything but generation, with a stub in place of the
+model's `validate()`:
+
+    python3 tests/benchmark_server.py --path MODEL_DIR [--num_requests N]
+
+Requests alternate between two sets of generation options. They are timed once with request contexts reused across
+requests, and once with `original_init_request` below in place of `Server._init_request`, which is what every request
+paid before contexts were reused: a deep copy of all arguments, the language-dependent properties of the numericalizer
+and model reset, and the vocabulary and output options of the task updated.
+"""
+
+import argparse
+import copy
+import statistics
+import time
+
+from genienlp import server
+from genienlp.arguments import GENERATION_HYPERPARAMETERS
+from genienlp.models.base import ValidationOutput
+from genienlp.tasks.registry import get_tasks
+from genienlp.util import adjust_language_code
+
+REQUESTS = [
+    {'id': '1', 'task': 'generic', 'context': 'show me the weather .', 'question': 'translate'},
+    {
+        'id': '2',
+        'task': 'generic',
+        'options': {'num_beams': 2, 'num_outputs': 2},
+        'context': 'show me the weather .',
+        'question': 'translate',
+    },
+]
+
+
+def stub_validate(model, data_iterator, task, output_predictions_only=False, **kwargs):
+    # as many outputs per example as the options of the request ask for, so that the responses are formatted as usual
+    num_outputs = sum(model.args.num_outputs)
+    return ValidationOutput(predictions=[['stub answer'] * num_outputs for batch in data_iterator for _ in batch.example_id])
+
+
+def original_init_request(nlp_server, request):
+    """
+    `Server._init_request` as it was before request contexts were reused
+    """
+    args = copy.deepcopy(nlp_server.args)
+    for k, v in request.get('options', {}).items():
+        if k not in server.GENERATION_ARGUMENTS:
+            continue
+        # the original only accepted lists for these; wrap scalars so that the same requests can be sent
+        setattr(args, k, [v] if k in GENERATION_HYPERPARAMETERS and not isinstance(v, list) else v)
+
+    src_locale, tgt_locale = adjust_language_code(
+        nlp_server.model.config, nlp_server.args.pretrained_model, args.src_locale, args.tgt_locale
+    )
+    nlp_server.numericalizer.update_language_dependent_properties(src_locale, tgt_locale)
+    nlp_server.model.update_language_dependent_configs(tgt_locale)
+
+    task_name = request['task'] if 'task' in request else 'generic'
+    task = list(get_tasks([task_name], args, nlp_server._cached_task_names).values())[0]
+    if task_name not in nlp_server._cached_task_names:
+        nlp_server._cached_task_names[task_name] = task
+
+    # every request also grew the vocabulary and set the output options of its task
+    nlp_server._tasks_with_vocab.discard(task.name)
+    nlp_server._output_options_task = None
+    return task, args
+
+
+def time_requests(nlp_server, num_requests):
+    latencies = []
+    for i in range(num_requests):
+        request = REQUESTS[i % len(REQUESTS)]
+        start = time.perf_counter()
+        nlp_server.handle_request(request)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    server.parse_argv(parser)
+    parser.add_argument('--num_requests', default=1000, type=int, help='number of requests to time in each mode')
+    args = parser.parse_args()
+
+    model, device, confidence_estimators, estimator_filenames, ned_model = server.init(args)
+    nlp_server = server.Server(args, model, device, confidence_estimators, estimator_filenames, ned_model)
+    model.validate = lambda *a, **kw: stub_validate(model, *a, **kw)
+
+    # the first requests load the tasks and grow the vocabulary, which only happens once per process
+    time_requests(nlp_server, len(REQUESTS))
+
+    for mode in ('reused', 'original'):
+        if mode == 'original':
+            # tasks were cached per server too, but start from an empty cache as a new server would
+            nlp_server._cached_task_names = dict()
+            nlp_server._init_request = lambda request: original_init_request(nlp_server, request)
+        latencies = sorted(time_requests(nlp_server, args.num_requests))
+        print(
+            f'{"reused request contexts" if mode == "reused" else "original _init_request"}: '
+            f'median {statistics.median(latencies) * 1e6:.0f} us, '
+            f'p90 {latencies[int(0.9 * (len(latencies) - 1))] * 1e6:.0f} us per request'
+        )
+    nlp_server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -38,6 +38,31 @@ do
     exit 1
   fi
 
+  # collecting the features during greedy generation must give the same features as the teacher-forced pass
+  genienlp predict \
+    --tasks almond \
+    --evaluate test \
+    --path $workdir/model_$i \
+    --overwrite \
+    --eval_dir $workdir/model_$i/eval_results_from_generation/ \
+    --data $SRCDIR/dataset/ \
+    --embeddings $EMBEDDING_DIR \
+    --save_confidence_features \
+    --confidence_feature_path $workdir/model_$i/confidences_from_generation.pkl \
+    --confidence_from_generation \
+    --mc_dropout_num 0
+  python3 -c '
+import sys
+import torch
+teacher_forced, from_generation = torch.load(sys.argv[1]), torch.load(sys.argv[2])
+assert len(teacher_forced) == len(from_generation)
+for example_tf, example_gen in zip(teacher_forced, from_generation):
+    for tf, gen in zip(example_tf, example_gen):
+        assert torch.equal(tf.prediction, gen.prediction), (tf.prediction, gen.prediction)
+        for name in ("nodrop_logits", "nodrop_probs", "nodrop_entropies"):
+            assert torch.allclose(getattr(tf, name), getattr(gen, name), atol=1e-4), (name, getattr(tf, name), getattr(gen, name))
+' $workdir/model_$i/confidences.pkl $workdir/model_$i/confidences_from_generation.pkl
+
   # calibrate
   genienlp calibrate \
     --confidence_path $workdir/model_$i/confidences.pkl \
@@ -10,7 +10,8 @@ for hparams in \
   "--model TransformerLSTM --pretrained_model bert-base-cased --min_output_length 2 --trainable_decoder_embeddings=50 --num_beams 4 --num_beam_groups 4 --num_outputs 4 --diversity_penalty 1.0" \
   "--model TransformerLSTM --pretrained_model bert-base-cased --min_output_length 2 --trainable_decoder_embeddings=50  --override_question . --train_batching_algorithm epoch" \
   "--model TransformerLSTM --pretrained_model xlm-roberta-base --min_output_length 2 --trainable_decoder_embeddings=50 --eval_set_name aux" \
-  "--model TransformerSeq2Seq --pretrained_model sshleifer/bart-tiny-random --preprocess_special_tokens --min_output_length 2 --num_beams 4 --num_beam_groups 1 --num_outputs 4" ;
+  "--model TransformerSeq2Seq --pretrained_model sshleifer/bart-tiny-random --preprocess_special_tokens --min_output_length 2 --num_beams 4 --num_beam_groups 1 --num_outputs 4" \
+  "--model TransformerSeq2Seq --pretrained_model t5-small --pack_examples --pack_max_length 64" ;
 do
 
   # train
@@ -47,6 +48,19 @@ do
 
     echo "Testing the server mode"
     echo '{"id": "dummy_example_1", "context": "show me .", "question": "translate to thingtalk", "answer": "now => () => notify"}' | genienlp server --path $workdir/model_$i --stdin
+
+    echo "Testing int8 quantization"
+    # the metrics of models trained for a few iterations are meaningless, so only check that both modes predict
+    genienlp check-quantization \
+      --quantize dynamic-int8 \
+      --max_metric_drop 100 \
+      --tasks almond \
+      --evaluate test \
+      --path $workdir/model_$i \
+      --overwrite \
+      --eval_dir $workdir/model_$i/quantization_results/ \
+      --data $SRCDIR/dataset/ \
+      --embeddings $EMBEDDING_DIR
   fi
 
   if [ $i == 2 ] ; then
@@ -54,6 +68,52 @@ do
     diff -u $SRCDIR/expected_results/almond/bert_base_cased_beam.tsv $workdir/model_$i/eval_results/test/almond.tsv
   fi
 
+  if [ $i == 6 ] ; then
+    # packing examples must not change the loss of each example
+    python3 -c '
+import argparse, sys
+import torch
+from genienlp import server
+from genienlp.data_utils.example import Example, NumericalizedExamples, pack_examples
+
+parser = argparse.ArgumentParser()
+server.parse_argv(parser)
+model = server.init(parser.parse_args(["--path", sys.argv[1]]))[0]
+model.eval()  # no dropout
+examples = [
+    Example.from_raw(str(i), context, "translate", answer)
+    for i, (context, answer) in enumerate(
+        [
+            ("show me the weather .", "now => @org.weather.current => notify"),
+            ("post hello on twitter .", "now => @com.twitter.post param:status = \" hello \""),
+            ("what time is it ?", "now => @org.time.get => notify"),
+            ("play some music by the beatles on spotify .", "now => @com.spotify.play param:artist = \" the beatles \""),
+        ]
+    )
+]
+features = NumericalizedExamples.from_examples(examples, model.numericalizer)
+
+def example_losses(batch):
+    # forward() returns the loss averaged over the batch, which for a batch of one is the loss of that example
+    return [model(NumericalizedExamples.collate_batches([f], model.numericalizer, None), train=True).loss.item() for f in batch]
+
+with torch.no_grad():
+    model.args.pack_examples = False
+    alone = example_losses(features)
+    model.args.pack_examples, model.args.pack_max_length = True, 64
+    batch = NumericalizedExamples.collate_batches(features, model.numericalizer, None)
+    # several examples share each row
+    assert len(pack_examples(batch.context.length.tolist(), batch.answer.length.tolist(), 64, 64)) < len(features)
+    _, packed = model._packed_forward(batch.context, batch.answer.value, batch.answer.length)
+    packed = (packed / batch.answer.length).tolist()
+print(alone, packed)
+assert all(abs(a - p) <= 1e-4 * max(1, abs(a)) for a, p in zip(alone, packed)), (alone, packed)
+' $workdir/model_$i
+
+    # training throughput with and without packing
+    python3 $SRCDIR/benchmark_packing.py --path $workdir/model_$i --data_file $SRCDIR/dataset/almond/train.tsv --num_steps 5 --repeats 1
+  fi
+
   rm -rf $workdir/model_$i $workdir/model_"$i"_exported
 
   i=$((i+1))
@@ -0,0 +1,303 @@
+#!/usr/bin/env bash
+
+. ./tests/lib.sh
+
+# a small client for the TCP server; see the usage of each mode below
+cat > $workdir/client.py <<'END'
+import asyncio
+import json
+import struct
+import sys
+
+import msgpack
+
+mode, port = sys.argv[1], int(sys.argv[2])
+
+
+def read_requests(path):
+    with open(path) as fp:
+        return [json.loads(line) for line in fp]
+
+
+def print_responses(responses):
+    for response in sorted(responses, key=lambda response: response['id']):
+        print(json.dumps(response, ensure_ascii=False, sort_keys=True))
+
+
+async def send(reader, writer, request):
+    writer.write((json.dumps(request) + '\n').encode('utf-8'))
+    await writer.drain()
+    return json.loads(await reader.readline())
+
+
+async def open_msgpack_connection():
+    reader, writer = await asyncio.open_connection('localhost', port)
+    ack = await send(reader, writer, {'protocol': 'msgpack', 'pipeline': True})
+    assert ack == {'protocol': 'msgpack', 'pipeline': True}, ack
+    return reader, writer
+
+
+def write_frame(writer, payload):
+    writer.write(struct.pack('>I', len(payload)) + payload)
+
+
+async def read_frame(reader):
+    (length,) = struct.unpack('>I', await reader.readexactly(4))
+    return msgpack.unpackb(await reader.readexactly(length), raw=False)
+
+
+async def main():
+    if mode == 'serial':
+        # client.py serial PORT REQUESTS_FILE: sends the requests one after the other, and prints the responses
+        reader, writer = await asyncio.open_connection('localhost', port)
+        responses = [await send(reader, writer, request) for request in read_requests(sys.argv[3])]
+        for response in responses:
+            assert 'error' not in response, response
+        print_responses(responses)
+    elif mode == 'concurrent':
+        # client.py concurrent PORT REQUESTS_FILE: sends all requests at once, on one connection each, so that the
+        # server batches them together, and prints the responses
+        requests = read_requests(sys.argv[3])
+        connections = [await asyncio.open_connection('localhost', port) for _ in requests]
+        responses = await asyncio.gather(
+            *[send(reader, writer, request) for (reader, writer), request in zip(connections, requests)]
+        )
+        for response in responses:
+            assert 'error' not in response, response
+        print_responses(responses)
+    elif mode == 'pipelined':
+        # client.py pipelined PORT REQUESTS_FILE: negotiates msgpack, sends all requests on one connection without
+        # waiting for the responses, and prints the responses, which can arrive in any order
+        requests = read_requests(sys.argv[3])
+        reader, writer = await open_msgpack_connection()
+        for request in requests:
+            write_frame(writer, msgpack.packb(request, use_bin_type=True))
+        await writer.drain()
+        responses = [await read_frame(reader) for _ in requests]
+        for response in responses:
+            assert 'error' not in response, response
+        assert sorted(response['id'] for response in responses) == sorted(request['id'] for request in requests)
+        print_responses(responses)
+    elif mode == 'streaming':
+        # client.py streaming PORT REQUESTS_FILE: sends the requests one after the other with streaming enabled, checks
+        # that partial answers arrive before each response, and prints the responses
+        reader, writer = await asyncio.open_connection('localhost', port)
+        responses = []
+        for request in read_requests(sys.argv[3]):
+            response = await send(reader, writer, dict(request, stream=True))
+            num_partials = 0
+            while response.get('partial', False):
+                assert response['id'] == request['id'], response
+                num_partials += 1
+                response = json.loads(await reader.readline())
+            assert num_partials > 0, f'No partial answer for request {request["id"]}'
+            assert 'error' not in response, response
+            responses.append(response)
+        print_responses(responses)
+    elif mode == 'models':
+        # client.py models PORT MODEL_PATH REQUESTS_FILE: loads the model in MODEL_PATH under another name, sends the
+        # requests to it and prints the responses, then unloads it and checks that requests for it are rejected
+        reader, writer = await asyncio.open_connection('localhost', port)
+        response = await send(reader, writer, {'id': 'load', 'control': 'load', 'model': 'other', 'path': sys.argv[3]})
+        assert 'error' not in response, response
+        assert 'other' in [model['model'] for model in response['models']], response
+        requests = read_requests(sys.argv[4])
+        responses = [await send(reader, writer, dict(request, model='other')) for request in requests]
+        for response in responses:
+            assert 'error' not in response, response
+        response = await send(reader, writer, {'id': 'unload', 'control': 'unload', 'model': 'other'})
+        assert 'error' not in response, response
+        assert 'other' not in [model['model'] for model in response['models']], response
+        response = await send(reader, writer, dict(requests[0], model='other'))
+        assert response.get('code') == 'unknown_model', response
+        print_responses(responses)
+    elif mode == 'control_disabled':
+        # client.py control_disabled PORT MODEL_PATH: checks that control requests are rejected
+        reader, writer = await asyncio.open_connection('localhost', port)
+        response = await send(reader, writer, {'id': 'load', 'control': 'load', 'model': 'other', 'path': sys.argv[3]})
+        assert response.get('code') == 'forbidden', response
+        response = await send(reader, writer, {'id': 'models', 'control': 'models'})
+        assert response.get('code') == 'forbidden', response
+    elif mode == 'deadline':
+        # client.py deadline PORT REQUESTS_FILE: checks that a request with a deadline that is too short to answer it is
+        # rejected, and that the same request without a deadline is still answered
+        reader, writer = await asyncio.open_connection('localhost', port)
+        request = dict(read_requests(sys.argv[3])[0], cache=False)
+        response = await send(reader, writer, dict(request, timeout_ms=1))
+        assert response.get('code') == 'deadline_exceeded', response
+        response = await send(reader, writer, request)
+        assert 'error' not in response, response
+    elif mode == 'options':
+        # client.py options PORT REQUESTS_FILE: checks that the generation options of a request change its answers
+        reader, writer = await asyncio.open_connection('localhost', port)
+        request = read_requests(sys.argv[3])[0]
+        response = await send(reader, writer, dict(request, options={'num_beams': 2, 'num_outputs': 2}))
+        assert 'error' not in response, response
+        for instance in response['instances']:
+            assert len(instance['candidates']) == 2, response
+    elif mode == 'metric':
+        # client.py metric PORT NAME: prints the value of a metric (with its labels, if any) served on PORT, or 0
+        reader, writer = await asyncio.open_connection('localhost', port)
+        writer.write(b'GET /metrics HTTP/1.0\r\n\r\n')
+        lines = (await reader.read()).decode('utf-8').splitlines()
+        values = [line.split()[-1] for line in lines if line.split(' ')[0] == sys.argv[3]]
+        print(values[0] if values else 0)
+    elif mode == 'malformed':
+        # client.py malformed PORT: sends a message that is not valid msgpack, and checks that the server answers with
+        # an error and closes the connection
+        reader, writer = await open_msgpack_connection()
+        write_frame(writer, b'\xc1')
+        await writer.drain()
+        response = await read_frame(reader)
+        assert response['code'] == 'protocol_error', response
+        assert await reader.read() == b''
+    else:
+        raise ValueError(f'Unknown mode {mode}')
+
+
+asyncio.run(main())
+END
+
+# starts the server in the background, with the given arguments, and waits until it accepts connections
+start_server () {
+  genienlp server --path $workdir/model_$i --port 8401 "$@" &
+  SERVER_PID=$!
+  for attempt in $(seq 120) ; do
+    if python3 -c 'import socket; socket.create_connection(("localhost", 8401)).close()' 2>/dev/null ; then
+      return
+    fi
+    sleep 1
+  done
+  echo "The server did not start"
+  exit 1
+}
+
+# stops the server gracefully, and waits until it exits
+stop_server () {
+  kill $SERVER_PID
+  wait $SERVER_PID
+}
+
+# requests with several instances, some of them split into sentences whose answers are merged
+cat > $workdir/requests.jsonl <<'END'
+{"id": "1", "task": "generic", "instances": [{"example_id": "a", "context": "show me the weather .", "question": "translate"}, {"example_id": "b", "context": "what time is it ?", "question": "translate"}]}
+{"id": "2", "task": "generic", "instances": [{"example_id": "a", "context": "play some music .", "question": "translate"}]}
+{"id": "3", "task": "generic", "instances": [{"example_id": "c", "context": "show me restaurants .", "question": "translate"}, {"example_id": "d", "context": "turn on the lights .", "question": "translate"}, {"example_id": "e", "context": "post on twitter .", "question": "translate"}]}
+{"id": "4", "task": "generic", "options": {"translate_example_split": true}, "instances": [{"example_id": "a@0", "context": "hello .", "question": "translate"}, {"example_id": "a@1", "context": "show me the news .", "question": "translate"}, {"example_id": "b@0", "context": "get my emails .", "question": "translate"}]}
+{"id": "5", "task": "generic", "options": {"translate_example_split": true}, "instances": [{"example_id": "a@0", "context": "good morning .", "question": "translate"}, {"example_id": "a@1", "context": "what is on my calendar ?", "question": "translate"}]}
+{"id": "6", "task": "generic", "instances": [{"example_id": "f", "context": "set an alarm .", "question": "translate"}]}
+END
+
+i=0
+for hparams in \
+  "--model TransformerSeq2Seq --pretrained_model sshleifer/bart-tiny-random" ;
+do
+
+  # train
+  genienlp train \
+    $SHARED_TRAIN_HPARAMS \
+    --train_tasks almond \
+    --train_batch_tokens 100 \
+    --val_batch_size 100 \
+    --train_iterations 4 \
+    --save $workdir/model_$i \
+    --data $SRCDIR/dataset/ \
+    $hparams
+
+  # a batching window long enough for concurrent requests to share batches; trace every request
+  start_server --batch_wait_ms 500 --trace_file $workdir/trace.bin --trace_sample_rate 1 --trace_payloads
+
+  python3 $workdir/client.py serial 8401 $workdir/requests.jsonl > $workdir/serial.jsonl
+  python3 $workdir/client.py concurrent 8401 $workdir/requests.jsonl > $workdir/concurrent.jsonl
+
+  python3 $workdir/client.py pipelined 8401 $workdir/requests.jsonl > $workdir/pipelined.jsonl
+
+  # batching requests together must not change their answers
+  diff -u $workdir/serial.jsonl $workdir/concurrent.jsonl
+  # neither does pipelining them over msgpack
+  diff -u $workdir/serial.jsonl $workdir/pipelined.jsonl
+  python3 $workdir/client.py malformed 8401
+  # control requests are disabled by default
+  python3 $workdir/client.py control_disabled 8401 $workdir/model_$i
+
+  # streaming sends partial answers first, then the same response as without streaming
+  python3 $workdir/client.py streaming 8401 $workdir/requests.jsonl > $workdir/streaming.jsonl
+  diff -u $workdir/serial.jsonl $workdir/streaming.jsonl
+  # split sentences are merged into one answer per example
+  if [ "$(grep '"id": "4"' $workdir/serial.jsonl | python3 -c 'import json, sys; print(len(json.load(sys.stdin)["instances"]))')" != 2 ] ; then
+    echo "Unexpected number of answers for split instances"
+    exit 1
+  fi
+
+  stop_server
+
+  # replicas pinned to their own cores, with weights mapped from a shared file, answer like a single replica
+  start_server --cpu_profile --workers 2 --mapped_weights_dir $workdir/mapped_weights
+  python3 $workdir/client.py concurrent 8401 $workdir/requests.jsonl > $workdir/cpu_profile.jsonl
+  stop_server
+  diff -u $workdir/serial.jsonl $workdir/cpu_profile.jsonl
+  if test -z "$(ls $workdir/mapped_weights)" ; then
+    echo "The mapped weights were not written"
+    exit 1
+  fi
+
+  # int8 replicas grow the vocabulary of the quantized model and answer real requests; their answers can differ from
+  # the full-precision ones
+  start_server --quantize dynamic-int8 --workers 2
+  python3 $workdir/client.py concurrent 8401 $workdir/requests.jsonl > /dev/null
+  stop_server
+
+  # repeated requests are answered from the response cache, with the same answers
+  start_server --cache_size 100 --metrics_port 8402 --allow_control_requests
+  cache_hits='genienlp_cache_lookups_total{result="hit"}'
+  python3 $workdir/client.py serial 8401 $workdir/requests.jsonl > $workdir/uncached.jsonl
+  if [ "$(python3 $workdir/client.py metric 8402 "$cache_hits")" != 0 ] ; then
+    echo "Unexpected cache hits"
+    exit 1
+  fi
+  python3 $workdir/client.py serial 8401 $workdir/requests.jsonl > $workdir/cached.jsonl
+  diff -u $workdir/uncached.jsonl $workdir/cached.jsonl
+  # every instance is a hit, except those of requests whose split instances are merged, which are never cached
+  expected_hits=$(python3 -c '
+import json, sys
+print(sum(len(r["instances"]) for r in map(json.loads, open(sys.argv[1])) if not r.get("options", {}).get("translate_example_split")))
+' $workdir/requests.jsonl)
+  if [ "$(python3 $workdir/client.py metric 8402 "$cache_hits")" != "$expected_hits" ] ; then
+    echo "Repeated requests were not answered from the cache"
+    exit 1
+  fi
+
+  # requests that cannot be answered before their deadline are rejected
+  python3 $workdir/client.py deadline 8401 $workdir/requests.jsonl
+
+  # generation options are applied per request
+  python3 $workdir/client.py options 8401 $workdir/requests.jsonl
+
+  # a model loaded at runtime answers the requests routed to it, until it is unloaded
+  python3 $workdir/client.py models 8401 $workdir/model_$i $workdir/requests.jsonl > $workdir/loaded.jsonl
+  diff -u $workdir/serial.jsonl $workdir/loaded.jsonl
+  stop_server
+
+  # fixed cost of answering a request, without generation
+  python3 $SRCDIR/benchmark_server.py --path $workdir/model_$i --num_requests 50
+  # throughput and latency with the default settings, --cpu_profile and --quantize dynamic-int8
+  python3 $SRCDIR/benchmark_cpu_profile.py --path $workdir/model_$i --num_requests 20
+
+  # replay the traced requests against a new server
+  start_server
+  genienlp replay --trace_file $workdir/trace.bin --port 8401 --output $workdir/replay.json
+  stop_server
+  python3 -c '
+import json, sys
+report = json.load(open(sys.argv[1]))
+# each request was sent four times: serially, concurrently, pipelined and streaming
+assert report["requests"] == 4 * int(sys.argv[2]), report
+assert report["statuses"] == {"ok": report["requests"]}, report
+' $workdir/replay.json $(wc -l < $workdir/requests.jsonl)
+
+  rm -rf $workdir/model_$i $workdir/mapped_weights $workdir/cpu_profile.jsonl $workdir/serial.jsonl $workdir/concurrent.jsonl $workdir/pipelined.jsonl $workdir/streaming.jsonl $workdir/uncached.jsonl $workdir/cached.jsonl $workdir/loaded.jsonl $workdir/trace.bin* $workdir/replay.json
+  i=$((i+1))
+done
+
+rm -fr $workdir
+rm -rf $SRCDIR/torch-shm-file-*